@@ -0,0 +1,221 @@
+#   Copyright (C) 2026  agent <agent@local>
+#
+#   This file is part of cppreference-doc
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see http://www.gnu.org/licenses/.
+
+import concurrent.futures
+import datetime
+import heapq
+import json
+import time
+
+
+class PipelineStats:
+    ''' Collects the wall time and the number of processed elements of each
+        named pass of a page processing pipeline, along with the slowest
+        pages. The objects are picklable, thus worker processes may collect
+        statistics independently and return them to be merged by the driver.
+    '''
+
+    def __init__(self, num_slowest_pages=20):
+        self.num_slowest_pages = num_slowest_pages
+        self.num_pages = 0
+        self.num_warnings = 0
+        self.total_time = 0.0
+        # pass name -> [time, number of pages, number of elements]. The
+        # passes are kept in the order in which they have been first recorded
+        self.passes = dict()
+        # min-heap of (time, page) tuples
+        self.slowest_pages = []
+
+    def add_pass(self, name, elapsed, num_elements=0, num_pages=1):
+        entry = self.passes.setdefault(name, [0.0, 0, 0])
+        entry[0] += elapsed
+        entry[1] += num_pages
+        entry[2] += num_elements
+
+    def add_page(self, page, elapsed, num_warnings=0):
+        self.num_pages += 1
+        self.num_warnings += num_warnings
+        self.total_time += elapsed
+        self.add_slow_page(page, elapsed)
+
+    def add_slow_page(self, page, elapsed):
+        if len(self.slowest_pages) < self.num_slowest_pages:
+            heapq.heappush(self.slowest_pages, (elapsed, page))
+        elif self.slowest_pages and elapsed > self.slowest_pages[0][0]:
+            heapq.heapreplace(self.slowest_pages, (elapsed, page))
+
+    def merge(self, other):
+        self.num_pages += other.num_pages
+        self.num_warnings += other.num_warnings
+        self.total_time += other.total_time
+        for name, (elapsed, num_pages, num_elements) in other.passes.items():
+            self.add_pass(name, elapsed, num_elements, num_pages)
+        for elapsed, page in other.slowest_pages:
+            self.add_slow_page(page, elapsed)
+
+    def to_json(self):
+        return {
+            'pages': self.num_pages,
+            'warnings': self.num_warnings,
+            'total_time': self.total_time,
+            'passes': [
+                {
+                    'name': name,
+                    'time': elapsed,
+                    'pages': num_pages,
+                    'elements': num_elements,
+                }
+                for name, (elapsed, num_pages, num_elements)
+                in self.passes.items()
+            ],
+            'slowest_pages': [
+                {'page': page, 'time': elapsed}
+                for elapsed, page in sorted(self.slowest_pages, reverse=True)
+            ],
+        }
+
+    def write(self, fn):
+        with open(fn, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=2)
+            f.write('\n')
+
+
+def count_elements(root):
+    return sum(1 for _ in root.iter())
+
+
+class PassTimer:
+    ''' Records the time that has elapsed since the previous lap as a pass of
+        a single page into the given PipelineStats object. Does nothing if
+        stats is None, so that the pipelines can be instrumented without
+        overhead when statistics are not requested. The names of the passes
+        are prefixed with prefix, so that the passes of several pipelines
+        that process the same page can be told apart.
+    '''
+
+    def __init__(self, stats, page, prefix=''):
+        self.stats = stats
+        self.page = page
+        self.prefix = prefix
+        if stats is not None:
+            self.start = time.perf_counter()
+            self.last = self.start
+
+    def lap(self, name, root=None):
+        ''' Records a pass that ended just now. If root is given, the
+            elements in it are counted as the elements processed by the pass.
+        '''
+        if self.stats is None:
+            return
+        now = time.perf_counter()
+        num_elements = 0 if root is None else count_elements(root)
+        self.stats.add_pass(self.prefix + name, now - self.last,
+                            num_elements)
+        # exclude the time spent counting the elements
+        self.last = time.perf_counter()
+
+    def lap_with_parts(self, name, parts):
+        ''' Like lap, but the time that has elapsed since the previous lap is
+            split into the given parts. parts is a dict that maps the names of
+            the parts to (time, number of elements) tuples. The remaining time
+            is recorded under name.
+        '''
+        if self.stats is None:
+            return
+        now = time.perf_counter()
+        remaining = now - self.last
+        for part_name, (elapsed, num_elements) in parts.items():
+            self.stats.add_pass(self.prefix + part_name, elapsed,
+                                num_elements)
+            remaining -= elapsed
+        self.stats.add_pass(self.prefix + name, remaining)
+        self.last = now
+
+    def finish(self, num_warnings=0):
+        if self.stats is None:
+            return
+        self.stats.add_page(self.page, time.perf_counter() - self.start,
+                            num_warnings)
+
+
+def run_bounded(executor, fn, args_list, max_in_flight):
+    ''' Submits fn(*args) to the executor for each args tuple in args_list,
+        keeping at most max_in_flight tasks submitted but not yet consumed.
+        Yields (args, result) tuples in the order of completion, so that
+        neither a slow task stalls the consumer nor do the results of all
+        tasks pile up in memory.
+    '''
+    args_iter = iter(args_list)
+    pending = dict()
+
+    def submit_next():
+        for args in args_iter:
+            pending[executor.submit(fn, *args)] = args
+            return
+
+    for i in range(max(1, max_in_flight)):
+        submit_next()
+
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            args = pending.pop(future)
+            yield args, future.result()
+            submit_next()
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class ProgressReporter:
+    ''' Formats progress lines with the throughput and the estimated time
+        until all tasks complete, and keeps track of the slowest tasks.
+    '''
+
+    def __init__(self, total, num_slowest=10):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self.slowest = PipelineStats(num_slowest_pages=num_slowest)
+
+    def update(self, name, elapsed=None):
+        ''' Records a completed task and returns the progress line for it.
+            elapsed is the time the task itself took, if known.
+        '''
+        self.done += 1
+        if elapsed is not None:
+            self.slowest.add_slow_page(name, elapsed)
+
+        wall = time.perf_counter() - self.start
+        rate = self.done / wall if wall > 0 else 0.0
+        if rate > 0:
+            eta = format_duration((self.total - self.done) / rate)
+        else:
+            eta = '?'
+        return '{}/{} ({:.1f} pages/s, ETA {}): {}'.format(
+            self.done, self.total, rate, eta, name)
+
+    def format_summary(self):
+        wall = time.perf_counter() - self.start
+        lines = ['Processed {} pages in {}'.format(
+            self.done, format_duration(wall))]
+        for elapsed, name in sorted(self.slowest.slowest_pages,
+                                    reverse=True):
+            lines.append('  {:.3f}s {}'.format(elapsed, name))
+        return '\n'.join(lines)
@@ -18,14 +18,24 @@
 #   along with this program.  If not, see http://www.gnu.org/licenses/.
 
 import fnmatch
+import functools
+import hashlib
 import io
+import json
 import os
 import re
 import shutil
+import time
 import urllib.parse
 
 from lxml import etree
 
+from commands import preprocess_cssless
+from commands.pipeline_stats import PassTimer
+from commands.pipeline_stats import PipelineStats
+from commands.versioning import get_code_version
+from commands.versioning import hash_file
+
 
 def rmtree_if_exists(dir):
     if os.path.isdir(dir):
@@ -86,6 +96,70 @@ def rearrange_archive(root):
         os.remove(os.path.join(root, fn))
 
 
+def get_rearranged_path(path):
+    # Returns the location that rearrange_archive gives to the file at path
+    # or None if the file is removed. The path is relative to the root of the
+    # archive in both cases.
+    parts = path.split(os.sep)
+
+    if parts[0] == 'upload.cppreference.com':
+        if len(parts) > 2 and parts[1] == 'mwiki':
+            return os.path.join('common', *parts[2:])
+        return None
+
+    for lang in ["en"]:
+        if parts[0] != lang + ".cppreference.com":
+            continue
+        if len(parts) > 2 and parts[1] == 'w':
+            return os.path.join(lang, *parts[2:])
+        if len(parts) > 2 and parts[1] == 'mwiki':
+            return os.path.join('common', *parts[2:])
+        if len(parts) == 2 and parts[1] in ['DejaVuSansMonoCondensed60.ttf',
+                                            'DejaVuSansMonoCondensed75.ttf']:
+            return os.path.join('common', parts[1])
+        return None
+
+    if len(parts) == 1 and \
+            fnmatch.fnmatch(parts[0], 'cppreference-export*.xml'):
+        return None
+    return path
+
+
+def build_direct_layout(src_inventory, root, rename_map=None):
+    # Returns a list of (src_path, dst_path) tuples that describe where each
+    # file of the raw website copy listed in src_inventory ends up after the
+    # archive is copied to root, rearranged and the files are renamed
+    # according to rename_map. If rename_map is None, the file renames are
+    # not applied.
+    src = src_inventory.root
+    result = []
+    for dir, filenames in src_inventory.dirs.items():
+        for fn in filenames:
+            src_path = os.path.join(dir, fn)
+            rel_path = get_rearranged_path(os.path.relpath(src_path, src))
+            if rel_path is None:
+                continue
+
+            dst_path = os.path.join(root, rel_path)
+            if rename_map is not None:
+                dst_dir, dst_fn = os.path.split(dst_path)
+                new_fn = get_renamed_filename(dst_dir, dst_fn, rename_map)
+                if new_fn:
+                    dst_path = os.path.join(dst_dir, new_fn)
+            result.append((src_path, dst_path))
+    return result
+
+
+def link_or_copy_file(src_path, dst_path):
+    # Hardlinks dst_path to src_path. Falls back to copying if the file
+    # system does not support that
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+
+
 def convert_loader_name(fn):
     # Converts complex URL to resources supplied by MediaWiki loader to a
     # simplified name
@@ -103,82 +177,232 @@ def convert_loader_name(fn):
     raise Exception(msg)
 
 
+class FileInventory:
+    ''' A listing of all files within a directory tree. The tree is scanned
+        once and the listing is shared by all steps that need it.
+
+        dirs maps the path of each directory to the list of names of the
+        files in it.
+    '''
+
+    def __init__(self, root, dirs):
+        self.root = root
+        self.dirs = dirs
+
+    @classmethod
+    def scan(cls, root):
+        dirs = dict()
+        pending = [root]
+        while len(pending) > 0:
+            dir = pending.pop()
+            filenames = []
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if not entry.is_dir():
+                        filenames.append(entry.name)
+                    elif not entry.is_symlink():
+                        pending.append(entry.path)
+            dirs[dir] = filenames
+        return cls(root, dirs)
+
+    @classmethod
+    def from_walk(cls, root):
+        # Creates an inventory in the order in which os.walk visits the tree
+        return cls(root, dict((dir, list(filenames))
+                              for dir, _, filenames in os.walk(root)))
+
+    @classmethod
+    def from_layout(cls, root, layout):
+        # Creates an inventory of the destination of the given layout as
+        # returned by build_direct_layout
+        dirs = dict()
+        for _, dst_path in layout:
+            dir, fn = os.path.split(dst_path)
+            dirs.setdefault(dir, []).append(fn)
+        return cls(root, dirs)
+
+    def build_rename_map(self):
+        # Returns a rename map: a map from old to new file name
+        loader = re.compile(r'load\.php\?.*')
+        query = re.compile(r'\?.*')
+        result = dict()
+
+        # find files with invalid names -> rename all occurrences
+        for fn in set(fn for filenames in self.dirs.values()
+                      for fn in filenames):
+            if loader.match(fn):
+                result[fn] = convert_loader_name(fn)
+
+            elif any((c in fn) for c in '?*"'):
+                new_fn = query.sub('', fn)
+                new_fn = new_fn.replace('"', '_q_')
+                new_fn = new_fn.replace('*', '_star_')
+                result[fn] = new_fn
+
+        # find files that conflict on case-insensitive filesystems
+        for dir, filenames in self.dirs.items():
+            seen = dict()
+            for fn in (result.get(s, s) for s in filenames):
+                low = fn.lower()
+                num = seen.setdefault(low, 0)
+                if num > 0:
+                    name, ext = os.path.splitext(fn)
+                    # add file with its path -> only rename that occurrence
+                    result[os.path.join(dir, fn)] = \
+                        "{}.{}{}".format(name, num + 1, ext)
+                seen[low] += 1
+
+        return result
+
+    def get_rename_plan(self, rename_map):
+        # Returns a list of (src_path, dst_path) tuples for each file that is
+        # renamed according to rename_map
+        plan = []
+        for dir, filenames in self.dirs.items():
+            for old_fn in filenames:
+                new_fn = get_renamed_filename(dir, old_fn, rename_map)
+                if new_fn:
+                    plan.append((os.path.join(dir, old_fn),
+                                 os.path.join(dir, new_fn)))
+        return plan
+
+    def apply_renames(self, rename_map):
+        # Renames the files according to rename_map and updates the listing
+        plan = self.get_rename_plan(rename_map)
+        for src_path, dst_path in plan:
+            os.rename(src_path, dst_path)
+
+        for dir in self.dirs:
+            self.dirs[dir] = [
+                get_renamed_filename(dir, fn, rename_map) or fn
+                for fn in self.dirs[dir]
+            ]
+        return plan
+
+    def find_html_files(self):
+        # find files that need to be preprocessed
+        html_files = []
+        for dir, filenames in self.dirs.items():
+            for filename in fnmatch.filter(filenames, '*.html'):
+                html_files.append(os.path.join(dir, filename))
+        return html_files
+
+
+def get_renamed_filename(dir, old_fn, rename_map):
+    # Returns the new name of the file old_fn in directory dir or None if the
+    # file is not renamed
+    new_fn = rename_map.get(old_fn)
+    if new_fn:
+        # look for case conflict of the renamed file
+        new_path = os.path.join(dir, new_fn)
+        return rename_map.get(new_path, new_fn)
+
+    # original filename unchanged, look for case conflict
+    return rename_map.get(os.path.join(dir, old_fn))
+
+
 def build_rename_map(root):
     # Returns a rename map: a map from old to new file name
-    loader = re.compile(r'load\.php\?.*')
-    query = re.compile(r'\?.*')
-    result = dict()
-
-    # find files with invalid names -> rename all occurrences
-    for fn in set(fn for _, _, filenames in os.walk(root) for fn in filenames):
-        if loader.match(fn):
-            result[fn] = convert_loader_name(fn)
-
-        elif any((c in fn) for c in '?*"'):
-            new_fn = query.sub('', fn)
-            new_fn = new_fn.replace('"', '_q_')
-            new_fn = new_fn.replace('*', '_star_')
-            result[fn] = new_fn
-
-    # find files that conflict on case-insensitive filesystems
-    for dir, _, filenames in os.walk(root):
-        seen = dict()
-        for fn in (result.get(s, s) for s in filenames):
-            low = fn.lower()
-            num = seen.setdefault(low, 0)
-            if num > 0:
-                name, ext = os.path.splitext(fn)
-                # add file with its path -> only rename that occurrence
-                result[os.path.join(dir, fn)] = \
-                    "{}.{}{}".format(name, num + 1, ext)
-            seen[low] += 1
-
-    return result
+    return FileInventory.from_walk(root).build_rename_map()
 
 
 def rename_files(root, rename_map):
-    for dir, old_fn in ((dir, fn)
-                        for dir, _, filenames in os.walk(root)
-                        for fn in filenames):
-        src_path = os.path.join(dir, old_fn)
-
-        new_fn = rename_map.get(old_fn)
-        if new_fn:
-            # look for case conflict of the renamed file
-            new_path = os.path.join(dir, new_fn)
-            new_fn = rename_map.get(new_path, new_fn)
-        else:
-            # original filename unchanged, look for case conflict
-            new_fn = rename_map.get(src_path)
-        if new_fn:
-            dst_path = os.path.join(dir, new_fn)
-            print("Renaming {0}\n      to {1}".format(src_path, dst_path))
-            shutil.move(src_path, dst_path)
+    inventory = FileInventory.from_walk(root)
+    for src_path, dst_path in inventory.get_rename_plan(rename_map):
+        print("Renaming {0}\n      to {1}".format(src_path, dst_path))
+        shutil.move(src_path, dst_path)
 
 
 def find_html_files(root):
-    # find files that need to be preprocessed
-    html_files = []
-    for dir, _, filenames in os.walk(root):
-        for filename in fnmatch.filter(filenames, '*.html'):
-            html_files.append(os.path.join(dir, filename))
-    return html_files
+    return FileInventory.scan(root).find_html_files()
+
+
+# The packages whose versions affect the output of the transform
+TRANSFORM_PACKAGES = ['lxml']
+
+
+def get_transform_version():
+    # Returns a stamp that changes whenever the code that transforms the HTML
+    # files or the installed version of a package it depends on changes
+    return get_code_version(__file__, TRANSFORM_PACKAGES)
+
+
+def build_manifest(root, rename_map, html_files, asset_map=None):
+    # Returns a manifest describing the inputs of the preprocessing of the
+    # given HTML files. html_files is a list of (src_path, dst_path) tuples,
+    # src_path must refer to a file that has not been preprocessed yet.
+    files = dict()
+    for src_fn, fn in html_files:
+        files[os.path.relpath(fn, root)] = hash_file(src_fn)
+    return {
+        'version': get_transform_version(),
+        'rename_map': rename_map,
+        'asset_map': asset_map or {},
+        'files': files
+    }
+
+
+def get_unchanged_files(old_manifest, new_manifest):
+    # Returns the list of files (relative to the root of the archive) whose
+    # preprocessed output from the run that produced old_manifest can be
+    # reused. Any change of the transform code, the rename map or the asset
+    # map invalidates all files.
+    if old_manifest is None:
+        return []
+    if old_manifest.get('version') != new_manifest['version']:
+        return []
+    if old_manifest.get('rename_map') != new_manifest['rename_map']:
+        return []
+    if old_manifest.get('asset_map', {}) != \
+            new_manifest.get('asset_map', {}):
+        return []
+
+    old_files = old_manifest.get('files', {})
+    return [fn for fn, hash in new_manifest['files'].items()
+            if old_files.get(fn) == hash]
+
+
+def load_manifest(fn):
+    if not os.path.isfile(fn):
+        return None
+    try:
+        with open(fn, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def save_manifest(fn, manifest):
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+LOADER_LINK_RE = re.compile(
+    r'https?://[a-z]+\.cppreference\.com/mwiki/load\.php')
+
+RANGES_PLACEHOLDER_RE = re.compile(
+    r'https?://[a-z]+\.cppreference\.com/w/cpp/ranges(-[a-z]+)?-placeholder/.+')  # noqa
 
 
 def is_loader_link(target):
-    if re.match(r'https?://[a-z]+\.cppreference\.com/mwiki/load\.php', target):
+    if LOADER_LINK_RE.match(target):
         return True
     return False
 
 
-def transform_loader_link(target, file, root):
-    # Absolute loader.php links need to be made relative
-    abstarget = os.path.join(root, "common", convert_loader_name(target))
+def transform_loader_link(target, file, root, asset_map=None):
+    # Absolute loader.php links need to be made relative. asset_map maps the
+    # simplified names of the loader files to the names given by
+    # process_assets, if any.
+    name = convert_loader_name(target)
+    if asset_map is not None:
+        name = asset_map.get(name, name)
+    abstarget = os.path.join(root, "common", name)
     return os.path.relpath(abstarget, os.path.dirname(file))
 
 
 def is_ranges_placeholder(target):
-    if re.match(r'https?://[a-z]+\.cppreference\.com/w/cpp/ranges(-[a-z]+)?-placeholder/.+', target):  # noqa
+    if RANGES_PLACEHOLDER_RE.match(target):
         return True
     return False
 
@@ -253,6 +477,74 @@ def transform_link(rename_map, target, file, root):
     return trasform_relative_link(rename_map, target, file)
 
 
+class LinkRewriter:
+    ''' Transforms links in the same way as transform_link does. Most links
+        are shared by all pages within a directory, thus the results are
+        cached by the directory of the file the link comes from.
+
+        If asset_map is given, the links to the loader files point to the
+        names given to them by process_assets.
+    '''
+
+    def __init__(self, root, rename_map, cache_size=65536, asset_map=None):
+        self.root = root
+        self.rename_map = rename_map
+        self.asset_map = asset_map
+        if asset_map is not None:
+            # relative links to the loader files are transformed through the
+            # rename map
+            self.rename_map = dict(
+                (old, asset_map.get(new, new))
+                for old, new in rename_map.items())
+        # maps directories to the relative path from them to the root
+        self.root_prefixes = dict()
+        self.rewrite_in_dir = functools.lru_cache(maxsize=cache_size)(
+            self.rewrite_in_dir_uncached)
+
+    # Returns the relative path from dir to the root of the archive ending
+    # with a separator, or None if dir is not within the root.
+    def get_root_prefix(self, dir):
+        prefix = self.root_prefixes.get(dir, False)
+        if prefix is not False:
+            return prefix
+
+        rel_dir = os.path.relpath(dir, self.root)
+        if rel_dir == '.':
+            prefix = ''
+        elif rel_dir.split(os.sep)[0] in ['..', 'common']:
+            # relpath would give a different result, e.g. within common/
+            prefix = None
+        else:
+            prefix = '../' * (rel_dir.count(os.sep) + 1)
+
+        self.root_prefixes[dir] = prefix
+        return prefix
+
+    def rewrite_in_dir_uncached(self, dir, target):
+        if is_loader_link(target):
+            prefix = self.get_root_prefix(dir)
+            if prefix is None:
+                return transform_loader_link(target, os.path.join(dir, ''),
+                                             self.root, self.asset_map)
+            name = convert_loader_name(target)
+            if self.asset_map is not None:
+                name = self.asset_map.get(name, name)
+            return prefix + 'common/' + name
+
+        if is_external_link(target):
+            return target
+
+        return trasform_relative_link(self.rename_map, target,
+                                      os.path.join(dir, ''))
+
+    # Transforms a link in the given file according to the rename map.
+    def rewrite(self, target, file):
+        if is_ranges_placeholder(target):
+            # the result depends on the full path of the file
+            return transform_ranges_placeholder(target, file, self.root)
+        return self.rewrite_in_dir(os.path.dirname(file), target)
+
+
 def has_class(el, *classes_to_check):
     value = el.get('class')
     if value is None:
@@ -264,6 +556,145 @@ def has_class(el, *classes_to_check):
     return False
 
 
+class HtmlVisitor:
+    """ Walks an HTML tree once and dispatches each element to the handlers
+        that have been registered for its tag, id or classes, and then to the
+        handlers registered for all elements. Handlers are called in the
+        order they have been registered. Each handler receives the element
+        and returns True if it has modified the tree. Once an element is
+        removed from the tree, no more handlers are called for it and its
+        children are not visited. Finishers are called with the tree after
+        the walk and likewise return True if they have modified it.
+
+        Handlers and finishers are attributed to the pass that was current
+        when they were registered (see set_pass). The names of the passes
+        that have modified the tree are collected in modified_passes.
+    """
+
+    def __init__(self):
+        self.tag_handlers = dict()
+        self.id_handlers = dict()
+        self.class_handlers = dict()
+        self.element_handlers = []
+        self.finishers = []
+        self.num_handlers = 0
+        self.current_pass = None
+        self.modified_passes = set()
+
+    def set_pass(self, name):
+        self.current_pass = name
+
+    def add_handler(self, handlers, key, handler):
+        handlers.setdefault(key, []).append(
+            (self.num_handlers, handler, self.current_pass))
+        self.num_handlers += 1
+
+    def on_tag(self, tag, handler):
+        self.add_handler(self.tag_handlers, tag, handler)
+
+    def on_id(self, id, handler):
+        self.add_handler(self.id_handlers, id, handler)
+
+    def on_class(self, cl, handler):
+        self.add_handler(self.class_handlers, cl, handler)
+
+    def on_element(self, handler):
+        self.element_handlers.append((handler, self.current_pass))
+
+    def on_finish(self, finisher):
+        self.finishers.append((finisher, self.current_pass))
+
+    def get_handlers(self, el):
+        handlers = list(self.tag_handlers.get(el.tag, []))
+
+        id = el.get('id')
+        if id is not None:
+            handlers.extend(self.id_handlers.get(id, []))
+
+        value = el.get('class')
+        if value is not None:
+            for cl in set(value.split(' ')):
+                handlers.extend(self.class_handlers.get(cl, []))
+
+        if len(handlers) > 1:
+            handlers.sort(key=lambda h: h[0])
+        return [(h, name) for _, h, name in handlers] + \
+            self.element_handlers
+
+    def call(self, handler, name, arg, timings):
+        if timings is None:
+            modified = handler(arg)
+        else:
+            start = time.perf_counter()
+            modified = handler(arg)
+            entry = timings.setdefault(name, [0.0, 0])
+            entry[0] += time.perf_counter() - start
+            entry[1] += 1
+        if modified:
+            self.modified_passes.add(name)
+
+    def visit(self, html, timings=None):
+        """ Walks the tree. If timings is a dict, the time spent in the
+            handlers and finishers of each pass and the number of calls to
+            them are accumulated into it as name -> [time, number of calls].
+        """
+        root = html.getroot()
+        pending = [root]
+        while len(pending) > 0:
+            el = pending.pop()
+            if not isinstance(el.tag, str):
+                continue  # comments and processing instructions
+
+            removed = False
+            for handler, name in self.get_handlers(el):
+                self.call(handler, name, el, timings)
+                if el is not root and el.getparent() is None:
+                    removed = True
+                    break
+
+            if not removed:
+                pending.extend(reversed(el))
+
+        for finisher, name in self.finishers:
+            self.call(finisher, name, html, timings)
+
+
+def remove_element(el):
+    el.getparent().remove(el)
+    return True
+
+
+def is_in_tree(el, html):
+    # Checks whether el is still a part of the given tree, i.e. neither el nor
+    # any of its ancestors has been removed
+    root = html.getroot()
+    while el is not None:
+        if el is root:
+            return True
+        el = el.getparent()
+    return False
+
+
+def remove_elements_in_tree(html, candidates, predicate):
+    # Removes the candidates that are still a part of the given tree and
+    # match the predicate. Returns True if any element has been removed
+    modified = False
+    for el in candidates:
+        if is_in_tree(el, html) and predicate(el):
+            modified = remove_element(el)
+    return modified
+
+
+def is_top_level_element(el, parent_tag, root_tag='html'):
+    # Checks whether el matches /{root_tag}/{parent_tag}/*
+    parent = el.getparent()
+    if parent is None or parent.tag != parent_tag:
+        return False
+    root = parent.getparent()
+    return root is not None and root.tag == root_tag and \
+        root.getparent() is None
+
+
 # remove non-printable elements
 def remove_noprint(html):
     for el in html.xpath('//*'):
@@ -273,49 +704,133 @@ def remove_noprint(html):
             el.getparent().remove(el)
 
 
+def add_noprint_handlers(visitor):
+    for cl in ['noprint', 'editsection']:
+        visitor.on_class(cl, remove_element)
+    for id in ['toc', 'catlinks']:
+        visitor.on_id(id, remove_element)
+
+
+SEE_ALSO_ROW_DIVS = etree.XPath('.//td/div[@class]')
+SEE_ALSO_SEP_TDS = etree.XPath('.//td[@class]')
+SEE_ALSO_SPANS = etree.XPath(".//span[@id = 'See_also']")
+SEE_ALSO_ROWS = etree.XPath('.//tr')
+
+
+def is_see_also_row(el):
+    return has_class(el, 't-dcl-list-item', 't-dsc')
+
+
+# removes the given table row if it's a see also link, returns True on
+# success
+def remove_see_also_row(el):
+    if not any(has_class(div, 't-dcl-list-see', 't-dsc-see')
+               for div in SEE_ALSO_ROW_DIVS(el)):
+        return False
+
+    # remove preceding separator, if any
+    prev = el.getprevious()
+    if prev is not None:
+        if any(has_class(td, 't-dcl-list-sep')
+               for td in SEE_ALSO_SEP_TDS(prev)):
+            prev.getparent().remove(prev)
+
+    el.getparent().remove(el)
+    return True
+
+
+# removes the given h3 element if it's a see also section without content,
+# returns True on success
+def remove_see_also_heading(el):
+    if len(SEE_ALSO_SPANS(el)) == 0:
+        return False
+
+    next = el.getnext()
+    if next is None:
+        el.getparent().remove(el)
+        return True
+    if next.tag == 'table' and has_class(next, 't-dcl-list-begin') and \
+            len(SEE_ALSO_ROWS(next)) == 0:
+        el.getparent().remove(el)
+        next.getparent().remove(next)
+        return True
+    return False
+
+
 # remove see also links between C and C++ documentations
 def remove_see_also(html):
     for el in html.xpath('//tr[@class]'):
-        if not has_class(el, 't-dcl-list-item', 't-dsc'):
-            continue
+        if is_see_also_row(el):
+            remove_see_also_row(el)
 
-        child_tds = el.xpath('.//td/div[@class]')
-        if not any(has_class(td, 't-dcl-list-see', 't-dsc-see')
-                   for td in child_tds):
-            continue
+    for el in html.xpath('//h3'):
+        remove_see_also_heading(el)
 
-        # remove preceding separator, if any
-        prev = el.getprevious()
-        if prev is not None:
-            child_tds = prev.xpath('.//td[@class]')
-            if any(has_class(td, 't-dcl-list-sep') for td in child_tds):
-                prev.getparent().remove(prev)
 
-        el.getparent().remove(el)
+def add_see_also_handlers(visitor):
+    # the rows and headings are removed after the walk because a heading can
+    # be removed only if the rows of the table following it have been removed
+    rows = []
+    headings = []
 
-    for el in html.xpath('//h3'):
-        if len(el.xpath(".//span[@id = 'See_also']")) == 0:
-            continue
+    def add_row(el):
+        if el.tag == 'tr' and (len(rows) == 0 or rows[-1] is not el):
+            rows.append(el)
+        return False
 
-        next = el.getnext()
-        if next is None:
-            el.getparent().remove(el)
-        elif next.tag == 'table' and has_class(next, 't-dcl-list-begin') and \
-                len(next.xpath('.//tr')) == 0:
-            el.getparent().remove(el)
-            next.getparent().remove(next)
+    def add_heading(el):
+        headings.append(el)
+        return False
+
+    def finish(html):
+        modified = False
+        for el in rows:
+            modified |= remove_see_also_row(el)
+        for el in headings:
+            modified |= remove_see_also_heading(el)
+        return modified
+
+    visitor.on_class('t-dcl-list-item', add_row)
+    visitor.on_class('t-dsc', add_row)
+    visitor.on_tag('h3', add_heading)
+    visitor.on_finish(finish)
+
+
+def is_google_analytics_script(el):
+    if el.get('src') is not None:
+        return 'google-analytics.com/ga.js' in el.get('src')
+    if el.text is not None:
+        return 'google-analytics.com/ga.js' in el.text or \
+            'pageTracker' in el.text
+    return False
 
 
 # remove Google Analytics scripts
 def remove_google_analytics(html):
     for el in html.xpath('/html/body/script'):
-        if el.get('src') is not None:
-            if 'google-analytics.com/ga.js' in el.get('src'):
-                el.getparent().remove(el)
-        elif el.text is not None:
-            if 'google-analytics.com/ga.js' in el.text or \
-                    'pageTracker' in el.text:
-                el.getparent().remove(el)
+        if is_google_analytics_script(el):
+            el.getparent().remove(el)
+
+
+def is_top_level_google_analytics_script(el):
+    return is_top_level_element(el, 'body') and is_google_analytics_script(el)
+
+
+def add_google_analytics_handlers(visitor):
+    # the scripts are removed after the see also sections, see CLEANUP_PASSES
+    scripts = []
+
+    def handle_script(el):
+        if is_top_level_google_analytics_script(el):
+            scripts.append(el)
+        return False
+
+    def finish(html):
+        return remove_elements_in_tree(html, scripts,
+                                       is_top_level_google_analytics_script)
+
+    visitor.on_tag('script', handle_script)
+    visitor.on_finish(finish)
 
 
 # remove ads
@@ -336,49 +851,282 @@ def remove_ads(html):
             el.getparent().remove(el)
 
 
+def is_ads_element(el):
+    if el.tag == 'script':
+        # Carbon Ads
+        if el.get('src') is not None and \
+                'carbonads.com/carbon.js' in el.get('src'):
+            return True
+        # BuySellAds
+        return el.get('type') is not None and el.text is not None and \
+            'buysellads.com' in el.text
+    if el.tag == 'style':
+        return is_top_level_element(el, 'body') and el.text is not None and \
+            '#carbonads' in el.text
+    if el.tag == 'div':
+        return el.get('id') is not None and el.get('id').startswith('bsap_')
+    return False
+
+
+def add_ads_handlers(visitor):
+    # the ads are removed after the see also sections, see CLEANUP_PASSES
+    candidates = []
+
+    def handle_candidate(el):
+        if is_ads_element(el):
+            candidates.append(el)
+        return False
+
+    def finish(html):
+        return remove_elements_in_tree(html, candidates, is_ads_element)
+
+    visitor.on_tag('script', handle_candidate)
+    visitor.on_tag('style', handle_candidate)
+    visitor.on_tag('div', handle_candidate)
+    visitor.on_finish(finish)
+
+
+FILEINFO_LINK_RE = re.compile(
+    r'https?://[a-z]+\.cppreference\.com/w/File:')
+FILEINFO_PARENTS = etree.XPath(
+    r"//a[re:test(@href, 'https?://[a-z]+\.cppreference\.com/w/File:')]/..",
+    namespaces={'re': 'http://exslt.org/regular-expressions'})
+
+
 # remove links to file info pages (e.g. on images)
 def remove_fileinfo(html):
-    info = etree.XPath(r"//a[re:test(@href, 'https?://[a-z]+\.cppreference\.com/w/File:')]/..",  # noqa
-                       namespaces={'re':'http://exslt.org/regular-expressions'})  # noqa
-    for el in info(html):
+    for el in FILEINFO_PARENTS(html):
         el.getparent().remove(el)
 
 
+def add_fileinfo_handlers(visitor):
+    parents = []
+
+    def handle_link(el):
+        href = el.get('href')
+        if href is not None and FILEINFO_LINK_RE.search(href):
+            parent = el.getparent()
+            if parent not in parents:
+                parents.append(parent)
+        return False
+
+    def finish(html):
+        # skips the elements that have been removed in the meantime
+        return remove_elements_in_tree(html, parents,
+                                       lambda el: el.getparent() is not None)
+
+    visitor.on_tag('a', handle_link)
+    visitor.on_finish(finish)
+
+
 # remove external links to unused resources
 def remove_unused_external(html):
     for el in html.xpath('/html/head/link'):
-        if el.get('rel') in ('alternate', 'search', 'edit', 'EditURI'):
-            el.getparent().remove(el)
-        elif el.get('rel') == 'shortcut icon':
-            (head, tail) = os.path.split(el.get('href'))
-            el.set('href', os.path.join(head, 'common', tail))
+        process_unused_external(el)
+
+
+def process_unused_external(el):
+    if el.get('rel') in ('alternate', 'search', 'edit', 'EditURI'):
+        return remove_element(el)
+    if el.get('rel') == 'shortcut icon':
+        (head, tail) = os.path.split(el.get('href'))
+        el.set('href', os.path.join(head, 'common', tail))
+        return True
+    return False
+
+
+def add_unused_external_handlers(visitor):
+    def handle_link(el):
+        if is_top_level_element(el, 'head'):
+            return process_unused_external(el)
+        return False
+
+    visitor.on_tag('link', handle_link)
+
+
+# The cleanup passes that are applied to each HTML file, in order. Each pass
+# is described by a (name, markers, add_handlers) tuple. markers is a list of
+# byte strings at least one of which occurs in the raw contents of any page
+# the pass can modify, or None if the pass needs to be applied to all pages.
+# The see_also pass can remove elements only after the walk. The passes that
+# follow it thus remove elements in finishers as well. The finishers run in
+# the order of the passes, so that each pass sees the tree as modified by the
+# preceding passes only.
+CLEANUP_PASSES = [
+    ('unused_external', None, add_unused_external_handlers),
+    ('noprint', [b'noprint', b'editsection', b'toc', b'catlinks'],
+     add_noprint_handlers),
+    ('see_also', [b't-dcl-list-see', b't-dsc-see', b'See_also'],
+     add_see_also_handlers),
+    ('google_analytics', [b'google-analytics.com/ga.js', b'pageTracker'],
+     add_google_analytics_handlers),
+    ('ads', [b'carbonads', b'bsap_', b'buysellads.com'], add_ads_handlers),
+    ('fileinfo', [b'/w/File:'], add_fileinfo_handlers),
+]
+
+
+# Returns the names of the cleanup passes that may modify a page with the
+# given raw contents
+def get_applicable_passes(data):
+    return [name for name, markers, _ in CLEANUP_PASSES
+            if markers is None or any(m in data for m in markers)]
+
+
+# Returns a visitor that applies the given cleanup passes (all by default) and
+# rewrites the links of the file fn using the given LinkRewriter
+def build_cleanup_visitor(rewriter, fn, passes=None):
+    visitor = HtmlVisitor()
+    for name, _, add_handlers in CLEANUP_PASSES:
+        if passes is None or name in passes:
+            visitor.set_pass(name)
+            add_handlers(visitor)
+    visitor.set_pass(None)
+
+    # apply changes to links caused by file renames
+    def rewrite_links(el):
+        for attr in ['src', 'href']:
+            value = el.get(attr)
+            if value is not None:
+                el.set(attr, rewriter.rewrite(value, fn))
+        return False
 
+    visitor.set_pass('rewrite_links')
+    visitor.on_element(rewrite_links)
+    visitor.set_pass(None)
+    return visitor
+
+
+# Preprocesses the HTML file fn in place. If src_fn is given, the file is
+# read from src_fn instead and the result is written to fn. rewriter is the
+# LinkRewriter to use, a new one is created if it's not given.
+# If cssless_fn is set, the cleaned page is additionally transformed by the
+# cssless transforms of preprocess_qch.py and written to cssless_fn. The
+# worker must have been set up by preprocess_cssless.init_cssless_worker.
+def preprocess_html_file(root, fn, rename_map, src_fn=None, rewriter=None,
+                         modified_passes=None, stats=None, cssless_fn=None):
+    if rewriter is None:
+        rewriter = LinkRewriter(root, rename_map)
+    timer = PassTimer(stats, fn)
+
+    # the raw contents are scanned for markers so that only the cleanup passes
+    # that may apply to the page are run
+    with open(src_fn or fn, 'rb') as f:
+        data = f.read()
+    passes = get_applicable_passes(data)
 
-def preprocess_html_file(root, fn, rename_map):
     parser = etree.HTMLParser()
-    html = etree.parse(fn, parser)
+    html = etree.parse(io.BytesIO(data), parser, base_url=src_fn or fn)
     output = io.StringIO()
+    timer.lap('parse', html.getroot())
 
-    remove_unused_external(html)
-    remove_noprint(html)
-    remove_see_also(html)
-    remove_google_analytics(html)
-    remove_ads(html)
-    remove_fileinfo(html)
+    # the time spent in the handlers is recorded separately for each pass,
+    # the remainder is the overhead of the traversal itself
+    visitor = build_cleanup_visitor(rewriter, fn, passes)
+    timings = None if stats is None else dict()
+    visitor.visit(html, timings)
+    timer.lap_with_parts('walk', timings)
 
-    # apply changes to links caused by file renames
-    for el in html.xpath('//*[@src]'):
-        el.set('src', transform_link(rename_map, el.get('src'), fn, root))
-    for el in html.xpath('//*[@href]'):
-        el.set('href', transform_link(rename_map, el.get('href'), fn, root))
+    if modified_passes is not None:
+        modified_passes.update(n for n in visitor.modified_passes
+                               if n in passes)
 
+    num_warnings = 0
     for err in list(parser.error_log):
         print("HTML WARN: {0}".format(err), file=output)
+        num_warnings += 1
 
+    if src_fn is not None:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
     html.write(fn, encoding='utf-8', method='html')
+    timer.lap('write')
+
+    if cssless_fn is not None:
+        # the cleaned tree is not needed anymore, thus it's transformed in
+        # place. The warnings are dropped as in preprocess_qch.py.
+        cssless_timer = PassTimer(stats, cssless_fn, 'cssless_')
+        preprocess_cssless.preprocess_html_tree_merge_cssless(
+            html.getroot(), fn, cssless_fn, cssless_timer)
+
+    timer.finish(num_warnings)
     return output.getvalue()
 
 
+# The state shared by all files preprocessed within a worker process. It's
+# installed once per worker by init_html_worker so that the rename map does
+# not need to be sent along with each file.
+_worker_root = None
+_worker_rename_map = None
+_worker_rewriter = None
+_worker_collect_stats = False
+_worker_cssless_root = None
+
+
+# If cssless_root is set, the pages are additionally transformed by the
+# cssless transforms and written to the same relative paths within
+# cssless_root. stylesheets is the StyleSheetCache for these transforms.
+def init_html_worker(root, rename_map, collect_stats=False, asset_map=None,
+                     cssless_root=None, stylesheets=None):
+    global _worker_root
+    global _worker_rename_map
+    global _worker_rewriter
+    global _worker_collect_stats
+    global _worker_cssless_root
+    _worker_root = root
+    _worker_rename_map = rename_map
+    _worker_rewriter = LinkRewriter(root, rename_map, asset_map=asset_map)
+    _worker_collect_stats = collect_stats
+    _worker_cssless_root = cssless_root
+    if cssless_root is not None:
+        preprocess_cssless.init_cssless_worker(stylesheets)
+
+
+def get_worker_cssless_fn(fn):
+    if _worker_cssless_root is None:
+        return None
+    return os.path.join(_worker_cssless_root,
+                        os.path.relpath(fn, _worker_root))
+
+
+# Preprocesses a chunk of HTML files in a worker process that has been set up
+# by init_html_worker. files is a list of (src_fn, fn) tuples as accepted by
+# preprocess_html_file. Returns a tuple of the list of non-empty outputs, a
+# dict that maps the names of the cleanup passes to the number of pages they
+# have modified and the PipelineStats of the chunk, if the worker has been set
+# up to collect them, or None.
+def preprocess_html_chunk(files):
+    outputs = []
+    pass_counts = dict()
+    stats = PipelineStats() if _worker_collect_stats else None
+    for src_fn, fn in files:
+        modified_passes = set()
+        output = preprocess_html_file(_worker_root, fn, _worker_rename_map,
+                                      src_fn, _worker_rewriter,
+                                      modified_passes, stats,
+                                      get_worker_cssless_fn(fn))
+        if len(output) > 0:
+            outputs.append(output)
+        for name in modified_passes:
+            pass_counts[name] = pass_counts.get(name, 0) + 1
+    return outputs, pass_counts, stats
+
+
+# Applies the cssless transforms to a chunk of already preprocessed HTML files
+# in a worker process that has been set up by init_html_worker with
+# cssless_root. files is a list of paths of the preprocessed files. Returns
+# the same tuple as preprocess_html_chunk. The statistics are not collected
+# for these files, as they are not preprocessed.
+def preprocess_cssless_chunk(files):
+    for fn in files:
+        preprocess_cssless.preprocess_html_merge_cssless(
+            fn, get_worker_cssless_fn(fn))
+    return [], dict(), None
+
+
+def split_into_chunks(items, chunk_size):
+    return [items[i:i + chunk_size]
+            for i in range(0, len(items), chunk_size)]
+
+
 def preprocess_css_file(fn):
     f = open(fn, "r", encoding='utf-8')
     text = f.read()
@@ -410,3 +1158,102 @@ def preprocess_startup_script(fn):
 
     with open(fn, "w", encoding='utf-8') as f:
         f.write(text)
+
+
+# The files in common/ that the MediaWiki loader files are renamed to by
+# convert_loader_name
+LOADER_ASSETS = ['site_modules.css', 'ext.css', 'site_scripts.js',
+                 'skin_scripts.js', 'startup_scripts.js']
+
+
+def minify_css(text):
+    # Conservatively minifies CSS: comments are removed and whitespace is
+    # collapsed and dropped next to the punctuation where it is never
+    # significant. Strings and escapes are preserved verbatim.
+    separators = ['{', '}', ';', ',', '>']
+    out = []
+    pending_space = False
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+            continue
+        if c.isspace():
+            pending_space = True
+            i += 1
+            continue
+
+        if c in '"\'':
+            end = i + 1
+            while end < n and text[end] != c:
+                end += 2 if text[end] == '\\' else 1
+            token = text[i:end + 1]
+        elif c == '\\':
+            token = text[i:i + 2]
+        else:
+            token = c
+
+        if pending_space and len(out) > 0 and out[-1] not in separators \
+                and token not in separators:
+            out.append(' ')
+        pending_space = False
+        if token == '}' and len(out) > 0 and out[-1] == ';':
+            out.pop()
+        out.append(token)
+        i += len(token)
+
+    return ''.join(out) + '\n'
+
+
+def minify_js(text):
+    # Conservatively minifies JavaScript: only indentation, trailing
+    # whitespace and empty lines are removed. This is safe as long as no
+    # string spans multiple lines, thus scripts that contain template
+    # literals or line continuations are left intact.
+    if '`' in text or re.search(r'\\\s*$', text, re.MULTILINE):
+        return text
+    lines = [line.strip() for line in text.split('\n')]
+    return ''.join(line + '\n' for line in lines if line != '')
+
+
+def process_assets(root, minify=True):
+    # Minifies the loader assets in common/ and renames them to names that
+    # include a hash of their contents. Assets with identical contents are
+    # merged into a single file. Returns a map from the simplified names
+    # given by convert_loader_name to the new names, to be used when
+    # transforming the links to the assets.
+    data_path = os.path.join(root, 'common')
+    asset_map = dict()
+    names_by_content = dict()
+
+    for name in LOADER_ASSETS:
+        fn = os.path.join(data_path, name)
+        if not os.path.isfile(fn):
+            continue
+
+        with open(fn, 'r', encoding='utf-8', errors='surrogateescape') as f:
+            text = f.read()
+        stem, ext = os.path.splitext(name)
+        if minify and ext == '.css':
+            text = minify_css(text)
+        elif minify and ext == '.js':
+            text = minify_js(text)
+        data = text.encode('utf-8', errors='surrogateescape')
+
+        digest = hashlib.sha1(data).hexdigest()
+        new_name = names_by_content.get((digest, ext))
+        if new_name is None:
+            new_name = '{0}.{1}{2}'.format(stem, digest[:12], ext)
+            names_by_content[(digest, ext)] = new_name
+
+            # the file may be hardlinked to the source tree, thus a new file
+            # is written instead of modifying the existing one
+            with open(os.path.join(data_path, new_name), 'wb') as f:
+                f.write(data)
+        os.remove(fn)
+        asset_map[name] = new_name
+
+    return asset_map
@@ -15,44 +15,185 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see http://www.gnu.org/licenses/.
 
-import copy
+import collections
 import functools
+import hashlib
+import inspect
 import io
 import logging
 import os
+import pickle
+import re
+import shutil
+import time
+import urllib.parse
 import warnings
 
 import cssutils
 from lxml import etree
 from lxml.etree import strip_elements
 from premailer import Premailer
-
-
-def preprocess_html_merge_cssless(src_path, dst_path):
+from premailer.premailer import FILTER_PSEUDOSELECTORS
+
+from commands.pipeline_stats import PassTimer
+from commands.pipeline_stats import PipelineStats
+from commands.versioning import get_code_version
+from commands.versioning import get_package_version
+from commands.versioning import hash_file
+
+
+# The state shared by all pages processed within a worker process. It's
+# installed by init_cssless_worker.
+_worker_stylesheets = None
+_worker_collect_stats = False
+_worker_compact = False
+
+
+def init_cssless_worker(stylesheets, collect_stats=False,
+                        style_cache_options=None, style_cache_tables=None,
+                        track_style_cache_entries=False, compact=False):
+    # style_cache_options is a (maxsize, eviction) tuple that configures the
+    # style caches. style_cache_tables are preloaded into the caches. If
+    # track_style_cache_entries is set, the new entries of the caches are
+    # returned by preprocess_html_merge_cssless_task so that they can be
+    # persisted. If compact is set, the inline styles are compacted by
+    # compact_inline_styles and the pages are written without indentation.
+    global _worker_stylesheets
+    global _worker_collect_stats
+    global _worker_compact
+    _worker_stylesheets = stylesheets
+    _worker_collect_stats = collect_stats
+    _worker_compact = compact
+    if style_cache_options is not None:
+        configure_style_caches(*style_cache_options)
+    if style_cache_tables is not None:
+        preload_style_caches(style_cache_tables)
+    if track_style_cache_entries:
+        for cache in STYLE_CACHES.values():
+            cache.track_new_entries()
+
+
+def preprocess_html_merge_cssless(src_path, dst_path, stats=None):
+    timer = PassTimer(stats, dst_path)
     with open(src_path, 'r') as a_file:
         content = a_file.read()
         parser = etree.HTMLParser()
         stripped = content.strip()
         root = etree.fromstring(stripped, parser)
+    timer.lap('parse', root)
+
+    output = preprocess_html_tree_merge_cssless(root, src_path, dst_path,
+                                                timer)
+    timer.finish(output.count('\n'))
+    return output
+
 
-    output = preprocess_html_merge_css(root, src_path)
-    strip_style_tags(root)
-    remove_display_none(root)
-    convert_span_tables_to_tr_td(root)
-    convert_inline_block_elements_to_table(root)
-    convert_zero_td_width_to_nonzero(root)
-    convert_font_size_property_to_pt(root, 16)
-    convert_table_border_top_to_tr_background(root)
+# Transforms an already parsed page in place and writes it to dst_path.
+# src_path is the path the page has been read from, the style sheets linked
+# from the page are resolved relative to it. The passes are recorded through
+# the given PassTimer.
+def preprocess_html_tree_merge_cssless(root, src_path, dst_path, timer):
+    output = preprocess_html_merge_css(root, src_path, _worker_stylesheets)
+    timer.lap('premailer', root)
+    convert_cssless_tree(root, 16)
+    timer.lap('convert_cssless_tree', root)
+    if _worker_compact:
+        compact_inline_styles(root)
+        timer.lap('compact_inline_styles', root)
 
     head = os.path.dirname(dst_path)
     os.makedirs(head, exist_ok=True)
 
     with open(dst_path, 'wb') as a_file:
-        root.getroottree().write(a_file, pretty_print=True, method="html",
-                                 encoding='utf-8')
+        root.getroottree().write(a_file, pretty_print=not _worker_compact,
+                                 method="html", encoding='utf-8')
+    timer.lap('write')
     return output
 
 
+# Processes a page in a worker process that has been set up by
+# init_cssless_worker. Returns a tuple of the output, the time it took to
+# process the page, the PipelineStats of the page if the worker collects them
+# or None, and the updates of the style caches as returned by
+# take_style_cache_updates.
+def preprocess_html_merge_cssless_task(src_path, dst_path):
+    start = time.perf_counter()
+    stats = PipelineStats() if _worker_collect_stats else None
+    output = preprocess_html_merge_cssless(src_path, dst_path, stats)
+    elapsed = time.perf_counter() - start
+    return output, elapsed, stats, take_style_cache_updates()
+
+
+# The packages whose versions affect the output of the transform
+TRANSFORM_PACKAGES = ['premailer', 'cssutils', 'lxml']
+
+
+def get_transform_version():
+    # Returns a stamp that changes whenever the code that transforms the HTML
+    # files or the installed version of a package it depends on changes
+    return get_code_version(__file__, TRANSFORM_PACKAGES)
+
+
+class CsslessOutputCache:
+    ''' A content-addressed cache of the pages produced by
+        preprocess_html_merge_cssless. A page is keyed by the version of the
+        transform code and of the packages it depends on, the options, the
+        path of the page within the archive, the content of the page and the
+        contents of all style sheets of the archive. Any change of a style
+        sheet thus invalidates all pages, whereas a change of a page
+        invalidates only that page.
+
+        The cached pages are stored as cache_dir/<key[:2]>/<key>.html and are
+        materialized by hard links, or copies if the cache resides on a
+        different file system.
+    '''
+
+    def __init__(self, cache_dir, root, css_paths, compact=False):
+        self.cache_dir = cache_dir
+        self.root = root
+        h = hashlib.sha1()
+        h.update(get_transform_version().encode('utf-8'))
+        h.update(b'compact' if compact else b'')
+        for path in sorted(os.path.relpath(p, root) for p in css_paths):
+            h.update(path.encode('utf-8'))
+            h.update(hash_file(os.path.join(root, path)).encode('utf-8'))
+        self.prefix = h.hexdigest()
+
+    def get_key(self, src_path):
+        h = hashlib.sha1()
+        h.update(self.prefix.encode('utf-8'))
+        h.update(os.path.relpath(src_path, self.root).encode('utf-8'))
+        h.update(hash_file(src_path).encode('utf-8'))
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.html')
+
+    def materialize(self, key, dst_path):
+        # Puts the cached page to dst_path. Returns False if the page is not
+        # cached
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            return False
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        try:
+            os.link(path, dst_path)
+        except OSError:
+            shutil.copyfile(path, dst_path)
+        return True
+
+    def store(self, key, dst_path):
+        # Adds the page at dst_path to the cache. The page is copied, so that
+        # the cache is not affected if the output is modified later, and
+        # renamed into place, so that an interrupted run does not leave a
+        # partially written page in the cache.
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        shutil.copyfile(dst_path, tmp_path)
+        os.replace(tmp_path, path)
+
+
 def silence_cssutils_warnings():
     log = logging.Logger('ignore')
     output = io.StringIO()
@@ -65,20 +206,344 @@ def silence_cssutils_warnings():
     return output
 
 
-def preprocess_html_merge_css(root, src_path):
+def create_premailer(root, src_path, stylesheets=None):
+    if stylesheets is None:
+        return Premailer(root, base_url=src_path,
+                         disable_link_rewrites=True, remove_classes=True)
+    return CachedStyleSheetPremailer(stylesheets, root, base_url=src_path,
+                                     disable_link_rewrites=True,
+                                     remove_classes=True)
+
+
+def preprocess_html_merge_css(root, src_path, stylesheets=None):
     # cssutils_logging_handler of Premailer.__init__ is insufficient to silence
     # warnings to stderr in non-verbose mode
     output = silence_cssutils_warnings()
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        premailer = Premailer(root, base_url=src_path,
-                              disable_link_rewrites=True, remove_classes=True)
+        premailer = create_premailer(root, src_path, stylesheets)
         root = premailer.transform().getroot()
 
     return output.getvalue()
 
 
+class SerializedRules(str):
+    # The serialized form of the rules that Premailer could not inline
+    pass
+
+
+CSS_SIMPLE_SELECTOR_RE = re.compile(
+    r'(?P<tag>[a-zA-Z][a-zA-Z0-9-]*|\*)'
+    r'|(?P<kind>[.#])(?P<name>-?[a-zA-Z_][a-zA-Z0-9_-]*)'
+    r'|\[[^\[\]\'"()\\]*\]'
+    r'|:[a-zA-Z-]+(?:\([^()\'"\\]*\))?')
+
+
+def get_effective_selector(selector):
+    # Returns the selector that Premailer.transform evaluates for a rule with
+    # the given selector. Everything from the first colon on is dropped,
+    # unless it's one of the pseudo classes that filter the elements.
+    if ':' in selector:
+        new_selector, class_ = re.split(':', selector, 1)
+        class_ = ':' + class_
+        if class_ not in FILTER_PSEUDOSELECTORS and \
+                not class_.startswith(':nth-child'):
+            return new_selector
+    return selector
+
+
+def get_rightmost_compound_selector(selector):
+    # Returns the part of the selector after the last combinator or None if
+    # the selector can't be split reliably
+    depth = 0
+    start = 0
+    for i, c in enumerate(selector):
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c in '\'"\\':
+            return None
+        elif depth == 0 and c in ' \t\n>+~':
+            start = i + 1
+    if depth != 0:
+        return None
+    return selector[start:]
+
+
+def get_selector_requirements(selector):
+    # Returns the list of the (kind, name) features that an element must have
+    # to be matched by the rightmost compound of the given selector. kind is
+    # one of 'tag', '.' or '#'. Returns an empty list if the requirements
+    # can't be determined, in which case the selector may match any element.
+    compound = get_rightmost_compound_selector(
+        get_effective_selector(selector))
+    if not compound:
+        return []
+
+    requirements = []
+    pos = 0
+    while pos < len(compound):
+        m = CSS_SIMPLE_SELECTOR_RE.match(compound, pos)
+        if m is None or (m.group('tag') is not None and pos != 0):
+            return []
+        if m.group('tag') not in [None, '*']:
+            requirements.append(('tag', m.group('tag').lower()))
+        elif m.group('kind') is not None:
+            requirements.append((m.group('kind'), m.group('name')))
+        pos = m.end()
+    return requirements
+
+
+def get_page_features(root):
+    # Returns the set of the (kind, name) features of the elements of the
+    # page, as accepted by StyleRuleIndex.get_candidates
+    features = set()
+    for el in root.iter():
+        if not isinstance(el.tag, str):
+            continue
+        features.add(('tag', el.tag.lower()))
+        id = el.get('id')
+        if id is not None:
+            features.add(('#', id))
+        classes = el.get('class')
+        if classes is not None:
+            features.update(('.', c) for c in classes.split())
+    # the style elements with the leftover rules are added during the
+    # transformation
+    features.add(('tag', 'style'))
+    return features
+
+
+class StyleRuleIndex:
+    ''' Indexes the rules of a style sheet by a tag, class or id that the
+        rightmost compound selector of the rule requires, so that the rules
+        that can't match any element of a page can be skipped without
+        evaluating their selectors. The ids and the classes are preferred to
+        the tags, as they are more selective.
+    '''
+
+    def __init__(self, rules):
+        # positions of the rules whose requirements couldn't be determined
+        self.unindexed = []
+        # feature -> list of (position, requirements) tuples
+        self.by_feature = dict()
+        for pos, (_, selector, _) in enumerate(rules):
+            requirements = get_selector_requirements(selector)
+            if len(requirements) == 0:
+                self.unindexed.append(pos)
+                continue
+            key = min(requirements, key=lambda r: r[0] == 'tag')
+            self.by_feature.setdefault(key, []).append((pos, requirements))
+
+    def get_candidates(self, features):
+        # Returns the sorted positions of the rules that may match an element
+        # of a page with the given features
+        positions = list(self.unindexed)
+        for key in features:
+            for pos, requirements in self.by_feature.get(key, []):
+                if all(r in features for r in requirements):
+                    positions.append(pos)
+        positions.sort()
+        return positions
+
+    def filter(self, rules, features):
+        # Returns the rules that may match an element of a page with the
+        # given features. All rules are returned if features is None.
+        if features is None:
+            return rules
+        return [rules[pos] for pos in self.get_candidates(features)]
+
+
+class StyleSheetCache:
+    ''' Caches the external style sheets linked from the pages along with the
+        rule sets that Premailer parses them into, so that each style sheet
+        is read and parsed once instead of once per page. The style sheets
+        are keyed by their path and the rule sets by the hash of the content
+        of the style sheet. The cache is picklable, thus it can be filled once
+        by the driver and shared with the worker processes.
+
+        A rule set is a tuple of the inlinable rules and the serialized rules
+        that can't be inlined. The inlinable rules are indexed by
+        StyleRuleIndex. The inlinable rules are stored as in Premailer,
+        except that the index of the style sheet within the page is omitted
+        from the specificity.
+    '''
+
+    def __init__(self):
+        # path -> text
+        self.sheets = dict()
+        # text -> content hash
+        self.keys = dict()
+        # content hash -> (rules, leftover)
+        self.rule_sets = dict()
+        # content hash -> StyleRuleIndex of the rules
+        self.rule_indexes = dict()
+
+    def load(self, path):
+        # Returns the text of the style sheet at path
+        text = self.sheets.get(path)
+        if text is None:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+            key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            # the same text object is returned for all identical sheets, so
+            # that lookups by text don't need to compare the contents
+            text = next((t for t, k in self.keys.items() if k == key), text)
+            self.keys[text] = key
+            self.sheets[path] = text
+        return text
+
+    def get_key(self, text):
+        # Returns the content hash of the given style sheet text or None if
+        # the text does not come from a style sheet loaded through this cache
+        return self.keys.get(text)
+
+    def add_files(self, paths):
+        # Loads and parses the style sheets at the given paths. Returns the
+        # warnings produced by the parser.
+        output = silence_cssutils_warnings()
+        premailer = create_premailer(None, None, self)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for path in paths:
+                text = self.load(os.path.abspath(path))
+                premailer._parse_style_rules(text, 0)
+        return output.getvalue()
+
+
+# The versions of premailer whose internals CachedStyleSheetPremailer has been
+# written against
+SUPPORTED_PREMAILER_VERSIONS = ['3.7.0']
+
+# The parameters of the private Premailer methods CachedStyleSheetPremailer
+# overrides
+PREMAILER_OVERRIDDEN_METHODS = {
+    '_load_external': ['self', 'url'],
+    '_parse_style_rules': ['self', 'css_body', 'ruleset_index'],
+    '_css_rules_to_string': ['self', 'rules'],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def check_premailer_compatibility():
+    # Raises an exception unless the installed premailer is a version whose
+    # private methods and specificity tuples CachedStyleSheetPremailer
+    # relies on. The specificity tuples are expected to be (important, ids,
+    # classes, elements, ruleset index, rule index)
+    version = get_package_version('premailer')
+    if version not in SUPPORTED_PREMAILER_VERSIONS:
+        raise Exception(
+            'Unsupported premailer version {0}, CachedStyleSheetPremailer '
+            'supports {1}'.format(version,
+                                  ', '.join(SUPPORTED_PREMAILER_VERSIONS)))
+
+    for name, params in PREMAILER_OVERRIDDEN_METHODS.items():
+        method = getattr(Premailer, name, None)
+        if method is None or \
+                list(inspect.signature(method).parameters) != params:
+            raise Exception(
+                'Premailer.{0} does not have the expected parameters '
+                '{1}'.format(name, ', '.join(params)))
+
+    rules, leftover = Premailer()._parse_style_rules(
+        'p { color: red } #a .b { color: blue !important }', 7)
+    specs = [spec for spec, selector, bulk in rules]
+    if specs != [(0, 0, 0, 1, 7, 0), (1, 1, 1, 0, 7, 1)]:
+        raise Exception(
+            'Unexpected layout of the premailer specificity tuples: '
+            '{0}'.format(specs))
+
+
+class CachedStyleSheetPremailer(Premailer):
+    ''' A Premailer that reads and parses the external style sheets through
+        a StyleSheetCache. The result of the transformation is the same as
+        with Premailer.
+
+        This class overrides the private Premailer methods _load_external,
+        _parse_style_rules and _css_rules_to_string and rewrites the ruleset
+        index within the specificity tuples of the parsed rules. It thus
+        depends on the internals of the premailer version pinned in
+        requirements.txt, see check_premailer_compatibility, which is run
+        when the first instance is created.
+    '''
+
+    def __init__(self, stylesheets, *args, **kwargs):
+        check_premailer_compatibility()
+        super().__init__(*args, **kwargs)
+        self.stylesheets = stylesheets
+        self.page_features = None
+
+    def get_page_features(self):
+        # The rules that can't match any element of the page are dropped, as
+        # Premailer.transform would find no elements to apply them to. The
+        # features are collected when the first style sheet is parsed, as the
+        # page is not available earlier.
+        if self.page_features is None:
+            if self.html is None:
+                return None
+            self.page_features = get_page_features(
+                self.html.getroottree().getroot())
+        return self.page_features
+
+    def get_local_path(self, url):
+        # Returns the path of the local file Premailer._load_external would
+        # read for the given URL or None if it's not a local file
+        if url.startswith('//') or url.startswith('http://') or \
+                url.startswith('https://'):
+            return None
+        path = url
+        if not os.path.isabs(path):
+            path = os.path.abspath(os.path.join(self.base_path or '', path))
+        if os.path.exists(path):
+            return path
+        if self.base_url:
+            return self.get_local_path(
+                urllib.parse.urljoin(self.base_url, url))
+        return None
+
+    def _load_external(self, url):
+        path = self.get_local_path(url)
+        if path is None:
+            return super()._load_external(url)
+        return self.stylesheets.load(path)
+
+    def _parse_style_rules(self, css_body, ruleset_index):
+        key = self.stylesheets.get_key(css_body)
+        if key is None:
+            # inline style sheets are not cached
+            rules, leftover = super()._parse_style_rules(css_body,
+                                                         ruleset_index)
+            return (StyleRuleIndex(rules).filter(rules,
+                                                 self.get_page_features()),
+                    leftover)
+
+        rule_set = self.stylesheets.rule_sets.get(key)
+        if rule_set is None:
+            rules, leftover = super()._parse_style_rules(css_body, 0)
+            rules = [(spec[:4] + spec[5:], selector, bulk)
+                     for spec, selector, bulk in rules]
+            if len(leftover) > 0:
+                leftover = [SerializedRules(
+                    super()._css_rules_to_string(leftover))]
+            rule_set = (rules, leftover)
+            self.stylesheets.rule_sets[key] = rule_set
+            self.stylesheets.rule_indexes[key] = StyleRuleIndex(rules)
+
+        rules, leftover = rule_set
+        rules = self.stylesheets.rule_indexes[key].filter(
+            rules, self.get_page_features())
+        rules = [(spec[:4] + (ruleset_index,) + spec[4:], selector, bulk)
+                 for spec, selector, bulk in rules]
+        return rules, list(leftover)
+
+    def _css_rules_to_string(self, rules):
+        if len(rules) == 1 and isinstance(rules[0], SerializedRules):
+            return str(rules[0])
+        return super()._css_rules_to_string(rules)
+
+
 def strip_style_tags(root):
     strip_elements(root, 'style')
 
@@ -94,25 +559,366 @@ def needs_td_wrapper(element):
     return True
 
 
-@functools.lru_cache(maxsize=None)
-def cssutils_parse_style_cached_nocopy(style):
-    return cssutils.parseStyle(style)
+CSS_NAME_RE = re.compile(r'^-?[a-zA-Z_][a-zA-Z0-9_-]*$')
+CSS_HEX_COLOR_RE = re.compile(r'^#([0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+CSS_NUMBER_RE = re.compile(r'^([+-]?)(\d*\.\d+|\d+)([a-zA-Z]+|%)?$')
 
+# The units that cssutils omits from zero values
+CSS_ZERO_UNITS = ['cm', 'mm', 'in', 'px', 'pc', 'pt', 'em', 'ex']
 
-def cssutils_parse_style_cached(style):
-    return copy.deepcopy(cssutils_parse_style_cached_nocopy(style))
+# The characters that may change the meaning of the separators in a
+# declaration list, e.g. within strings, URLs or comments
+CSS_COMPLEX_CHARS = set('"\'()!\\/*{}@<')
 
 
-@functools.lru_cache(maxsize=None)
-def get_css_style_property_value(style, prop_name):
-    atrib = cssutils_parse_style_cached_nocopy(style)
-    value = atrib.getPropertyCSSValue(prop_name)
-    if value:
-        return value.cssText
+def normalize_css_number(sign, digits, unit):
+    # Serializes a number in the same way as cssutils does
+    unit = '' if unit is None else unit.lower()
+    value = float(sign + digits) if '.' in digits else int(sign + digits)
+    if value == 0:
+        return '0' if unit in CSS_ZERO_UNITS else '0' + unit
+
+    if value == int(value):
+        text = str(int(value))
+    else:
+        text = '%f' % value
+        # keep at least one digit after the decimal point
+        i = text.index('.') + 2
+        text = text[:i] + text[i:].rstrip('0')
+    if sign == '+':
+        text = '+' + text
+    return text + unit
+
+
+def normalize_css_hex_color(color):
+    # Shortens #rrggbb to #rgb if each pair repeats the same character, in
+    # the same way as cssutils does. The comparison is case sensitive
+    if len(color) == 7 and color[1] == color[2] and \
+            color[3] == color[4] and color[5] == color[6]:
+        return '#' + color[1] + color[3] + color[5]
+    return color
+
+
+def normalize_css_word(word):
+    if CSS_NAME_RE.match(word):
+        return word
+    if CSS_HEX_COLOR_RE.match(word):
+        return normalize_css_hex_color(word)
+    m = CSS_NUMBER_RE.match(word)
+    if m:
+        return normalize_css_number(*m.groups())
     return None
 
 
-@functools.lru_cache(maxsize=None)
+def normalize_css_value(value):
+    # Returns the value normalized in the same way as cssutils does or None
+    # if the value is too complex to be handled here. Only lists of
+    # identifiers, colors and numbers separated by whitespace or commas are
+    # supported.
+    if any(c in CSS_COMPLEX_CHARS for c in value):
+        return None
+    groups = []
+    for group in value.split(','):
+        words = []
+        for word in group.split():
+            word = normalize_css_word(word)
+            if word is None:
+                return None
+            words.append(word)
+        if len(words) == 0:
+            return None
+        groups.append(' '.join(words))
+    return ', '.join(groups)
+
+
+class InlineStyle(tuple):
+    ''' An immutable, hashable and ordered list of the declarations of an
+        inline style. Each declaration is a (name, value, priority) tuple
+        normalized in the same way as cssutils normalizes them, so that the
+        serialized form is identical to the output of cssutils. The
+        modifications return new objects.
+    '''
+
+    __slots__ = ()
+
+    def get_index(self, name):
+        # Returns the index of the effective declaration of the property or
+        # None if it's not set
+        found = None
+        for i in range(len(self) - 1, -1, -1):
+            if self[i][0] == name:
+                if self[i][2]:
+                    return i
+                if found is None:
+                    found = i
+        return found
+
+    def get(self, name):
+        i = self.get_index(name.lower())
+        if i is None:
+            return None
+        return self[i][1]
+
+    def remove(self, name):
+        name = name.lower()
+        return InlineStyle(d for d in self if d[0] != name)
+
+    @staticmethod
+    def normalize_value(name, value):
+        normalized = normalize_css_value(value)
+        if normalized is None:
+            prop = cssutils.css.Property(name, value)
+            if not prop.wellformed:
+                return None
+            normalized = prop.propertyValue.cssText
+        return normalized
+
+    def set(self, name, value):
+        if not value:
+            return self.remove(name)
+
+        name = name.lower()
+        normalized = self.normalize_value(name, value)
+        if normalized is None:
+            return self
+
+        i = self.get_index(name)
+        if i is None:
+            return InlineStyle(self + ((name, normalized, ''),))
+        # cssutils parses the serialized value again when replacing the value
+        # of an existing property, which may normalize it further
+        normalized = self.normalize_value(name, normalized)
+        return InlineStyle(self[:i] + ((name, normalized, ''),) + self[i + 1:])
+
+    def css_text(self, separator=': '):
+        # separator is put between the names and the values
+        return ';'.join('{0}{3}{1} !{2}'.format(*d, separator) if d[2] else
+                        '{0}{2}{1}'.format(*d[:2], separator) for d in self)
+
+
+class StyleCache:
+    ''' Caches the results of a style helper function by its arguments. The
+        size of the cache may be bounded, in which case either the least
+        recently used ('lru') or the oldest ('fifo') entries are evicted. The
+        number of hits, misses and evictions is counted. If tracking is
+        enabled, the entries added since the last call to take_new_entries
+        are recorded so that they can be collected from the worker processes
+        and persisted.
+    '''
+
+    def __init__(self, func, maxsize=None, eviction='lru'):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.entries = collections.OrderedDict()
+        self.configure(maxsize, eviction)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.new_entries = None
+
+    def configure(self, maxsize=None, eviction='lru'):
+        if eviction not in STYLE_CACHE_EVICTION_POLICIES:
+            raise ValueError('Unknown eviction policy: {0}'.format(eviction))
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.trim()
+
+    def __call__(self, *args):
+        try:
+            value = self.entries[args]
+        except KeyError:
+            self.misses += 1
+            value = self.func(*args)
+            self.add(args, value)
+            if self.new_entries is not None:
+                self.new_entries.append((args, value))
+            return value
+
+        self.hits += 1
+        if self.eviction == 'lru':
+            self.entries.move_to_end(args)
+        return value
+
+    def add(self, args, value):
+        self.entries[args] = value
+        self.trim()
+
+    def trim(self):
+        if self.maxsize is None:
+            return
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def track_new_entries(self):
+        self.new_entries = []
+
+    def take_new_entries(self):
+        # Returns the entries added since the last call and forgets them
+        entries = self.new_entries or []
+        if self.new_entries is not None:
+            self.new_entries = []
+        return entries
+
+    def take_counters(self):
+        # Returns the (hits, misses, evictions) counted since the last call
+        # and resets them
+        counters = (self.hits, self.misses, self.evictions)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        return counters
+
+
+STYLE_CACHE_EVICTION_POLICIES = ['lru', 'fifo']
+
+# The caches of the style helpers by name of the helper
+STYLE_CACHES = dict()
+
+
+def style_cache(func):
+    # Decorates a style helper with a StyleCache
+    cache = StyleCache(func)
+    STYLE_CACHES[func.__name__] = cache
+    return cache
+
+
+def configure_style_caches(maxsize=None, eviction='lru'):
+    for cache in STYLE_CACHES.values():
+        cache.configure(maxsize, eviction)
+
+
+def get_style_cache_version():
+    # Returns a stamp that changes whenever the code of the style helpers
+    # changes, which invalidates the persisted caches
+    return get_transform_version()
+
+
+def load_style_caches(fn):
+    # Returns the style cache tables persisted by save_style_caches as a dict
+    # from the names of the caches to lists of (args, value) tuples, or None
+    # if the file does not exist, can't be loaded or has been written by
+    # different code. The version stamp is stored as a separate record before
+    # the tables and is checked before the tables are unpickled, because the
+    # tables of different code may reference classes that no longer exist
+    if not os.path.isfile(fn):
+        return None
+    try:
+        with open(fn, 'rb') as f:
+            if pickle.load(f) != get_style_cache_version():
+                return None
+            tables = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(tables, dict):
+        return None
+    return tables
+
+
+def save_style_caches(fn, tables):
+    with open(fn, 'wb') as f:
+        pickle.dump(get_style_cache_version(), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def preload_style_caches(tables):
+    for name, entries in tables.items():
+        cache = STYLE_CACHES.get(name)
+        if cache is None:
+            continue
+        for args, value in entries:
+            cache.add(args, value)
+        cache.take_counters()
+
+
+def take_style_cache_updates():
+    # Returns a dict that maps the names of the caches to tuples of the
+    # counters returned by StyleCache.take_counters, the current size and the
+    # new entries of each cache
+    return dict((name, cache.take_counters() +
+                 (len(cache.entries), cache.take_new_entries()))
+                for name, cache in STYLE_CACHES.items())
+
+
+class StyleCacheReport:
+    ''' Aggregates the updates of the style caches of all workers '''
+
+    def __init__(self, tables=None):
+        # name -> [hits, misses, evictions, maximum size]
+        self.counters = dict()
+        # name -> dict of args -> value
+        self.tables = dict()
+        for name, entries in (tables or {}).items():
+            self.tables[name] = dict(entries)
+
+    def add(self, updates):
+        for name, (hits, misses, evictions, size, entries) in updates.items():
+            counters = self.counters.setdefault(name, [0, 0, 0, 0])
+            counters[0] += hits
+            counters[1] += misses
+            counters[2] += evictions
+            counters[3] = max(counters[3], size)
+            table = self.tables.setdefault(name, dict())
+            for args, value in entries:
+                # the latest entries are kept on eviction, thus the most
+                # recently seen entries are moved to the end
+                table.pop(args, None)
+                table[args] = value
+
+    def get_tables(self, maxsize=None):
+        tables = dict()
+        for name, table in self.tables.items():
+            entries = list(table.items())
+            if maxsize is not None:
+                entries = entries[max(0, len(entries) - maxsize):]
+            tables[name] = entries
+        return tables
+
+    def format(self):
+        lines = []
+        for name, (hits, misses, evictions, size) in \
+                sorted(self.counters.items()):
+            lines.append(
+                'Style cache {0}: {1} hits, {2} misses, {3} evictions, '
+                '{4} entries'.format(name, hits, misses, evictions, size))
+        return '\n'.join(lines)
+
+
+def parse_inline_style_with_cssutils(style):
+    decl = cssutils.parseStyle(style)
+    return InlineStyle((p.name, p.propertyValue.cssText, p.priority)
+                       for p in decl.getProperties(all=True))
+
+
+@style_cache
+def parse_inline_style(style):
+    # Parses the value of a style attribute into an InlineStyle. Simple
+    # declaration lists are parsed directly, cssutils is used for the rest.
+    if style is None:
+        return InlineStyle()
+    if any(c in CSS_COMPLEX_CHARS for c in style):
+        return parse_inline_style_with_cssutils(style)
+
+    declarations = []
+    for declaration in style.split(';'):
+        if declaration.strip() == '':
+            continue
+        name, sep, value = declaration.partition(':')
+        name = name.strip()
+        value = normalize_css_value(value)
+        if not sep or not CSS_NAME_RE.match(name) or value is None:
+            return parse_inline_style_with_cssutils(style)
+        declarations.append((name.lower(), value, ''))
+    return InlineStyle(declarations)
+
+
+@style_cache
+def get_css_style_property_value(style, prop_name):
+    return parse_inline_style(style).get(prop_name)
+
+
+@style_cache
 def has_css_style_property_value(style, prop_name, prop_value):
     value = get_css_style_property_value(style, prop_name)
     if value and value == prop_value:
@@ -120,11 +926,14 @@ def has_css_style_property_value(style, prop_name, prop_value):
     return False
 
 
-@functools.lru_cache(maxsize=None)
+@style_cache
 def remove_css_style_property(style, property_name):
-    atrib = cssutils_parse_style_cached(style)
-    atrib.removeProperty(property_name)
-    return atrib.getCssText(separator='')
+    return parse_inline_style(style).remove(property_name).css_text()
+
+
+@style_cache
+def set_css_style_property(style, prop_name, prop_value):
+    return parse_inline_style(style).set(prop_name, prop_value).css_text()
 
 
 def remove_css_property(element, property_name):
@@ -144,9 +953,8 @@ def has_css_property_value(el, prop_name, prop_value):
 
 
 def set_css_property_value(el, prop_name, prop_value):
-    atrib = cssutils_parse_style_cached(el.get('style'))
-    atrib.setProperty(prop_name, prop_value)
-    el.set('style', atrib.getCssText(separator=''))
+    el.set('style', set_css_style_property(el.get('style'), prop_name,
+                                           prop_value))
 
 
 def convert_display_property_to_html_tag(element, element_tag, display_value):
@@ -194,6 +1002,14 @@ def remove_display_none(root_el):
             el.getparent().remove(el)
 
 
+def is_span_table(el):
+    # note that only the prefix of the CSS property value is matched as text
+    style = el.get('style')
+    return el.tag == 'span' and style is not None and \
+        'display:table' in style and \
+        has_css_property_value(el, 'display', 'table')
+
+
 def convert_span_tables_to_tr_td(root_el):
     # note that the following xpath expressions match only the prefix of the
     # CSS property value
@@ -208,40 +1024,49 @@ def convert_span_tables_to_tr_td(root_el):
     return root_el
 
 
-def convert_inline_block_elements_to_table(root_el):
-    for el in root_el.xpath('//*[contains(@style, "display")]'):
-        if not has_css_property_value(el, 'display', 'inline-block') and \
-                not has_css_property_value(el, 'display', 'inline-table'):
-            continue
+def is_inline_block(el):
+    return has_css_property_value(el, 'display', 'inline-block') or \
+        has_css_property_value(el, 'display', 'inline-table')
+
+
+def convert_inline_block_elements_to_table_at(el):
+    # Puts el and the subsequent inline block elements into a table, if el is
+    # an inline block element
+    if not is_inline_block(el):
+        return
+
+    elements_to_put_into_table = [el]
+    el = el.getnext()
 
-        elements_to_put_into_table = [el]
+    # find subsequent inline block elements
+    while el is not None:
+        if is_inline_block(el):
+            elements_to_put_into_table.append(el)
+        else:
+            break
         el = el.getnext()
 
-        # find subsequent inline block elements
-        while el is not None:
-            if has_css_property_value(el, 'display', 'inline-block') or \
-                    has_css_property_value(el, 'display', 'inline-table'):
-                elements_to_put_into_table.append(el)
-            else:
-                break
-            el = el.getnext()
+    # only makes sense to put two or more to table
+    if len(elements_to_put_into_table) < 2:
+        return
 
-        # only makes sense to put two or more to table
-        if len(elements_to_put_into_table) < 2:
-            continue
+    # create table and put elements into it
+    table_el = etree.Element('table')
+    table_el.set('style', 'padding:0; margin:0; border:none;')
 
-        # create table and put elements into it
-        table_el = etree.Element('table')
-        table_el.set('style', 'padding:0; margin:0; border:none;')
+    elements_to_put_into_table[0].addprevious(table_el)
 
-        elements_to_put_into_table[0].addprevious(table_el)
+    tr = etree.SubElement(table_el, 'tr')
 
-        tr = etree.SubElement(table_el, 'tr')
+    for el in elements_to_put_into_table:
+        td = etree.SubElement(tr, 'td')
+        el.getparent().remove(el)
+        td.append(el)
 
-        for el in elements_to_put_into_table:
-            td = etree.SubElement(tr, 'td')
-            el.getparent().remove(el)
-            td.append(el)
+
+def convert_inline_block_elements_to_table(root_el):
+    for el in root_el.xpath('//*[contains(@style, "display")]'):
+        convert_inline_block_elements_to_table_at(el)
 
 
 def get_table_rows(table_el):
@@ -278,63 +1103,335 @@ def has_table_border_top(table_el):
     return False
 
 
+def convert_table_border_top_to_tr_background_at(table_el):
+    if not has_table_border_top(table_el):
+        return
+
+    td_count = get_max_number_of_columns(table_el)
+    for tr_el in get_table_rows(table_el):
+        if has_tr_border_top(tr_el):
+            # TODO: handle border properties
+            clear_tr_border_top(tr_el)
+            border_tr = etree.Element('tr')
+            border_td = etree.SubElement(border_tr, 'td')
+            border_td.set('colspan', str(td_count))
+            border_td.set('style', 'height:1px; font-size:1px; '
+                                   'background-color: #ccc;')
+            tr_el.addprevious(border_tr)
+
+
 def convert_table_border_top_to_tr_background(root_el):
     for table_el in root_el.iter('table'):
-        if not has_table_border_top(table_el):
-            continue
+        convert_table_border_top_to_tr_background_at(table_el)
 
-        td_count = get_max_number_of_columns(table_el)
-        for tr_el in get_table_rows(table_el):
-            if has_tr_border_top(tr_el):
-                # TODO: handle border properties
-                clear_tr_border_top(tr_el)
-                border_tr = etree.Element('tr')
-                border_td = etree.SubElement(border_tr, 'td')
-                border_td.set('colspan', str(td_count))
-                border_td.set('style', 'height:1px; font-size:1px; '
-                                       'background-color: #ccc;')
-                tr_el.addprevious(border_tr)
+
+def convert_zero_css_width_to_nonzero(el):
+    if has_css_property_value(el, 'width', '0%'):
+        el.attrib['width'] = "1px"
+        remove_css_property(el, 'width')
 
 
 def convert_zero_td_width_to_nonzero(root_el):
     for el in root_el.xpath('//*[contains(@style, "width")]'):
-        if has_css_property_value(el, 'width', '0%'):
-            el.attrib['width'] = "1px"
-            remove_css_property(el, 'width')
+        convert_zero_css_width_to_nonzero(el)
 
     for el in root_el.xpath('//*[contains(@width, "0%")]'):
         el.attrib['width'] = "1px"
 
 
-def apply_font_size(size, parent_size_pt):
+@style_cache
+def parse_font_size(size):
+    # Returns a (number, is_relative) tuple for a font-size value, or None if
+    # the unit is not supported. Relative sizes are multiplied by the font
+    # size of the parent.
     size = size.strip()
 
     if size[-2:] == 'em':
-        value_number = float(size[:-2].strip())
-        return value_number*parent_size_pt
+        return float(size[:-2].strip()), True
 
     if size[-2:] in ['pt', 'px']:
-        return float(size[:-2].strip())
+        return float(size[:-2].strip()), False
 
     if size[-1] == '%':
-        value_number = float(size[:-1].strip())/100
-        return value_number*parent_size_pt
+        return float(size[:-1].strip())/100, True
 
-    return parent_size_pt
+    return None
 
 
-def convert_font_size_property_to_pt_recurse(el, parent_size_pt):
-    size_value = get_css_property_value(el, "font-size")
+def apply_font_size(size, parent_size_pt):
+    parsed = parse_font_size(size)
+    if parsed is None:
+        return parent_size_pt
+
+    value_number, is_relative = parsed
+    if is_relative:
+        return value_number*parent_size_pt
+    return value_number
 
-    if size_value:
-        el_size_pt = apply_font_size(size_value, parent_size_pt)
-        set_css_property_value(el, "font-size", "{}pt".format(el_size_pt))
-    else:
-        el_size_pt = parent_size_pt
 
-    for child in el.getchildren():
-        convert_font_size_property_to_pt_recurse(child, el_size_pt)
+def convert_font_size_property_to_pt_at(el, parent_size_pt):
+    # Converts the font size of el to points and returns it. The style is
+    # only rewritten if it changes.
+    style = el.get('style')
+    size_value = get_css_style_property_value(style, "font-size")
+    if not size_value:
+        return parent_size_pt
+
+    el_size_pt = apply_font_size(size_value, parent_size_pt)
+    new_style = set_css_style_property(style, "font-size",
+                                       "{}pt".format(el_size_pt))
+    if new_style != style:
+        el.set('style', new_style)
+    return el_size_pt
 
 
 def convert_font_size_property_to_pt(root_el, default_size):
-    convert_font_size_property_to_pt_recurse(root_el, default_size)
+    pending = [(root_el, default_size)]
+    while len(pending) > 0:
+        el, parent_size_pt = pending.pop()
+        el_size_pt = convert_font_size_property_to_pt_at(el, parent_size_pt)
+        pending.extend((child, el_size_pt) for child in reversed(el))
+
+
+def is_pruned_element(el):
+    # Returns whether the element is removed by strip_style_tags or
+    # remove_display_none
+    return el.tag == 'style' or \
+        has_css_property_value(el, 'display', 'none')
+
+
+def convert_cssless_tree(root_el, default_size):
+    # Applies strip_style_tags, remove_display_none,
+    # convert_span_tables_to_tr_td, convert_inline_block_elements_to_table,
+    # convert_zero_td_width_to_nonzero, convert_font_size_property_to_pt and
+    # convert_table_border_top_to_tr_background in a single walk over the
+    # tree. The result is the same as if the passes were applied one after
+    # another.
+    #
+    # The children of each element are pruned before the element itself is
+    # converted, so that no conversion sees an element that the earlier
+    # passes would have removed. The conversions of an element may only
+    # affect its following siblings and its descendants, which are visited
+    # later. The tables are converted after all their descendants, because
+    # their rows depend on the conversions of the descendants.
+    pending = [(root_el, default_size)]
+    while len(pending) > 0:
+        el, size_pt = pending.pop()
+        if size_pt is None:
+            convert_table_border_top_to_tr_background_at(el)
+            continue
+        if not isinstance(el.tag, str):
+            continue  # comments and processing instructions
+
+        for child in el:
+            if isinstance(child.tag, str) and is_pruned_element(child):
+                el.remove(child)
+
+        if is_span_table(el):
+            convert_span_table_to_tr_td(el)
+        convert_inline_block_elements_to_table_at(el)
+        convert_zero_css_width_to_nonzero(el)
+        width = el.get('width')
+        if width is not None and '0%' in width:
+            el.attrib['width'] = "1px"
+        size_pt = convert_font_size_property_to_pt_at(el, size_pt)
+
+        if el.tag == 'table':
+            pending.append((el, None))
+        pending.extend((child, size_pt) for child in reversed(el))
+
+
+# The inherited properties whose declarations are dropped by
+# compact_inline_styles if they are equal to the value of the parent
+COMPACT_INHERITED_PROPERTIES = [
+    'color', 'font-family', 'font-size', 'font-style', 'font-weight',
+    'line-height', 'text-align', 'white-space'
+]
+
+# The elements that compact_inline_styles may change, along with the
+# COMPACT_INHERITED_PROPERTIES that the default style sheet of the browsers
+# sets on them. The values of these properties are not inherited from the
+# parent. The elements that are not listed are left as is. The pages are
+# rendered in the standards mode, thus the tables inherit the font properties.
+COMPACT_INHERITED_OVERRIDES = {
+    'html': [], 'body': [], 'div': [], 'span': [], 'p': [], 'blockquote': [],
+    'ul': [], 'ol': [], 'li': [], 'dl': [], 'dt': [], 'dd': [],
+    'table': [], 'tbody': [], 'thead': [], 'tfoot': [], 'tr': [], 'td': [],
+    'th': ['font-weight', 'text-align'],
+    'a': ['color'],
+    'b': ['font-weight'], 'strong': ['font-weight'],
+    'i': ['font-style'], 'em': ['font-style'], 'cite': ['font-style'],
+    'var': ['font-style'], 'dfn': ['font-style'],
+    'code': ['font-family'], 'tt': ['font-family'], 'kbd': ['font-family'],
+    'samp': ['font-family'],
+    'pre': ['font-family', 'white-space'],
+    'h1': ['font-size', 'font-weight'], 'h2': ['font-size', 'font-weight'],
+    'h3': ['font-size', 'font-weight'], 'h4': ['font-size', 'font-weight'],
+    'h5': ['font-size', 'font-weight'], 'h6': ['font-size', 'font-weight'],
+    'small': ['font-size'], 'big': ['font-size'],
+    'sub': ['font-size'], 'sup': ['font-size'],
+}
+
+# Other attributes, e.g. align or bgcolor, may give the element a style that
+# compact_inline_styles does not know about
+COMPACT_SAFE_ATTRIBUTES = ['style', 'id', 'class', 'title', 'lang', 'name']
+
+# The properties whose initial value is not overridden by the default style
+# sheet of the browsers on the given elements, along with the values that are
+# equivalent to the initial value
+COMPACT_COMMON_INITIAL_VALUES = {
+    'background-color': ['transparent'],
+    'float': ['none'],
+    'clear': ['none'],
+}
+COMPACT_BOX_INITIAL_VALUES = {
+    'margin': ['0', '0 0', '0 0 0', '0 0 0 0'],
+    'margin-top': ['0'],
+    'margin-right': ['0'],
+    'margin-bottom': ['0'],
+    'margin-left': ['0'],
+    'padding': ['0', '0 0', '0 0 0', '0 0 0 0'],
+    'padding-top': ['0'],
+    'padding-right': ['0'],
+    'padding-bottom': ['0'],
+    'padding-left': ['0'],
+    'border': ['none', '0'],
+    'border-top': ['none', '0'],
+    'border-right': ['none', '0'],
+    'border-bottom': ['none', '0'],
+    'border-left': ['none', '0'],
+    'vertical-align': ['baseline'],
+}
+COMPACT_INITIAL_VALUES = {
+    'div': dict(COMPACT_BOX_INITIAL_VALUES, display=['block']),
+    'span': dict(COMPACT_BOX_INITIAL_VALUES, display=['inline']),
+}
+
+# The line-height values that are inherited as specified. The relative
+# lengths are inherited as computed from the font size of the parent.
+CSS_INHERITABLE_LINE_HEIGHT_RE = re.compile(r'^(normal|[0-9.]+(px|pt)?)$')
+
+CSS_SHORTHAND_FAMILIES = ['margin', 'padding', 'border', 'background', 'font']
+
+
+def get_css_property_family(name):
+    # Returns the shorthand property that may set the given property, or the
+    # property itself
+    family = name.split('-')[0]
+    if family in CSS_SHORTHAND_FAMILIES:
+        return family
+    return name
+
+
+def collapse_padding_values(values):
+    # Returns the padding shorthand value for the given top, right, bottom and
+    # left values
+    if values[3] == values[1]:
+        values = values[:3]
+        if values[2] == values[0]:
+            values = values[:2]
+            if values[1] == values[0]:
+                values = values[:1]
+    return ' '.join(values)
+
+
+def collapse_border_values(values):
+    if all(v == values[0] for v in values):
+        return values[0]
+    return None
+
+
+def collapse_css_sides(style, family, collapse_values):
+    # Replaces the declarations of the four sides of the given shorthand
+    # property with a single declaration of the shorthand, if these are the
+    # only declarations of the family and collapse_values returns the value of
+    # the shorthand
+    sides = [family + '-' + side for side in ['top', 'right', 'bottom', 'left']]
+    members = [d for d in style if get_css_property_family(d[0]) == family]
+    if sorted(d[0] for d in members) != sorted(sides) or \
+            any(d[2] for d in members):
+        return style
+
+    value = collapse_values([style.get(side) for side in sides])
+    if value is None:
+        return style
+
+    declarations = []
+    for d in style:
+        if d[0] not in sides:
+            declarations.append(d)
+        elif d is members[0]:
+            declarations.append((family, value, ''))
+    return InlineStyle(declarations)
+
+
+@style_cache
+def compact_inline_style(style, tag, parent_inherited):
+    # Returns the compacted inline style of an element along with the values
+    # of COMPACT_INHERITED_PROPERTIES that the children of the element
+    # inherit. parent_inherited contains the values the element inherits,
+    # None stands for an unknown value. tag is None for the elements that must
+    # not be changed.
+    style = parse_inline_style(style)
+    overrides = COMPACT_INHERITED_OVERRIDES.get(tag)
+    if overrides is None:
+        overrides = COMPACT_INHERITED_PROPERTIES
+    else:
+        style = collapse_css_sides(style, 'padding', collapse_padding_values)
+        style = collapse_css_sides(style, 'border', collapse_border_values)
+
+    family_counts = collections.Counter(
+        get_css_property_family(d[0]) for d in style)
+
+    inherited = list(parent_inherited)
+    for i, name in enumerate(COMPACT_INHERITED_PROPERTIES):
+        if family_counts[get_css_property_family(name)] > 0:
+            inherited[i] = style.get(name)
+        elif name in overrides:
+            inherited[i] = None
+
+    if tag not in COMPACT_INHERITED_OVERRIDES:
+        return style, tuple(inherited)
+
+    initial_values = COMPACT_INITIAL_VALUES.get(tag, {})
+    declarations = []
+    for name, value, priority in style:
+        if not priority and \
+                family_counts[get_css_property_family(name)] == 1:
+            if name in COMPACT_INHERITED_PROPERTIES and \
+                    name not in overrides:
+                i = COMPACT_INHERITED_PROPERTIES.index(name)
+                if parent_inherited[i] == value and \
+                        (name != 'line-height' or
+                         CSS_INHERITABLE_LINE_HEIGHT_RE.match(value)):
+                    continue
+            if value in initial_values.get(name, []) or \
+                    value in COMPACT_COMMON_INITIAL_VALUES.get(name, []):
+                continue
+        declarations.append((name, value, priority))
+    return InlineStyle(declarations), tuple(inherited)
+
+
+def compact_inline_styles(root_el):
+    # Drops the declarations of the inline styles that are equal to the
+    # inherited or the initial value, collapses the sides of padding and
+    # border into shorthands and serializes the styles without any
+    # whitespace. The elements are rendered the same, but the pages are
+    # smaller.
+    unknown = (None,) * len(COMPACT_INHERITED_PROPERTIES)
+    pending = [(root_el, unknown)]
+    while len(pending) > 0:
+        el, parent_inherited = pending.pop()
+        if not isinstance(el.tag, str):
+            continue
+
+        tag = el.tag
+        if any(a not in COMPACT_SAFE_ATTRIBUTES for a in el.attrib):
+            tag = None
+        style, inherited = compact_inline_style(el.get('style'), tag,
+                                                parent_inherited)
+        if len(style) > 0:
+            el.set('style', style.css_text(':'))
+        elif 'style' in el.attrib:
+            el.attrib.pop('style')
+        pending.extend((child, inherited) for child in reversed(el))
@@ -0,0 +1,49 @@
+#   Copyright (C) 2026  agent <agent@local>
+#
+#   This file is part of cppreference-doc
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see http://www.gnu.org/licenses/.
+
+import hashlib
+import importlib.metadata
+
+
+def hash_file(fn):
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_package_version(name):
+    # Returns the installed version of the given distribution or 'unknown'
+    # if it is not installed as a distribution
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def get_code_version(fn, packages=()):
+    # Returns a stamp that changes whenever the code in the given file or the
+    # installed version of any of the given packages changes
+    if not packages:
+        return hash_file(fn)
+    h = hashlib.sha1()
+    h.update(hash_file(fn).encode('utf-8'))
+    for name in packages:
+        h.update('\n{0}=={1}'.format(name, get_package_version(name))
+                 .encode('utf-8'))
+    return h.hexdigest()
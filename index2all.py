@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+'''
+    Copyright (C) 2026  agent <agent@local>
+
+    This file is part of cppreference-doc
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+'''
+
+import argparse
+import contextlib
+
+from index_transform.autolinker import Index2AutolinkerGroups
+from index_transform.autolinker import Index2AutolinkerLinks
+from index_transform.autolinker import format_autolinker
+from index_transform.browser import BROWSER_FOOTER
+from index_transform.browser import BROWSER_HEADER
+from index_transform.browser import Index2Browser
+from index_transform.common import IndexTransformGroup
+from index_transform.common import compile_index
+from index_transform.common import load_compiled_index
+from index_transform.devhelp import Index2Devhelp
+from index_transform.devhelp import format_devhelp_book
+from index_transform.devhelp import make_devhelp_book
+from index_transform.doxygen_tag import Index2DoxygenTag
+from index_transform.doxygen_tag import Item
+from index_transform.doxygen_tag import load_link_map
+from index_transform.doxygen_tag import write_doxygen_tag_header
+from index_transform.doxygen_tag import write_doxygen_tag_map
+from index_transform.highlight import Index2Highlight
+from index_transform.search import Index2Search
+
+
+def write_outputs(args, records):
+    # The transforms of all requested outputs are driven by a single pass
+    # over the compiled records. The outputs that are written after the pass
+    # are finished by the functions in 'finishers'
+    with contextlib.ExitStack() as stack:
+        def open_output(fn):
+            return stack.enter_context(open(fn, 'w', encoding='utf-8'))
+
+        transforms = []
+        finishers = []
+
+        if args.highlight is not None:
+            transforms.append(Index2Highlight(open_output(args.highlight)))
+
+        if args.search is not None:
+            transforms.append(Index2Search(open_output(args.search)))
+
+        if args.autolinker is not None:
+            autolinker_f = open_output(args.autolinker)
+            groups_tr = Index2AutolinkerGroups()
+            links_tr = Index2AutolinkerLinks()
+            transforms += [groups_tr, links_tr]
+            finishers.append(lambda: autolinker_f.write(
+                format_autolinker(groups_tr.groups, links_tr.links)))
+
+        if args.browser is not None:
+            browser_f = open_output(args.browser)
+            browser_f.write(BROWSER_HEADER)
+            transforms.append(Index2Browser(browser_f))
+            finishers.append(lambda: browser_f.write(BROWSER_FOOTER))
+
+        if args.devhelp is not None:
+            book_el, functions_el = make_devhelp_book(
+                args.book_title, args.book_name, args.book_base,
+                args.rel_link, args.chapters)
+            transforms.append(Index2Devhelp(functions_el))
+
+            def finish_devhelp():
+                with open(args.devhelp, 'wb') as out_f:
+                    out_f.write(format_devhelp_book(book_el))
+            finishers.append(finish_devhelp)
+
+        if args.doxygen_tag is not None:
+            link_map = load_link_map(args.link_map)
+            doxygen_f = open_output(args.doxygen_tag)
+            write_doxygen_tag_header(doxygen_f, args.chapters)
+            ns_map = Item()
+            transforms.append(Index2DoxygenTag(ns_map))
+            finishers.append(lambda: write_doxygen_tag_map(
+                doxygen_f, link_map, ns_map))
+
+        IndexTransformGroup(transforms).transform_compiled(records)
+        for finish in finishers:
+            finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='index2all',
+        description='Produces any number of the outputs of the index2* '
+                    'scripts from a single walk over the index')
+    parser.add_argument(
+        'index', type=str,
+        help='Path to index file to process')
+
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='Path to the directory to cache the compiled index in. If not '
+             'given, the index is compiled in memory only')
+
+    parser.add_argument(
+        '--highlight', type=str, default=None,
+        help='Path to store the output of index2highlight.py to')
+
+    parser.add_argument(
+        '--search', type=str, default=None,
+        help='Path to store the output of index2search.py to')
+
+    parser.add_argument(
+        '--autolinker', type=str, default=None,
+        help='Path to store the output of index2autolinker.py to')
+
+    parser.add_argument(
+        '--browser', type=str, default=None,
+        help='Path to store the output of index2browser.py to')
+
+    parser.add_argument(
+        '--devhelp', type=str, default=None,
+        help='Path to store the output of index2devhelp.py to. Requires '
+             '--chapters, --book_base, --book_title, --book_name and '
+             '--rel_link')
+
+    parser.add_argument(
+        '--doxygen_tag', type=str, default=None,
+        help='Path to store the output of index2doxygen-tag.py to. Requires '
+             '--chapters')
+
+    parser.add_argument(
+        '--chapters', type=str, default=None,
+        help='Path to the chapters file to include')
+
+    parser.add_argument(
+        '--book_base', type=str, default=None,
+        help='url to the location of the devhelp book')
+
+    parser.add_argument(
+        '--book_title', type=str, default=None,
+        help='the title of the devhelp book')
+
+    parser.add_argument(
+        '--book_name', type=str, default=None,
+        help='the name of the devhelp package')
+
+    parser.add_argument(
+        '--rel_link', type=str, default=None,
+        help='the link relative to the root of the documentation')
+
+    parser.add_argument(
+        '--link_map', type=str, default='web',
+        help='the file name of the link map of the doxygen tag file or '
+             '\'web\' if no link remap should be done')
+
+    args = parser.parse_args()
+
+    if args.devhelp is not None:
+        for name in ['chapters', 'book_base', 'book_title', 'book_name',
+                     'rel_link']:
+            if getattr(args, name) is None:
+                parser.error('--devhelp requires --' + name)
+
+    if args.doxygen_tag is not None and args.chapters is None:
+        parser.error('--doxygen_tag requires --chapters')
+
+    if args.cache_dir is not None:
+        records = load_compiled_index(args.index, args.cache_dir)
+    else:
+        records = compile_index(args.index)
+    write_outputs(args, records)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,8 @@
 '''
 
 import argparse
-import json
 
-from index_transform.autolinker import Index2AutolinkerGroups
-from index_transform.autolinker import Index2AutolinkerLinks
+from index_transform.autolinker import transform_autolinker
 
 
 def main():
@@ -54,26 +52,14 @@ def main():
                         help='Path to index file to process')
     parser.add_argument('destination', type=str,
                         help='Path to destination file to store results to')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Path to the directory to cache the compiled '
+                             'index in')
     args = parser.parse_args()
 
     out_f = open(args.destination, 'w', encoding='utf-8')
 
-    tr = Index2AutolinkerGroups()
-    tr.transform_file(args.index)
-    groups = tr.groups
-
-    tr = Index2AutolinkerLinks()
-    tr.transform_file(args.index)
-    links = tr.links
-
-    json_groups = list(groups.values())
-
-    json_groups = sorted(json_groups, key=lambda x: x['name'])
-    links = sorted(links, key=lambda x: x['target'])
-
-    out_f.write(json.dumps({'groups': json_groups, 'links': links},
-                           indent=None,
-                           separators=(',\n', ': '), sort_keys=True))
+    out_f.write(transform_autolinker(args.index, args.cache_dir))
     out_f.close()
 
 
@@ -20,7 +20,7 @@
 
 import argparse
 
-from index_transform.browser import Index2Browser
+from index_transform.browser import transform_browser
 
 
 def main():
@@ -29,40 +29,14 @@ def main():
                         help='Path to index file to process')
     parser.add_argument('destination', type=str,
                         help='Path to destination file to store results to')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Path to the directory to cache the compiled '
+                             'index in')
     args = parser.parse_args()
 
     out_f = open(args.destination, 'w', encoding='utf-8')
 
-    out_f.write('''
-<html>
-  <head>
-  <style type="text/css">
-    body {
-      font-size: 0.8em;
-    }
-
-    .link a {
-      font-size: 0.8em;
-      color: #808080;
-    }
-    .mark {
-      font-size: 0.8em;
-      color: #008000;
-    }
-  </style>
-  </head>
-  <body>
-    <ul>
-''')
-
-    tr = Index2Browser(out_f)
-    tr.transform_file(args.index)
-
-    out_f.write('''
-    </ul>
-  </body>
-</html>
-''')
+    transform_browser(out_f, args.index, args.cache_dir)
 
 
 if __name__ == '__main__':
@@ -32,6 +32,7 @@ from ddg_parse_html import DdgException
 from ddg_parse_html import get_declarations
 from ddg_parse_html import get_short_description
 from index_transform.common import IndexTransform
+from index_transform.common import load_compiled_index
 
 # Entry types
 # a class or struct
@@ -68,6 +69,11 @@ ITEM_TYPE_VARIABLE = 10
 ITEM_TYPE_VARIABLE_INLINEMEM = 11
 
 
+# the tags of the index elements get_item_type may recognize
+ITEM_TYPE_TAGS = ['const', 'function', 'variable', 'constructor', 'destructor',
+                  'class', 'enum']
+
+
 def get_item_type(el):
     if (el.tag == 'const' and el.getparent().tag == 'enum' and
             el.get('link') == '.'):
@@ -127,21 +133,25 @@ class DDGDebug:
         return True
 
 
-class Index2DuckDuckGoList(IndexTransform):
-
-    def __init__(self, ident_map):
-        self.ident_map = ident_map
-        super().__init__(ignore_typedefs=True)
-
-    def process_item_hook(self, el, full_name, full_link):
-
-        item_type = get_item_type(el)
+def get_ident_map(index_file, cache_dir=None):
+    ''' Returns a two level map that stores information about location and
+        type of identifiers: full_link maps to a dict that has full_name map to
+        ITEM_TYPE_* value. If cache_dir is given, the compiled index is loaded
+        from or stored to it
+    '''
+    ident_map = {}
+    tr = IndexTransform(ignore_typedefs=True)
+    if cache_dir is None:
+        items = tr.iter_items(e.parse(index_file), tags=ITEM_TYPE_TAGS)
+    else:
+        items = tr.iter_compiled_items(
+            load_compiled_index(index_file, cache_dir), tags=ITEM_TYPE_TAGS)
+    for item in items:
+        item_type = get_item_type(item.el)
         if item_type:
-            if full_link in self.ident_map:
-                self.ident_map[full_link][full_name] = item_type
-            else:
-                self.ident_map[full_link] = {full_name: item_type}
-        IndexTransform.process_item_hook(self, el, full_name, full_link)
+            ident_map.setdefault(item.full_link, {})[item.full_name] = \
+                item_type
+    return ident_map
 
 
 def get_html_files(root):
@@ -528,6 +538,10 @@ def main():
     parser.add_argument(
         '--debug_abstracts_path', type=str, default=None,
         help='Path to print the abstracts before newline stripping occurs')
+
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='Path to the directory to cache the compiled index in')
     args = parser.parse_args()
 
     # If a the second argument is 'debug', the program switches to debug mode
@@ -539,14 +553,8 @@ def main():
     index_file = args.index
     output_file = args.output
 
-    # a map that stores information about location and type of identifiers
-    # it's two level map: full_link maps to a dict that has full_name map to
-    # ITEM_TYPE_* value
-    ident_map = {}
-
     # get a list of pages to analyze
-    tr = Index2DuckDuckGoList(ident_map)
-    tr.transform_file(index_file)
+    ident_map = get_ident_map(index_file, args.cache_dir)
 
     # get a mapping between titles and pages
     # linkmap = dict { title -> filename }
@@ -40,12 +40,15 @@ def main():
                         help='the path of the source file')
     parser.add_argument('dest_fn', type=str,
                         help='the path of the destination file')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='the directory to cache the compiled index in')
     args = parser.parse_args()
 
     with open(args.dest_fn, 'wb') as out_f:
         output = transform_devhelp(args.book_title, args.book_name,
                                    args.book_base, args.rel_link,
-                                   args.chapters_path, args.in_fn)
+                                   args.chapters_path, args.in_fn,
+                                   cache_dir=args.cache_dir)
         out_f.write(output)
 
 
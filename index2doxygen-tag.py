@@ -20,12 +20,7 @@
 
 import argparse
 
-from lxml import etree
-
-from index_transform.doxygen_tag import Index2DoxygenTag
-from index_transform.doxygen_tag import Item
-from index_transform.doxygen_tag import print_map
-from link_map import LinkMap
+from index_transform.doxygen_tag import transform_doxygen_tag
 
 
 def main():
@@ -47,6 +42,10 @@ def main():
         'dest_fn', type=str,
         help='the file name of the destination file')
 
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='the directory to cache the compiled index in')
+
     args = parser.parse_args()
 
     link_map_fn = args.link_map_fn
@@ -54,35 +53,9 @@ def main():
     chapters_fn = args.chapters_fn
     dest_fn = args.dest_fn
 
-    out_f = open(dest_fn, 'w', encoding='utf-8')
-
-    link_map = None
-    if link_map_fn != 'web':
-        link_map = LinkMap()
-        link_map.read(link_map_fn)
-
-    ns_map = Item()
-
-    out_f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n')
-    out_f.write('<tagfile>\n')
-
-    with open(chapters_fn, encoding='utf-8') as chapters_f:
-        chapters_tree = etree.parse(chapters_f)
-        for header_chapter in \
-                chapters_tree.getroot().findall(".//*[@name='Headers']/*"):
-            out_f.write('  <compound kind="file">\n')
-            out_f.write('    <name>{0}</name>\n'.format(
-                header_chapter.attrib['name']))
-            out_f.write('    <filename>{0}</filename>\n'.format(
-                header_chapter.attrib['link']))
-            out_f.write('    <namespace>std</namespace>\n')
-            out_f.write('  </compound>\n')
-
-    tr = Index2DoxygenTag(ns_map)
-    tr.transform_file(in_fn)
-    print_map(out_f, link_map, ns_map)
-    out_f.write('''</tagfile>
-''')
+    with open(dest_fn, 'w', encoding='utf-8') as out_f:
+        transform_doxygen_tag(out_f, link_map_fn, in_fn, chapters_fn,
+                              args.cache_dir)
 
 
 if __name__ == '__main__':
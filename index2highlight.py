@@ -32,12 +32,16 @@ def main():
     parser.add_argument(
         'destination', type=str,
         help='Path to destination file to store results to')
+
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='Path to the directory to cache the compiled index in')
     args = parser.parse_args()
 
     out_f = open(args.destination, 'w', encoding='utf-8')
 
     tr = Index2Highlight(out_f)
-    tr.transform_file(args.index)
+    tr.transform_file(args.index, args.cache_dir)
 
 
 if __name__ == '__main__':
@@ -18,6 +18,8 @@
     along with this program.  If not, see http://www.gnu.org/licenses/.
 '''
 
+import json
+
 from index_transform.common import IndexTransform
 
 
@@ -26,16 +28,6 @@ def get_rel_name(full_name):
     return full_name[pos+2:]
 
 
-def is_group(el):
-    curr_el = el
-    while True:
-        if curr_el.tag != 'class' and curr_el.tag != 'enum':
-            return False
-        curr_el = curr_el.getparent()
-        if curr_el.tag == 'index':
-            return True
-
-
 def needs_entry_in_group(el):
     tags = ['const', 'function', 'class', 'enum', 'variable']
     return el.tag in tags
@@ -49,7 +41,7 @@ class Index2AutolinkerGroups(IndexTransform):
         self.curr_group = None
 
     def process_item_hook(self, el, full_name, full_link):
-        if is_group(el):
+        if self.is_group(el):
             saved_group = self.curr_group
 
             self.groups[full_name] = {
@@ -63,7 +55,7 @@ class Index2AutolinkerGroups(IndexTransform):
         else:
             IndexTransform.process_item_hook(self, el, full_name, full_link)
 
-        if is_group(el.getparent()):
+        if self.is_group(el.getparent()):
             base_url = self.groups[self.curr_group]['base_url']
             if full_link.find(base_url) == 0:
                 rel_link = full_link[len(base_url):]
@@ -82,7 +74,7 @@ class Index2AutolinkerLinks(IndexTransform):
     def process_item_hook(self, el, full_name, full_link):
         self.links.append({'string': full_name, 'target': full_link})
 
-        if is_group(el):
+        if self.is_group(el):
             saved_group = self.curr_group
             self.curr_group = full_name
             IndexTransform.process_item_hook(self, el, full_name, full_link)
@@ -90,7 +82,7 @@ class Index2AutolinkerLinks(IndexTransform):
         else:
             IndexTransform.process_item_hook(self, el, full_name, full_link)
 
-        if is_group(el.getparent()) and self.curr_group and \
+        if self.is_group(el.getparent()) and self.curr_group and \
                 needs_entry_in_group(el):
 
             self.links.append({
@@ -98,3 +90,27 @@ class Index2AutolinkerLinks(IndexTransform):
                 'target': full_link,
                 'on_group': self.curr_group
             })
+
+
+def transform_autolinker(in_fn, cache_dir=None):
+    tr = Index2AutolinkerGroups()
+    tr.transform_file(in_fn, cache_dir)
+    groups = tr.groups
+
+    tr = Index2AutolinkerLinks()
+    tr.transform_file(in_fn, cache_dir)
+    links = tr.links
+
+    return format_autolinker(groups, links)
+
+
+def format_autolinker(groups, links):
+    # Returns the autolinker data file for the results of
+    # Index2AutolinkerGroups and Index2AutolinkerLinks
+    json_groups = list(groups.values())
+
+    json_groups = sorted(json_groups, key=lambda x: x['name'])
+    links = sorted(links, key=lambda x: x['target'])
+
+    return json.dumps({'groups': json_groups, 'links': links},
+                      indent=None, separators=(',\n', ': '), sort_keys=True)
@@ -61,3 +61,39 @@ class Index2Browser(IndexTransform):
                             '<ul>')
         IndexTransform.process_item_hook(self, el, full_name, full_link)
         self.out_file.write('</ul></li>\n')
+
+
+BROWSER_HEADER = '''
+<html>
+  <head>
+  <style type="text/css">
+    body {
+      font-size: 0.8em;
+    }
+
+    .link a {
+      font-size: 0.8em;
+      color: #808080;
+    }
+    .mark {
+      font-size: 0.8em;
+      color: #008000;
+    }
+  </style>
+  </head>
+  <body>
+    <ul>
+'''
+
+BROWSER_FOOTER = '''
+    </ul>
+  </body>
+</html>
+'''
+
+
+def transform_browser(out_f, in_fn, cache_dir=None):
+    out_f.write(BROWSER_HEADER)
+    tr = Index2Browser(out_f)
+    tr.transform_file(in_fn, cache_dir)
+    out_f.write(BROWSER_FOOTER)
@@ -18,8 +18,17 @@
     along with this program.  If not, see http://www.gnu.org/licenses/.
 '''
 
+import collections
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+
 import lxml.etree as e
 
+from commands.versioning import get_code_version
+
 '''
     This is a python script for various transformations of the index.
 
@@ -30,14 +39,76 @@ import lxml.etree as e
 
     Called to output information of a feature and continue the processing of the
     children. By default just processes the children.
+
+    The result of the walk over the index does not depend on the hooks, thus it
+    can be compiled once into a tree of records and cached, see
+    load_compiled_index. The transforms replay the records through the hooks
+    without parsing the XML.
 '''
 
+# Flags of the compiled records. FROM_TYPEDEF marks the records that have been
+# pulled from the target of a typedef, FROM_INHERITS the records that have been
+# pulled from a base class
+FROM_TYPEDEF = 1
+FROM_INHERITS = 2
+
+# The tags of the elements that describe the features
+ITEM_TAGS = ['const', 'function', 'class', 'enum', 'variable', 'typedef',
+             'constructor', 'destructor', 'specialization', 'overload']
+
+# A feature yielded by IndexTransform.iter_items. 'kind' is the tag of the
+# element, 'depth' is the nesting level of the feature (0 for the top-level
+# features, members pulled from the base classes or typedef targets have the
+# same depth as the other members), 'group' is the full name of the innermost
+# enclosing group (see is_group) or None and 'el' is the element itself
+IndexItem = collections.namedtuple(
+    'IndexItem', ['kind', 'full_name', 'full_link', 'depth', 'group', 'el'])
+
+# The structural facts of an element of the index that IndexTransform.annotate
+# computes. 'depth' is the nesting level of the element (0 for the root
+# element), 'is_group' tells whether the element is a group (see is_group)
+# and 'group_root' is the outermost group that contains the element or is the
+# element itself, None if there's no such group
+ElementInfo = collections.namedtuple(
+    'ElementInfo', ['depth', 'is_group', 'group_root'])
+
+
+def is_group(el):
+    ''' Returns whether 'el' is a class or enum that is nested in classes or
+        enums only
+    '''
+    curr_el = el
+    while True:
+        if curr_el.tag != 'class' and curr_el.tag != 'enum':
+            return False
+        curr_el = curr_el.getparent()
+        if curr_el.tag == 'index':
+            return True
+
 
 class IndexTransform:
 
     def __init__(self, ignore_typedefs=False, ignore_inherits=False):
         self.ignore_typedefs = ignore_typedefs
         self.ignore_inherits = ignore_inherits
+        # the root element of the annotated index and a dict that maps names
+        # to lists of top-level class and enum elements, see annotate
+        self.alias_root = None
+        self.aliases = None
+        # maps the elements of the annotated index to ElementInfo tuples
+        self.element_info = dict()
+        # maps the elements of the annotated index that have 'inherits'
+        # children to the lists of these children
+        self.inherits_lists = dict()
+        # maps tuples of 'inherits' elements to the members pulled from the
+        # base classes, see get_inherited_members
+        self.inherited_members = dict()
+        # the children of the compiled record that is being replayed, None if
+        # the XML index is walked
+        self.replay_children = None
+        # called by process_children instead of replaying replay_children
+        # while the transform is driven by an IndexTransformGroup
+        self.children_handler = None
 
     """ Returns the attribute 'attr' of 'el', raises exception on error
     """
@@ -120,100 +191,517 @@ class IndexTransform:
         name += self.get_name(el)
         return name
 
+    """ Computes the structural facts of all elements of the index that
+        contains 'el' in a single pass, so that the walks over the index do
+        not need to query the tree. Indexes the top-level classes and enums by
+        their names, records the ElementInfo of each element and the
+        'inherits' children of each element. 'el' is either an element or an
+        element tree.
+    """
+    def annotate(self, el):
+        if hasattr(el, 'getroottree'):
+            el = el.getroottree()
+        self.alias_root = el.getroot()
+        self.aliases = dict()
+        self.element_info = dict()
+        self.inherits_lists = dict()
+        self.inherited_members = dict()
+
+        root = self.alias_root
+        root_info = ElementInfo(0, False, None)
+        self.element_info[root] = root_info
+        pending = [(root, root_info)]
+        while pending:
+            parent, parent_info = pending.pop()
+            inherits = []
+            for el in parent.iterchildren(e.Element):
+                el_is_group = el.tag in ['class', 'enum'] and \
+                    (parent is root or parent_info.is_group)
+                if el_is_group and parent is root:
+                    group_root = el
+                    self.aliases.setdefault(el.get('name'), []).append(el)
+                else:
+                    group_root = parent_info.group_root
+                info = ElementInfo(parent_info.depth + 1, el_is_group,
+                                   group_root)
+                self.element_info[el] = info
+
+                if el.tag == 'inherits':
+                    inherits.append(el)
+                if len(el):
+                    pending.append((el, info))
+            if inherits:
+                self.inherits_lists[parent] = inherits
+
+    """ Returns the ElementInfo of 'el'. Annotates the index that contains
+        'el' if it hasn't been annotated yet
+    """
+    def get_element_info(self, el):
+        info = self.element_info.get(el)
+        if info is None:
+            self.annotate(el)
+            info = self.element_info[el]
+        return info
+
+    """ Returns the 'inherits' children of 'el' """
+    def get_inherits(self, el):
+        self.get_element_info(el)
+        return self.inherits_lists.get(el, [])
+
+    """ Returns whether 'el' is a group, see is_group. 'el' may also be an
+        IndexNode of a compiled index
+    """
+    def is_group(self, el):
+        info = self.element_info.get(el)
+        if info is not None:
+            return info.is_group
+        if isinstance(el, IndexNode):
+            return is_group(el)
+        return self.get_element_info(el).is_group
+
     """ Returns the element within the document that has a name that matches
         'name'
     """
     def get_alias(self, el, name):
-        aliases = el.xpath('/index/class[@name = \'' + name + '\'] |' +
-                           '/index/enum[@name = \'' + name + '\']')
+        if self.alias_root is None or \
+                el.getroottree().getroot() is not self.alias_root:
+            self.annotate(el)
+        aliases = self.aliases.get(name, [])
         if len(aliases) == 0:
             raise Exception('No aliases found for \'' + name + '\'')
         if len(aliases) > 1:
             raise Exception('More than one alias found for \'' + name + '\'')
         return aliases[0]
 
-    """ Processes one item """
-    def process_item(self, el, parent_name, parent_link):
-        if el.tag in ['const', 'function', 'class', 'enum', 'variable',
-                      'typedef', 'constructor', 'destructor', 'specialization',
-                      'overload']:
-
+    """ Yields (el, full_name, full_link, flags) tuples for the features
+        that 'el' stands for when it is processed as a child of the item with
+        the given full name and link. An element of ITEM_TAGS stands for
+        itself, the first 'inherits' element of a class stands for the members
+        pulled from all base classes of the class. 'flags' is FROM_INHERITS
+        for the latter. This defines the walk over the index for
+        process_item, iter_items and compile_index alike
+    """
+    def iter_features(self, el, parent_name, parent_link):
+        if el.tag in ITEM_TAGS:
             full_name = self.get_full_name(el, parent_name)
             full_link = self.get_full_link(el, parent_link)
-
-            self.process_item_hook(el, full_name, full_link)
+            yield el, full_name, full_link, 0
 
         elif el.tag == 'inherits' and \
-                el.getparent().xpath('child::inherits')[0] == el:
+                self.get_inherits(el.getparent())[0] is el:
 
             if self.ignore_inherits:
                 return
-            pending = el.getparent().xpath('child::inherits')
-            self.inherits_worker(parent_name, pending, list())
-
-    """ Processes children of an item """
-    def process_children(self, el, parent_name, parent_link):
-
+            pending = self.get_inherits(el.getparent())
+            for source_ch, source_link in self.get_inherited_members(pending):
+                for feature in self.iter_features(source_ch, parent_name,
+                                                  source_link):
+                    yield feature[:3] + (FROM_INHERITS,)
+
+    """ Yields (el, parent_name, parent_link, flags) tuples for the child
+        elements of the feature 'el' that are processed as its children. The
+        children of a typedef are those of its target and have the
+        FROM_TYPEDEF flag
+    """
+    def iter_child_elements(self, el, parent_name, parent_link):
         if el.tag == 'class' or el.tag == 'enum':
             for child in el:
-                self.process_item(child, parent_name, parent_link)
+                yield child, parent_name, parent_link, 0
         elif el.tag == 'typedef':
             if self.ignore_typedefs:
                 return
 
             alias_name = el.get('alias')
-            if alias_name:
-                target = self.get_alias(el, alias_name)
-            else:
+            if not alias_name:
                 return
+            target = self.get_alias(el, alias_name)
             link = self.get_link(target)
             for target_ch in target:
-                self.process_item(target_ch, parent_name, link)
+                yield target_ch, parent_name, link, FROM_TYPEDEF
 
-    """ Pulls the contents of the inherited classes. Diamond inheritance is
-        handled properly
-    """
-    def inherits_worker(self, parent_name, pending, finished):
-        if len(pending) == 0:
+    """ Processes one item """
+    def process_item(self, el, parent_name, parent_link):
+        for feature, full_name, full_link, flags in \
+                self.iter_features(el, parent_name, parent_link):
+            self.process_item_hook(feature, full_name, full_link)
+
+    """ Processes children of an item """
+    def process_children(self, el, parent_name, parent_link):
+        if self.children_handler is not None:
+            self.children_handler()
             return
 
-        current = pending.pop(0)
+        if self.replay_children is not None:
+            self.replay_records(self.replay_children)
+            return
 
-        # find the source class/enum
-        source = self.get_alias(current, self.get_attr(current, 'name'))
+        for child, child_parent_name, child_parent_link, flags in \
+                self.iter_child_elements(el, parent_name, parent_link):
+            self.process_item(child, child_parent_name, child_parent_link)
+
+    """ Returns the members that the class with the given 'inherits' elements
+        pulls from its base classes as a list of (member, parent_link)
+        tuples. The base classes are visited breadth-first and each of them
+        is visited only once, thus diamond inheritance is handled properly.
+        The classes in 'finished' are considered visited already. The result
+        is cached for the rest of the transform unless 'finished' is not
+        empty.
+    """
+    def get_inherited_members(self, pending, finished=()):
+        key = tuple(pending)
+        if not finished and key in self.inherited_members:
+            return self.inherited_members[key]
+
+        ignore_tags = ['constructor', 'destructor', 'inherits',
+                       'specialization', 'overload']
+        members = []
+        visited = set(finished)
+        queue = collections.deque(pending)
+        while queue:
+            current = queue.popleft()
+
+            # find the source class/enum
+            source = self.get_alias(current, self.get_attr(current, 'name'))
+            if source in visited:
+                # its bases have been queued when it was visited first
+                continue
+            visited.add(source)
 
-        if source not in finished:
-            finished.append(source)
             parent_link = self.get_attr(source, 'link')
             for source_ch in source:
-                ignore_tags = ['constructor', 'destructor', 'inherits',
-                               'specialization', 'overload']
                 if source_ch.tag in ignore_tags:
                     pass
                 elif source_ch.tag == 'function' and \
                         source_ch.get('name') == 'operator=':
                     pass
                 else:
-                    self.process_item(source_ch, parent_name, parent_link)
+                    members.append((source_ch, parent_link))
 
-        # append new elements
-        more_pending = source.xpath('child::inherits')
-        more_pending = [p for p in more_pending if p is not current]
-        pending.extend(more_pending)
+            # append new elements
+            queue.extend(p for p in self.get_inherits(source)
+                         if p is not current)
 
-        self.inherits_worker(parent_name, pending, finished)
+        if not finished:
+            self.inherited_members[key] = members
+        return members
 
-    """ Transforms the index from the given path """
-    def transform_file(self, fn):
+    """ Pulls the contents of the inherited classes. Diamond inheritance is
+        handled properly. The walk pulls them via iter_features
+    """
+    def inherits_worker(self, parent_name, pending, finished):
+        for source_ch, parent_link in self.get_inherited_members(pending,
+                                                                 finished):
+            self.process_item(source_ch, parent_name, parent_link)
+
+    """ Transforms the index from the given path. If 'cache_dir' is given,
+        the compiled index is loaded from or stored to it
+    """
+    def transform_file(self, fn, cache_dir=None):
+        if cache_dir is not None:
+            self.transform_compiled(load_compiled_index(fn, cache_dir))
+            return
         root = e.parse(fn)
         self.transform_xml(root)
 
+    """ Transforms the index from the given compiled records, see
+        compile_index
+    """
+    def transform_compiled(self, records):
+        self.replay_records(records)
+        self.replay_children = None
+
+    """ Returns the flags of the compiled records that the transform
+        ignores
+    """
+    def get_skip_flags(self):
+        skip_flags = 0
+        if self.ignore_typedefs:
+            skip_flags |= FROM_TYPEDEF
+        if self.ignore_inherits:
+            skip_flags |= FROM_INHERITS
+        return skip_flags
+
+    """ Calls the hooks for the given compiled records and their children,
+        except those that the transform ignores
+    """
+    def replay_records(self, records):
+        skip_flags = self.get_skip_flags()
+        saved_children = self.replay_children
+        for node, full_name, full_link, flags, children in records:
+            if flags & skip_flags:
+                continue
+            self.replay_children = children
+            self.process_item_hook(node, full_name, full_link)
+        self.replay_children = saved_children
+
     """ Transforms the index from the given XML tree """
     def transform_xml(self, root):
+        self.annotate(root)
         elems = root.xpath('/index/*')
         for el in elems:
             self.process_item(el, '', '')
 
+    """ Lazily yields the features of the index from the given XML tree as
+        IndexItem tuples in the order in which process_item_hook would be
+        called. If 'tags' is given, only the features with these tags are
+        yielded. If 'prefix' is given, only the features whose full names
+        start with it are yielded. The walk stops as soon as the generator is
+        no longer consumed
+    """
+    def iter_items(self, root, tags=None, prefix=None):
+        self.annotate(root)
+        for el in root.xpath('/index/*'):
+            yield from filter_items(self.iter_item(el, '', '', 0, None),
+                                    tags, prefix)
+
+    """ Like iter_items, but yields the features from the given compiled
+        records, see compile_index. The 'el' fields are IndexNode objects
+    """
+    def iter_compiled_items(self, records, tags=None, prefix=None):
+        return filter_items(self.iter_records(records, 0, None), tags, prefix)
+
+    """ Yields the features of the given compiled records and their
+        children, except those that the transform ignores
+    """
+    def iter_records(self, records, depth, group):
+        skip_flags = self.get_skip_flags()
+        for node, full_name, full_link, flags, children in records:
+            if flags & skip_flags:
+                continue
+            yield IndexItem(node.tag, full_name, full_link, depth, group,
+                            node)
+            child_group = full_name if self.is_group(node) else group
+            yield from self.iter_records(children, depth + 1, child_group)
+
+    """ Yields the features of an item and of its children as IndexItem
+        tuples, see process_item
+    """
+    def iter_item(self, el, parent_name, parent_link, depth, group):
+        for feature, full_name, full_link, flags in \
+                self.iter_features(el, parent_name, parent_link):
+            yield IndexItem(feature.tag, full_name, full_link, depth, group,
+                            feature)
+
+            child_group = full_name if self.is_group(feature) else group
+            for child, child_parent_name, child_parent_link, child_flags in \
+                    self.iter_child_elements(feature, full_name, full_link):
+                yield from self.iter_item(child, child_parent_name,
+                                          child_parent_link, depth + 1,
+                                          child_group)
+
     """ Hooks """
     def process_item_hook(self, el, full_name, full_link):
         self.process_children(el, full_name, full_link)
+
+
+class IndexTransformGroup:
+    ''' Replays the compiled records through the hooks of several transforms
+        in a single pass over the records. Each record is passed to the
+        transforms that don't ignore it: the hook of the first transform is
+        called and when it processes the children, the hook of the next
+        transform is called for the same record and so on. The children are
+        then replayed once for all transforms that have processed the
+        children of the record. Thus each transform sees the same sequence of
+        hook calls as when it replays the records on its own.
+    '''
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def transform_compiled(self, records):
+        skip_flags = [(tr, tr.get_skip_flags()) for tr in self.transforms]
+        self.replay_records(skip_flags, records)
+
+    def replay_records(self, skip_flags, records):
+        for record in records:
+            flags = record[3]
+            active = [(tr, skip) for tr, skip in skip_flags
+                      if not flags & skip]
+            if active:
+                self.call_hooks(active, [], record)
+
+    def call_hooks(self, active, descending, record):
+        # Calls the hook of the first transform in 'active' for the record.
+        # 'active' and 'descending' are lists of (transform, skip flags)
+        # tuples, the latter lists the transforms that have processed the
+        # children of the record so far
+        if not active:
+            self.replay_records(descending, record[4])
+            return
+
+        tr = active[0][0]
+        called = False
+
+        def process_children():
+            nonlocal called
+            called = True
+            self.call_hooks(active[1:], descending + active[:1], record)
+
+        saved_handler = tr.children_handler
+        tr.children_handler = process_children
+        try:
+            tr.process_item_hook(*record[:3])
+        finally:
+            tr.children_handler = saved_handler
+        if not called:
+            self.call_hooks(active[1:], descending, record)
+
+
+def filter_items(items, tags=None, prefix=None):
+    ''' Yields the IndexItem tuples that have one of the given tags and whose
+        full names start with the given prefix. None matches anything
+    '''
+    if tags is not None:
+        tags = frozenset(tags)
+    for item in items:
+        if tags is not None and item.kind not in tags:
+            continue
+        if prefix is not None and not item.full_name.startswith(prefix):
+            continue
+        yield item
+
+
+class IndexNode:
+    ''' A picklable stand-in of an element of the index. Provides the subset
+        of the lxml element interface that the hooks use
+    '''
+
+    __slots__ = ['tag', 'attrib', 'parent']
+
+    def __init__(self, tag, attrib, parent):
+        self.tag = tag
+        self.attrib = attrib
+        self.parent = parent
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def getparent(self):
+        return self.parent
+
+
+class IndexCompiler(IndexTransform):
+    ''' Records the features of a full walk over the index as a tree of
+        (node, full_name, full_link, flags, children) tuples
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.nodes = dict()
+
+    def get_node(self, el):
+        node = self.nodes.get(el)
+        if node is None:
+            parent = el.getparent()
+            if parent is not None:
+                parent = self.get_node(parent)
+            node = IndexNode(el.tag, dict(el.attrib), parent)
+            self.nodes[el] = node
+        return node
+
+    def compile_item(self, el, parent_name, parent_link, flags):
+        records = []
+        for feature, full_name, full_link, feature_flags in \
+                self.iter_features(el, parent_name, parent_link):
+            children = []
+            for child, child_parent_name, child_parent_link, child_flags in \
+                    self.iter_child_elements(feature, full_name, full_link):
+                children.extend(self.compile_item(
+                    child, child_parent_name, child_parent_link, child_flags))
+            records.append((self.get_node(feature), full_name, full_link,
+                            flags | feature_flags, children))
+        return records
+
+    def compile_xml(self, root):
+        self.annotate(root)
+        records = []
+        for el in root.xpath('/index/*'):
+            records.extend(self.compile_item(el, '', '', 0))
+        return records
+
+
+def compile_index(fn):
+    ''' Walks the index at the given path and returns the compiled records
+        that IndexTransform.transform_compiled accepts
+    '''
+    return IndexCompiler().compile_xml(e.parse(fn))
+
+
+def get_compiled_index_version():
+    # Returns a stamp that changes whenever the code that walks the index or
+    # defines the format of the compiled records changes
+    return get_code_version(__file__)
+
+
+def get_compiled_index_path(fn, cache_dir):
+    h = hashlib.sha256()
+    h.update(get_compiled_index_version().encode('utf-8'))
+    with open(fn, 'rb') as f:
+        h.update(f.read())
+    name = os.path.splitext(os.path.basename(fn))[0]
+    return os.path.join(cache_dir, name + '-' + h.hexdigest() + '.pickle')
+
+
+def is_compiled_index(records):
+    # Checks that the value loaded from a compiled index file is a list of
+    # records as produced by IndexCompiler.compile_xml
+    return isinstance(records, list) and \
+        all(isinstance(r, tuple) and len(r) == 5 for r in records)
+
+
+def remove_stale_compiled_indexes(fn, cache_dir, path):
+    # Removes the files compiled from earlier contents or versions of the
+    # index at fn, except the file at path
+    name = os.path.splitext(os.path.basename(fn))[0]
+    pattern = re.compile(re.escape(name) + r'-[0-9a-f]{64}\.pickle')
+    for other in os.listdir(cache_dir):
+        other_path = os.path.join(cache_dir, other)
+        if pattern.fullmatch(other) and other_path != path:
+            try:
+                os.unlink(other_path)
+            except FileNotFoundError:
+                pass
+
+
+# maps the paths of the compiled index files to the records that have been
+# loaded from or stored to them by this process. The records are not modified
+# by the transforms, thus several transforms may share them
+loaded_compiled_indexes = dict()
+
+
+def load_compiled_index(fn, cache_dir):
+    ''' Returns the compiled records of the index at the given path. They are
+        loaded from cache_dir if the index has been compiled already,
+        otherwise the index is compiled and stored into cache_dir. The files
+        are keyed by the hash of the contents of the index and of the code
+        that compiles it, thus stale files are never used. Files that can't be
+        loaded are recompiled and the files compiled from other contents of
+        the index are removed when a new file is stored
+    '''
+    path = get_compiled_index_path(fn, cache_dir)
+    records = loaded_compiled_indexes.get(path)
+    if records is not None:
+        return records
+    try:
+        with open(path, 'rb') as f:
+            records = pickle.load(f)
+    except Exception:
+        # a missing, truncated or otherwise unreadable file is recompiled
+        records = None
+    if is_compiled_index(records):
+        loaded_compiled_indexes[path] = records
+        return records
+
+    records = compile_index(fn)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    remove_stale_compiled_indexes(fn, cache_dir, path)
+    loaded_compiled_indexes[path] = records
+    return records
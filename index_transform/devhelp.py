@@ -59,7 +59,21 @@ class Index2Devhelp(IndexTransform):
 
 
 def transform_devhelp(book_title, book_name, book_base, rel_link, chapters_fn,
-                      in_fn):
+                      in_fn, cache_dir=None):
+    root_el, functions_el = make_devhelp_book(book_title, book_name,
+                                              book_base, rel_link,
+                                              chapters_fn)
+
+    tr = Index2Devhelp(functions_el)
+    tr.transform_file(in_fn, cache_dir)
+
+    return format_devhelp_book(root_el)
+
+
+def make_devhelp_book(book_title, book_name, book_base, rel_link,
+                      chapters_fn):
+    # Returns the root element of a devhelp book that includes the given
+    # chapters and the empty element that Index2Devhelp fills with keywords
     root_el = etree.Element('book')
     root_el.set('xmlns', 'http://www.devhelp.net/book')
     root_el.set('title', book_title)
@@ -73,9 +87,9 @@ def transform_devhelp(book_title, book_name, book_base, rel_link, chapters_fn,
     root_el.append(chapters_tree.getroot())
 
     functions_el = etree.SubElement(root_el, 'functions')
+    return root_el, functions_el
 
-    tr = Index2Devhelp(functions_el)
-    tr.transform_file(in_fn)
 
+def format_devhelp_book(root_el):
     return etree.tostring(root_el, pretty_print=True, xml_declaration=True,
                           encoding='utf-8')
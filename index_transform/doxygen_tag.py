@@ -20,7 +20,10 @@
 
 from functools import total_ordering
 
+from lxml import etree
+
 from index_transform.common import IndexTransform
+from link_map import LinkMap
 from xml_utils import xml_escape
 
 
@@ -188,3 +191,50 @@ class Index2DoxygenTag(IndexTransform):
         if item_kind is not None:
             add_to_map(self.ns_map, full_name, full_link, item_kind)
         IndexTransform.process_item_hook(self, el, full_name, full_link)
+
+
+def transform_doxygen_tag(out_f, link_map_fn, in_fn, chapters_fn,
+                          cache_dir=None):
+    link_map = load_link_map(link_map_fn)
+
+    ns_map = Item()
+    write_doxygen_tag_header(out_f, chapters_fn)
+
+    tr = Index2DoxygenTag(ns_map)
+    tr.transform_file(in_fn, cache_dir)
+    write_doxygen_tag_map(out_f, link_map, ns_map)
+
+
+def load_link_map(link_map_fn):
+    # Returns the link map to remap the links with or None for 'web'
+    if link_map_fn == 'web':
+        return None
+    link_map = LinkMap()
+    link_map.read(link_map_fn)
+    return link_map
+
+
+def write_doxygen_tag_header(out_f, chapters_fn):
+    # Writes the beginning of the tag file up to the namespace map
+    out_f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n')
+    out_f.write('<tagfile>\n')
+
+    with open(chapters_fn, encoding='utf-8') as chapters_f:
+        chapters_tree = etree.parse(chapters_f)
+        for header_chapter in \
+                chapters_tree.getroot().findall(".//*[@name='Headers']/*"):
+            out_f.write('  <compound kind="file">\n')
+            out_f.write('    <name>{0}</name>\n'.format(
+                header_chapter.attrib['name']))
+            out_f.write('    <filename>{0}</filename>\n'.format(
+                header_chapter.attrib['link']))
+            out_f.write('    <namespace>std</namespace>\n')
+            out_f.write('  </compound>\n')
+
+
+def write_doxygen_tag_map(out_f, link_map, ns_map):
+    # Writes the namespace map filled by Index2DoxygenTag and the end of the
+    # tag file
+    print_map(out_f, link_map, ns_map)
+    out_f.write('''</tagfile>
+''')
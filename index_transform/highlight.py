@@ -23,7 +23,8 @@ from index_transform.common import IndexTransform
 
 class Index2Highlight(IndexTransform):
     def __init__(self, out_file):
-        super().__init__()
+        # do not walk the inheritance hierarchy
+        super().__init__(ignore_inherits=True)
         self.out_file = out_file
 
     def check_is_member(self, el):
@@ -54,6 +55,3 @@ class Index2Highlight(IndexTransform):
             self.out_file.write(full_name + ' => ' + full_link + '\n')
 
         IndexTransform.process_item_hook(self, el, full_name, full_link)
-
-    def inherits_worker(self, parent_name, pending, finished=list()):
-        pass  # do not walk the inheritance hierarchy
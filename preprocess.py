@@ -19,10 +19,13 @@
 
 import argparse
 import concurrent.futures
+import fnmatch
 import os
 import shutil
 
 from commands import preprocess
+from commands import preprocess_cssless
+from commands.pipeline_stats import PipelineStats
 
 
 def main():
@@ -34,48 +37,194 @@ def main():
     parser.add_argument(
         '--dst', type=str,
         help='Destination folder to put preprocessed archive to')
-    args = parser.parse_args()
 
-    root = args.dst
-    src = args.src
+    parser.add_argument(
+        '--manifest', type=str, default=None,
+        help='Path to the manifest file of the previous run. If set, only '
+             'the HTML files whose inputs have changed since that run are '
+             'preprocessed again. The manifest is updated afterwards')
 
-    # copy the source tree
-    preprocess.rmtree_if_exists(root)
-    shutil.copytree(src, root)
+    parser.add_argument(
+        '--direct', action='store_true', default=False,
+        help='If set, the HTML files are preprocessed straight from the '
+             'source directory into the rearranged destination and the '
+             'remaining files are hardlinked instead of copied')
 
-    preprocess.rearrange_archive(root)
+    parser.add_argument(
+        '--chunk_size', type=int, default=16,
+        help='The number of HTML files that are sent to a worker process at '
+             'once')
 
-    rename_map = preprocess.build_rename_map(root)
-    preprocess.rename_files(root, rename_map)
+    parser.add_argument(
+        '--assets', action='store_true', default=False,
+        help='If set, the CSS and JavaScript files of the MediaWiki loader '
+             'are minified and renamed to names that include a hash of '
+             'their contents')
 
-    # clean the html files
-    file_list = preprocess.find_html_files(root)
+    parser.add_argument(
+        '--cssless_dst', type=str, default=None,
+        help='If set, the preprocessed HTML files are additionally '
+             'transformed as by preprocess_qch.py and written to the given '
+             'folder, without reading and parsing them again')
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [
-            executor.submit(preprocess.preprocess_html_file,
-                            root, fn, rename_map)
-            for fn in file_list
-        ]
+    parser.add_argument(
+        '--stats', type=str, default=None,
+        help='If set, per-pass timings and counters are collected and '
+             'written to the given file as a JSON report')
+    args = parser.parse_args()
 
-        for future in futures:
-            output = future.result()
-            if len(output) > 0:
-                print(output)
+    if args.chunk_size < 1:
+        parser.error('--chunk_size must be at least 1')
+
+    root = args.dst
+    src = args.src
+
+    site_modules_css = os.path.join(root, 'common/site_modules.css')
+    ext_css = os.path.join(root, 'common/ext.css')
+    startup_script = os.path.join(root, 'common/startup_scripts.js')
+    modified_files = [site_modules_css, ext_css, startup_script]
+
+    # keep the output of the previous run if it can be reused
+    old_manifest = None
+    prev_root = root.rstrip('/') + '.prev'
+    preprocess.rmtree_if_exists(prev_root)
+    if args.manifest is not None and os.path.isdir(root):
+        old_manifest = preprocess.load_manifest(args.manifest)
+        if old_manifest is not None:
+            os.rename(root, prev_root)
+            # an interrupted run must not leave a stale manifest behind
+            os.remove(args.manifest)
+
+    preprocess.rmtree_if_exists(root)
+    if args.cssless_dst is not None:
+        preprocess.rmtree_if_exists(args.cssless_dst)
+
+    if args.direct:
+        # hardlink everything except the HTML files which are preprocessed
+        # directly from the source tree. Files that are modified afterwards
+        # are copied so that the source tree is left untouched.
+        src_inventory = preprocess.FileInventory.scan(src)
+        layout = preprocess.build_direct_layout(src_inventory, root)
+        inventory = preprocess.FileInventory.from_layout(root, layout)
+        rename_map = inventory.build_rename_map()
+        layout = preprocess.build_direct_layout(src_inventory, root,
+                                                rename_map)
+
+        file_list = []
+        for src_fn, fn in layout:
+            if fnmatch.fnmatch(fn, '*.html'):
+                file_list.append((src_fn, fn))
+            elif fn in modified_files:
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                shutil.copy(src_fn, fn)
+            else:
+                preprocess.link_or_copy_file(src_fn, fn)
+    else:
+        # copy the source tree
+        shutil.copytree(src, root)
+
+        preprocess.rearrange_archive(root)
+
+        inventory = preprocess.FileInventory.scan(root)
+        rename_map = inventory.build_rename_map()
+        plan = inventory.apply_renames(rename_map)
+        print('Renamed {0} files'.format(len(plan)))
+
+        # clean the html files
+        file_list = [(fn, fn) for fn in inventory.find_html_files()]
 
     # append css modifications
-    with open(os.path.join(root, 'common/site_modules.css'), "a") as out:
+    with open(site_modules_css, "a") as out:
         with open("preprocess-css.css", "r") as pp:
             out.writelines(pp)
 
     # clean the css files
 
-    for fn in [os.path.join(root, 'common/site_modules.css'),
-               os.path.join(root, 'common/ext.css')]:
+    for fn in [site_modules_css, ext_css]:
         preprocess.preprocess_css_file(fn)
 
-    preprocess.preprocess_startup_script(
-        os.path.join(root, 'common/startup_scripts.js'))
+    preprocess.preprocess_startup_script(startup_script)
+
+    # the assets are processed before the HTML files so that the links to
+    # them can be transformed to their final names
+    asset_map = None
+    if args.assets:
+        asset_map = preprocess.process_assets(root)
+
+    if args.manifest is not None:
+        manifest = preprocess.build_manifest(root, rename_map, file_list,
+                                             asset_map)
+
+        unchanged = set()
+        for rel_fn in preprocess.get_unchanged_files(old_manifest, manifest):
+            prev_fn = os.path.join(prev_root, rel_fn)
+            fn = os.path.join(root, rel_fn)
+            if os.path.isfile(prev_fn):
+                os.makedirs(os.path.dirname(fn), exist_ok=True)
+                os.replace(prev_fn, fn)
+                unchanged.add(fn)
+
+        print('Reusing {0} of {1} preprocessed HTML files'.format(
+            len(unchanged), len(file_list)))
+        file_list = [(src_fn, fn) for src_fn, fn in file_list
+                     if fn not in unchanged]
+        preprocess.rmtree_if_exists(prev_root)
+        reused_files = sorted(unchanged)
+    else:
+        reused_files = []
+
+    # the style sheets of the cssless transforms are parsed once and shared
+    # with all workers
+    stylesheets = None
+    if args.cssless_dst is not None:
+        css_paths = []
+        for dir, _, files in os.walk(root):
+            css_paths.extend(os.path.join(dir, fn) for fn in files
+                             if fn.endswith('.css'))
+        stylesheets = preprocess_cssless.StyleSheetCache()
+        stylesheets.add_files(sorted(css_paths))
+
+    # the rename map is sent to each worker process only once, the files are
+    # sent in chunks to reduce the communication overhead
+    chunks = preprocess.split_into_chunks(file_list, args.chunk_size)
+    with concurrent.futures.ProcessPoolExecutor(
+            initializer=preprocess.init_html_worker,
+            initargs=(root, rename_map, args.stats is not None,
+                      asset_map, args.cssless_dst,
+                      stylesheets)) as executor:
+        futures = [
+            executor.submit(preprocess.preprocess_html_chunk, chunk)
+            for chunk in chunks
+        ]
+        if args.cssless_dst is not None:
+            # the reused files have not been transformed by the cssless
+            # transforms yet
+            futures += [
+                executor.submit(preprocess.preprocess_cssless_chunk, chunk)
+                for chunk in preprocess.split_into_chunks(reused_files,
+                                                          args.chunk_size)
+            ]
+
+        pass_counts = dict()
+        stats = PipelineStats()
+        for future in concurrent.futures.as_completed(futures):
+            outputs, chunk_pass_counts, chunk_stats = future.result()
+            for output in outputs:
+                print(output)
+            for name, count in chunk_pass_counts.items():
+                pass_counts[name] = pass_counts.get(name, 0) + count
+            if chunk_stats is not None:
+                stats.merge(chunk_stats)
+
+    for name, _, _ in preprocess.CLEANUP_PASSES:
+        print('Cleanup pass {0} modified {1} of {2} pages'.format(
+            name, pass_counts.get(name, 0), len(file_list)))
+
+    if args.stats is not None:
+        stats.write(args.stats)
+
+    if args.manifest is not None:
+        preprocess.save_manifest(args.manifest, manifest)
 
 
 if __name__ == "__main__":
@@ -23,6 +23,9 @@ import os
 import shutil
 
 from commands import preprocess_cssless
+from commands.pipeline_stats import PipelineStats
+from commands.pipeline_stats import ProgressReporter
+from commands.pipeline_stats import run_bounded
 
 
 def main():
@@ -38,6 +41,47 @@ def main():
     parser.add_argument(
         '--verbose', action='store_true', default=False,
         help='If set, verbose output is produced')
+
+    parser.add_argument(
+        '--compact', action='store_true', default=False,
+        help='If set, the redundant declarations of the inline styles are '
+             'dropped and the pages are written without indentation')
+
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='If set, the preprocessed pages are cached in the given '
+             'directory and reused if neither the page, nor the style sheets, '
+             'nor the preprocessing code have changed')
+
+    parser.add_argument(
+        '--max_in_flight', type=int, default=None,
+        help='The maximum number of pages that are queued or being processed '
+             'at any time. Four times the number of CPUs by default')
+
+    parser.add_argument(
+        '--num_slowest', type=int, default=10,
+        help='The number of the slowest pages to list at the end')
+
+    parser.add_argument(
+        '--stats', type=str, default=None,
+        help='If set, per-pass timings and counters are collected and '
+             'written to the given file as a JSON report')
+
+    parser.add_argument(
+        '--style_cache', type=str, default=None,
+        help='Path to the file the caches of the inline style helpers are '
+             'persisted to. If it exists, the caches are preloaded from it')
+
+    parser.add_argument(
+        '--style_cache_size', type=int, default=None,
+        help='The maximum number of entries in each cache of the inline '
+             'style helpers. Unbounded by default')
+
+    parser.add_argument(
+        '--style_cache_eviction', type=str, default='lru',
+        choices=preprocess_cssless.STYLE_CACHE_EVICTION_POLICIES,
+        help='The policy of evicting entries from the bounded caches of the '
+             'inline style helpers')
     args = parser.parse_args()
 
     source_root = args.src
@@ -48,6 +92,7 @@ def main():
         shutil.rmtree(dest_root)
 
     paths_list = []
+    css_paths = []
     for root, _, files in os.walk(source_root):
         for file in files:
             if file.endswith(".html"):
@@ -55,21 +100,78 @@ def main():
                 rel_path = os.path.relpath(src_path, source_root)
                 dst_path = os.path.join(dest_root, rel_path)
                 paths_list.append((src_path, dst_path))
+            elif file.endswith(".css"):
+                css_paths.append(os.path.join(root, file))
+
+    cache = None
+    cache_keys = dict()
+    if args.cache_dir is not None:
+        cache = preprocess_cssless.CsslessOutputCache(
+            args.cache_dir, source_root, css_paths, args.compact)
+        missed_paths = []
+        for src_path, dst_path in paths_list:
+            key = cache.get_key(src_path)
+            if not cache.materialize(key, dst_path):
+                cache_keys[dst_path] = key
+                missed_paths.append((src_path, dst_path))
+        print('Reusing {0} of {1} preprocessed HTML files'.format(
+            len(paths_list) - len(missed_paths), len(paths_list)))
+        paths_list = missed_paths
+
+    # the style sheets are parsed once and shared with all workers
+    stylesheets = preprocess_cssless.StyleSheetCache()
+    if len(paths_list) > 0:
+        output = stylesheets.add_files(sorted(css_paths))
+        if verbose:
+            print(output)
+
+    stats = PipelineStats()
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        futures = [
-            executor.submit(preprocess_cssless.preprocess_html_merge_cssless,
-                            src_path, dst_path)
-            for src_path, dst_path in paths_list
-        ]
-
-        for i, future in enumerate(futures):
-            print('Processing file: {}/{}: {}'.format(
-                    i, len(paths_list), paths_list[i][1]))
-            output = future.result()
+    max_in_flight = args.max_in_flight
+    if max_in_flight is None:
+        max_in_flight = 4 * (os.cpu_count() or 1)
+
+    style_cache_tables = None
+    if args.style_cache is not None:
+        style_cache_tables = \
+            preprocess_cssless.load_style_caches(args.style_cache)
+    style_cache_report = preprocess_cssless.StyleCacheReport(
+        style_cache_tables)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            initializer=preprocess_cssless.init_cssless_worker,
+            initargs=(stylesheets, args.stats is not None,
+                      (args.style_cache_size, args.style_cache_eviction),
+                      style_cache_tables,
+                      args.style_cache is not None,
+                      args.compact)) as executor:
+        progress = ProgressReporter(len(paths_list), args.num_slowest)
+        results = run_bounded(
+            executor, preprocess_cssless.preprocess_html_merge_cssless_task,
+            paths_list, max_in_flight)
+
+        for (src_path, dst_path), result in results:
+            output, elapsed, page_stats, style_cache_updates = result
+            print('Processed file: ' + progress.update(dst_path, elapsed))
+            if cache is not None:
+                cache.store(cache_keys[dst_path], dst_path)
+            if page_stats is not None:
+                stats.merge(page_stats)
+            style_cache_report.add(style_cache_updates)
             if verbose:
                 print(output)
 
+    print(progress.format_summary())
+    print(style_cache_report.format())
+
+    if args.stats is not None:
+        stats.write(args.stats)
+
+    if args.style_cache is not None:
+        preprocess_cssless.save_style_caches(
+            args.style_cache,
+            style_cache_report.get_tables(args.style_cache_size))
+
 
 if __name__ == "__main__":
     main()
@@ -16,6 +16,7 @@
 #   along with this program.  If not, see http://www.gnu.org/licenses/.
 
 import os
+import tempfile
 import unittest
 
 from index_transform.devhelp import transform_devhelp
@@ -43,3 +44,22 @@ class TestTransformDevhelp(unittest.TestCase):
                 result_f.write(result)
 
         self.assertEqual(expected, result)
+
+    def test_transform_devhelp_compiled(self):
+        dir_path = os.path.dirname(__file__)
+        chapters_fn = os.path.join(
+            dir_path, 'transform_data/index-chapters-cpp.xml')
+        functions_fn = os.path.join(
+            dir_path, 'transform_data/index-functions-cpp.xml')
+        expected_path = os.path.join(
+            dir_path, 'devhelp_data/expected.xml')
+
+        with open(expected_path, 'rb') as expected_f:
+            expected = expected_f.read()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            result = transform_devhelp('book_title', 'book_name',
+                                       'book_base', 'rel_link', chapters_fn,
+                                       functions_fn, cache_dir=cache_dir)
+
+        self.assertEqual(expected, result)
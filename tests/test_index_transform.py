@@ -0,0 +1,400 @@
+#   Copyright (C) 2026  agent <agent@local>
+#
+#   This file is part of cppreference-doc
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see http://www.gnu.org/licenses/.
+import os
+import pickle
+import tempfile
+import unittest
+import unittest.mock
+
+from lxml import etree
+
+from index_transform.common import IndexTransform
+from index_transform.common import IndexTransformGroup
+from index_transform.common import is_group
+from index_transform.common import compile_index
+from index_transform.common import get_compiled_index_path
+from index_transform.common import load_compiled_index
+
+
+class TestGetAlias(unittest.TestCase):
+    def setUp(self):
+        self.root = etree.fromstring(
+            '<index>'
+            '<class name="std::a" link="a"/>'
+            '<enum name="std::e" link="e"/>'
+            '<class name="std::dup" link="d1"/>'
+            '<class name="std::dup" link="d2"/>'
+            '<class name="std::b" link="b">'
+            '<class name="std::nested" link="n"/>'
+            '<typedef name="t" alias="std::a"/>'
+            '</class>'
+            '</index>')
+        self.typedef = self.root.find('class/typedef')
+
+    def test_finds_top_level_classes_and_enums(self):
+        tr = IndexTransform()
+        self.assertEqual('a', tr.get_alias(self.typedef, 'std::a').get('link'))
+        self.assertEqual('e', tr.get_alias(self.typedef, 'std::e').get('link'))
+
+    def test_missing_and_ambiguous(self):
+        tr = IndexTransform()
+        with self.assertRaisesRegex(Exception, 'No aliases found'):
+            tr.get_alias(self.typedef, 'std::nested')
+        with self.assertRaisesRegex(Exception, 'More than one alias'):
+            tr.get_alias(self.typedef, 'std::dup')
+
+    def test_other_document(self):
+        tr = IndexTransform()
+        tr.get_alias(self.typedef, 'std::a')
+        other = etree.fromstring(
+            '<index><class name="std::a" link="other"/></index>')
+        self.assertEqual('other', tr.get_alias(other, 'std::a').get('link'))
+
+
+class TestAnnotate(unittest.TestCase):
+    def setUp(self):
+        self.root = etree.fromstring(
+            '<index>'
+            '<class name="a" link="a">'
+            '<inherits name="b"/>'
+            '<function name="f"/>'
+            '<!-- comment -->'
+            '<inherits name="c"/>'
+            '<enum name="e"><const name="v"/></enum>'
+            '</class>'
+            '<class name="b" link="b"/>'
+            '<class name="c" link="c"/>'
+            '<function name="g" link="g"/>'
+            '</index>')
+
+    def test_element_info(self):
+        tr = IndexTransform()
+        tr.annotate(self.root)
+        a = self.root[0]
+        f = a.find('function')
+        e = a.find('enum')
+        v = e.find('const')
+        g = self.root.find('function')
+        for el in [self.root, a, f, e, v, g]:
+            self.assertEqual(is_group(el), tr.is_group(el))
+        self.assertEqual((0, False, None), tr.get_element_info(self.root))
+        self.assertEqual((1, True, a), tr.get_element_info(a))
+        self.assertEqual((2, False, a), tr.get_element_info(f))
+        self.assertEqual((2, True, a), tr.get_element_info(e))
+        self.assertEqual((3, False, a), tr.get_element_info(v))
+        self.assertEqual((1, False, None), tr.get_element_info(g))
+
+    def test_inherits(self):
+        tr = IndexTransform()
+        tr.annotate(self.root)
+        a = self.root[0]
+        self.assertEqual(a.findall('inherits'), tr.get_inherits(a))
+        self.assertEqual([], tr.get_inherits(self.root.find('function')))
+        self.assertEqual(['a', 'b', 'c'], sorted(tr.aliases))
+
+    def test_annotates_lazily(self):
+        tr = IndexTransform()
+        a = self.root[0]
+        self.assertEqual(a.findall('inherits'), tr.get_inherits(a))
+        other = etree.fromstring('<index><class name="x"/></index>')
+        self.assertTrue(tr.is_group(other[0]))
+        self.assertIs(other, tr.alias_root)
+
+
+class RecordingTransform(IndexTransform):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.items = []
+
+    def process_item_hook(self, el, full_name, full_link):
+        self.items.append((full_name, full_link))
+        IndexTransform.process_item_hook(self, el, full_name, full_link)
+
+
+class TestInheritsWorker(unittest.TestCase):
+    def setUp(self):
+        # diamond: d -> (b, c) -> a, c also defines operator= and a
+        # constructor, which are not inherited
+        self.root = etree.fromstring(
+            '<index>'
+            '<class name="a" link="a"><function name="fa"/></class>'
+            '<class name="b" link="b"><inherits name="a"/>'
+            '<function name="fb"/></class>'
+            '<class name="c" link="c"><inherits name="a"/>'
+            '<function name="fc"/><function name="operator="/>'
+            '<constructor/></class>'
+            '<class name="d" link="d"><inherits name="b"/>'
+            '<inherits name="c"/><function name="fd"/></class>'
+            '<typedef name="t" alias="d"/>'
+            '</index>')
+
+    def test_diamond(self):
+        tr = RecordingTransform()
+        tr.transform_xml(self.root)
+        d_items = [i for i in tr.items if i[0].startswith('d::')]
+        self.assertEqual([('d::fb', 'b/fb'), ('d::fc', 'c/fc'),
+                          ('d::fa', 'a/fa'), ('d::fd', 'd/fd')], d_items)
+        t_items = [i for i in tr.items if i[0].startswith('t::')]
+        self.assertEqual([('t::' + n[3:], link) for n, link in d_items],
+                         t_items)
+
+    def test_members_are_cached(self):
+        tr = IndexTransform()
+        tr.annotate(self.root)
+        pending = self.root.xpath('/index/class[@name="d"]/inherits')
+        members = tr.get_inherited_members(pending)
+        self.assertIs(members, tr.get_inherited_members(pending))
+        self.assertEqual(['fb', 'fc', 'fa'],
+                         [m.get('name') for m, link in members])
+
+    def test_finished(self):
+        tr = IndexTransform()
+        tr.annotate(self.root)
+        pending = self.root.xpath('/index/class[@name="d"]/inherits')
+        a = self.root.xpath('/index/class[@name="a"]')
+        members = tr.get_inherited_members(pending, a)
+        self.assertEqual(['fb', 'fc'],
+                         [m.get('name') for m, link in members])
+
+
+class StructureTransform(RecordingTransform):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.depth = 0
+
+    def process_item_hook(self, el, full_name, full_link):
+        self.items.append((self.depth, el.tag, el.get('link'),
+                           el.getparent().tag, full_name, full_link))
+        self.depth += 1
+        IndexTransform.process_item_hook(self, el, full_name, full_link)
+        self.depth -= 1
+
+
+class TestCompiledIndex(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(__file__)
+        self.index_fn = os.path.join(
+            dir_path, 'transform_data/index-functions-cpp.xml')
+
+    def test_replay_matches_walk(self):
+        records = compile_index(self.index_fn)
+        for ignore_typedefs in [False, True]:
+            for ignore_inherits in [False, True]:
+                kwargs = {'ignore_typedefs': ignore_typedefs,
+                          'ignore_inherits': ignore_inherits}
+                expected = StructureTransform(**kwargs)
+                expected.transform_file(self.index_fn)
+                result = StructureTransform(**kwargs)
+                result.transform_compiled(records)
+                self.assertEqual(expected.items, result.items, kwargs)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = get_compiled_index_path(self.index_fn, cache_dir)
+            self.assertFalse(os.path.exists(path))
+
+            expected = RecordingTransform()
+            expected.transform_file(self.index_fn)
+            result = RecordingTransform()
+            result.transform_file(self.index_fn, cache_dir)
+            self.assertEqual(expected.items, result.items)
+            self.assertTrue(os.path.exists(path))
+
+            records = load_compiled_index(self.index_fn, cache_dir)
+            self.assertIs(records,
+                          load_compiled_index(self.index_fn, cache_dir))
+            result = RecordingTransform()
+            result.transform_compiled(records)
+            self.assertEqual(expected.items, result.items)
+            self.assertEqual([os.path.basename(path)], os.listdir(cache_dir))
+
+    def test_cache_unreadable(self):
+        expected = RecordingTransform()
+        expected.transform_file(self.index_fn)
+
+        def get_items(records):
+            result = RecordingTransform()
+            result.transform_compiled(records)
+            return result.items
+
+        records = compile_index(self.index_fn)
+        for data in [b'', b'garbage', pickle.dumps({'records': records}),
+                     pickle.dumps([('stale record',)])]:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                path = get_compiled_index_path(self.index_fn, cache_dir)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                self.assertEqual(expected.items, get_items(
+                    load_compiled_index(self.index_fn, cache_dir)))
+                # the unreadable file has been replaced
+                with open(path, 'rb') as f:
+                    self.assertEqual(expected.items,
+                                     get_items(pickle.load(f)))
+
+    def test_cache_code_version(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = get_compiled_index_path(self.index_fn, cache_dir)
+            load_compiled_index(self.index_fn, cache_dir)
+
+            with unittest.mock.patch(
+                    'index_transform.common.get_code_version',
+                    return_value='changed code'):
+                changed_path = get_compiled_index_path(self.index_fn,
+                                                       cache_dir)
+                load_compiled_index(self.index_fn, cache_dir)
+            self.assertNotEqual(path, changed_path)
+            self.assertEqual([os.path.basename(changed_path)],
+                             os.listdir(cache_dir))
+
+    def test_cache_remove_stale(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            stale = 'index-functions-cpp-' + '0' * 64 + '.pickle'
+            kept = ['index-functions-c-' + '0' * 64 + '.pickle',
+                    'index-functions-cpp-extra-' + '0' * 64 + '.pickle',
+                    'other.txt']
+            for name in [stale] + kept:
+                with open(os.path.join(cache_dir, name), 'wb'):
+                    pass
+            path = get_compiled_index_path(self.index_fn, cache_dir)
+            load_compiled_index(self.index_fn, cache_dir)
+            self.assertEqual(sorted(kept + [os.path.basename(path)]),
+                             sorted(os.listdir(cache_dir)))
+
+
+class NoClassChildrenTransform(StructureTransform):
+    # does not process the children of classes
+    def process_item_hook(self, el, full_name, full_link):
+        if el.tag == 'class':
+            self.items.append((self.depth, el.tag, full_name))
+            return
+        super().process_item_hook(el, full_name, full_link)
+
+
+class TestIndexTransformGroup(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(__file__)
+        self.index_fn = os.path.join(
+            dir_path, 'transform_data/index-functions-cpp.xml')
+
+    def make_transforms(self):
+        return [StructureTransform(),
+                NoClassChildrenTransform(),
+                StructureTransform(ignore_typedefs=True),
+                StructureTransform(ignore_inherits=True),
+                RecordingTransform(ignore_typedefs=True,
+                                   ignore_inherits=True)]
+
+    def test_matches_separate_replays(self):
+        records = compile_index(self.index_fn)
+        expected = self.make_transforms()
+        for tr in expected:
+            tr.transform_compiled(records)
+
+        result = self.make_transforms()
+        IndexTransformGroup(result).transform_compiled(records)
+        for expected_tr, result_tr in zip(expected, result):
+            self.assertEqual(expected_tr.items, result_tr.items)
+            self.assertIsNone(result_tr.children_handler)
+
+
+class TestIterItems(unittest.TestCase):
+    def setUp(self):
+        dir_path = os.path.dirname(__file__)
+        self.index_fn = os.path.join(
+            dir_path, 'transform_data/index-functions-cpp.xml')
+
+    def get_expected(self, **kwargs):
+        tr = StructureTransform(**kwargs)
+        tr.transform_file(self.index_fn)
+        return [(tag, full_name, full_link, depth)
+                for depth, tag, link, parent_tag, full_name, full_link
+                in tr.items]
+
+    def test_matches_walk(self):
+        for kwargs in [{}, {'ignore_typedefs': True},
+                       {'ignore_inherits': True}]:
+            tr = IndexTransform(**kwargs)
+            items = tr.iter_items(etree.parse(self.index_fn))
+            self.assertEqual(self.get_expected(**kwargs),
+                             [item[:4] for item in items], kwargs)
+
+    def test_walks_share_rules(self):
+        # a change of the walk applies to the hook transforms and to
+        # iter_items alike
+        class NoTypedefTargets(StructureTransform):
+            def iter_child_elements(self, el, parent_name, parent_link):
+                if el.tag == 'typedef':
+                    return iter(())
+                return StructureTransform.iter_child_elements(
+                    self, el, parent_name, parent_link)
+
+        expected = NoTypedefTargets()
+        expected.transform_file(self.index_fn)
+        items = NoTypedefTargets().iter_items(etree.parse(self.index_fn))
+        self.assertEqual(self.get_expected(ignore_typedefs=True),
+                         [(tag, full_name, full_link, depth)
+                          for depth, tag, link, parent_tag, full_name,
+                          full_link in expected.items])
+        self.assertEqual(self.get_expected(ignore_typedefs=True),
+                         [item[:4] for item in items])
+
+    def test_compiled_matches_walk(self):
+        records = compile_index(self.index_fn)
+        for kwargs in [{}, {'ignore_typedefs': True},
+                       {'ignore_inherits': True}]:
+            expected = [item[:5] for item in IndexTransform(**kwargs)
+                        .iter_items(etree.parse(self.index_fn))]
+            items = IndexTransform(**kwargs).iter_compiled_items(records)
+            self.assertEqual(expected, [item[:5] for item in items], kwargs)
+
+    def test_group(self):
+        root = etree.fromstring(
+            '<index>'
+            '<class name="a" link="a">'
+            '<function name="f"/>'
+            '<class name="b" link="b"><function name="g"/></class>'
+            '</class>'
+            '<function name="h" link="h"/>'
+            '</index>')
+        items = list(IndexTransform().iter_items(root))
+        self.assertEqual([('a', None), ('a::f', 'a'), ('a::b', 'a'),
+                          ('a::b::g', 'a::b'), ('h', None)],
+                         [(item.full_name, item.group) for item in items])
+        self.assertTrue(is_group(items[0].el))
+
+    def test_filter(self):
+        tr = IndexTransform()
+        items = list(tr.iter_items(etree.parse(self.index_fn),
+                                   tags=['function'], prefix='my::'))
+        expected = [(tag, full_name, full_link, depth)
+                    for tag, full_name, full_link, depth
+                    in self.get_expected()
+                    if tag == 'function' and full_name.startswith('my::')]
+        self.assertTrue(expected)
+        self.assertEqual(expected, [item[:4] for item in items])
+
+    def test_early_termination(self):
+        # the typedef is resolved only if the walk reaches it
+        root = etree.fromstring(
+            '<index>'
+            '<function name="f" link="f"/>'
+            '<typedef name="t" alias="missing"/>'
+            '</index>')
+        items = IndexTransform().iter_items(root)
+        self.assertEqual('f', next(items).full_name)
+        with self.assertRaisesRegex(Exception, 'No aliases found'):
+            next(items)
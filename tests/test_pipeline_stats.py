@@ -0,0 +1,88 @@
+#   Copyright (C) 2026  agent <agent@local>
+#
+#   This file is part of cppreference-doc
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see http://www.gnu.org/licenses/.
+
+import concurrent.futures
+import unittest
+
+from commands.pipeline_stats import PipelineStats
+from commands.pipeline_stats import ProgressReporter
+from commands.pipeline_stats import run_bounded
+
+
+class TestPipelineStats(unittest.TestCase):
+    def test_merge(self):
+        a = PipelineStats(num_slowest_pages=2)
+        a.add_pass('parse', 1.0, 10)
+        a.add_page('a.html', 3.0)
+        a.add_page('b.html', 1.0, num_warnings=2)
+
+        b = PipelineStats(num_slowest_pages=2)
+        b.add_pass('parse', 0.5, 5)
+        b.add_pass('write', 0.25)
+        b.add_page('c.html', 2.0)
+
+        a.merge(b)
+        report = a.to_json()
+        self.assertEqual(3, report['pages'])
+        self.assertEqual(2, report['warnings'])
+        self.assertEqual(6.0, report['total_time'])
+        self.assertEqual([
+            {'name': 'parse', 'time': 1.5, 'pages': 2, 'elements': 15},
+            {'name': 'write', 'time': 0.25, 'pages': 1, 'elements': 0},
+        ], report['passes'])
+        self.assertEqual([
+            {'page': 'a.html', 'time': 3.0},
+            {'page': 'c.html', 'time': 2.0},
+        ], report['slowest_pages'])
+
+
+class TestRunBounded(unittest.TestCase):
+    def test_bounded(self):
+        in_flight = []
+        max_in_flight = []
+
+        def task(i):
+            in_flight.append(i)
+            max_in_flight.append(len(in_flight))
+            return i * 2
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = []
+            for args, result in run_bounded(executor, task,
+                                            [(i,) for i in range(10)], 3):
+                # the task is consumed once its result has been taken
+                in_flight.remove(args[0])
+                results.append((args, result))
+
+        self.assertEqual([((i,), i * 2) for i in range(10)], sorted(results))
+        self.assertLessEqual(max(max_in_flight), 3)
+
+    def test_empty(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertEqual([], list(run_bounded(executor, abs, [], 4)))
+
+
+class TestProgressReporter(unittest.TestCase):
+    def test_slowest(self):
+        progress = ProgressReporter(3, num_slowest=2)
+        self.assertTrue(progress.update('a.html', 1.0).startswith('1/3 ('))
+        progress.update('b.html', 3.0)
+        self.assertTrue(progress.update('c.html', 2.0).endswith(
+            ', ETA 0:00:00): c.html'))
+
+        lines = progress.format_summary().split('\n')
+        self.assertEqual(['  3.000s b.html', '  2.000s c.html'], lines[1:])
@@ -21,17 +21,34 @@
 import contextlib
 import io
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 import unittest.mock
 
 from lxml import etree
 
+from commands.preprocess import CLEANUP_PASSES
+from commands.preprocess import FileInventory
+from commands.preprocess import HtmlVisitor
+from commands.preprocess import build_cleanup_visitor
+from commands.preprocess import build_direct_layout
+from commands.preprocess import build_manifest
 from commands.preprocess import build_rename_map
 from commands.preprocess import convert_loader_name
+from commands.preprocess import get_applicable_passes
+from commands.preprocess import get_rearranged_path
+from commands.preprocess import get_unchanged_files
 from commands.preprocess import has_class
+from commands.preprocess import init_html_worker
 from commands.preprocess import is_external_link
 from commands.preprocess import is_ranges_placeholder
+from commands.preprocess import LinkRewriter
+from commands.preprocess import minify_css
+from commands.preprocess import minify_js
+from commands.preprocess import preprocess_html_chunk
+from commands.preprocess import process_assets
 from commands.preprocess import remove_ads
 from commands.preprocess import remove_fileinfo
 from commands.preprocess import remove_google_analytics
@@ -39,8 +56,13 @@ from commands.preprocess import remove_noprint
 from commands.preprocess import remove_see_also
 from commands.preprocess import remove_unused_external
 from commands.preprocess import rename_files
+from commands.preprocess import split_into_chunks
+from commands.preprocess import transform_link
 from commands.preprocess import transform_ranges_placeholder
 from commands.preprocess import trasform_relative_link
+from commands.preprocess_cssless import StyleSheetCache
+from commands.preprocess_cssless import init_cssless_worker
+from commands.preprocess_cssless import preprocess_html_merge_cssless
 
 
 class DummyFile(object):
@@ -78,6 +100,26 @@ class TestConvertLoaderName(unittest.TestCase):
             convert_loader_name('')
 
 
+class TestGetRearrangedPath(unittest.TestCase):
+    def test_get_rearranged_path(self):
+        entries = [
+            ('en.cppreference.com/w/cpp/io.html', 'en/cpp/io.html'),
+            ('en.cppreference.com/mwiki/skins/common/images/a.png',
+             'common/skins/common/images/a.png'),
+            ('en.cppreference.com/DejaVuSansMonoCondensed60.ttf',
+             'common/DejaVuSansMonoCondensed60.ttf'),
+            ('en.cppreference.com/robots.txt', None),
+            ('upload.cppreference.com/mwiki/images/0/06/a.svg',
+             'common/images/0/06/a.svg'),
+            ('upload.cppreference.com/robots.txt', None),
+            ('cppreference-export-ns0,4,8,10.xml', None),
+            ('other.txt', 'other.txt'),
+        ]
+        for path, expected in entries:
+            self.assertEqual(expected, get_rearranged_path(path),
+                             msg="path='{}'".format(path))
+
+
 class TestHasClass(unittest.TestCase):
     def test_has_class(self):
         el = etree.Element('tag')
@@ -257,17 +299,23 @@ class TestPreprocessHtml(unittest.TestCase):
     def setUp(self):
         self.testdata = os.path.join(os.path.dirname(__file__),
                                      'preprocess_data')
-        infile = os.path.join(self.testdata, "fabs.html")
         self.parser = etree.HTMLParser()
-        self.html = etree.parse(infile, self.parser)
+        self.html = self.parse_input()
+
+    # Returns a freshly parsed tree of the input test data file
+    def parse_input(self):
+        infile = os.path.join(self.testdata, "fabs.html")
+        return etree.parse(infile, self.parser)
 
     # Check whether the HTML matches the contents of the specified test data
     # file
-    def check_output(self, expected_file):
+    def check_output(self, expected_file, html=None):
+        if html is None:
+            html = self.html
         with open(os.path.join(self.testdata, expected_file), 'rb') as f:
             expected = f.read()
         with io.BytesIO() as buf:
-            self.html.write(buf, encoding='utf-8', method='html')
+            html.write(buf, encoding='utf-8', method='html')
             actual = buf.getvalue()
 
         self.assertEqual(expected, actual)
@@ -296,8 +344,153 @@ class TestPreprocessHtml(unittest.TestCase):
         remove_unused_external(self.html)
         self.check_output("fabs_external.html")
 
-
-class TestFileRename(unittest.TestCase):
+    def test_fused_passes(self):
+        expected_files = {
+            'unused_external': "fabs_external.html",
+            'noprint': "fabs_noprint.html",
+            'see_also': "fabs_seealso.html",
+            'google_analytics': "fabs_ga.html",
+            'ads': "fabs_ads.html",
+            'fileinfo': "fabs_fileinfo.html",
+        }
+        for name, _, add_handlers in CLEANUP_PASSES:
+            with self.subTest(name=name):
+                html = self.parse_input()
+                visitor = HtmlVisitor()
+                add_handlers(visitor)
+                visitor.visit(html)
+                self.check_output(expected_files[name], html)
+
+    def test_get_applicable_passes(self):
+        self.assertEqual(['unused_external'],
+                         get_applicable_passes(b'<html><body></body></html>'))
+        self.assertEqual(['unused_external', 'ads', 'fileinfo'],
+                         get_applicable_passes(
+                             b'<div id="bsap_1"><a href="/w/File:a.png">'))
+
+        with open(os.path.join(self.testdata, "fabs.html"), 'rb') as f:
+            data = f.read()
+        self.assertEqual([name for name, _, _ in CLEANUP_PASSES],
+                         get_applicable_passes(data))
+
+    # Applies the cleanup passes one after another and rewrites the links
+    # like preprocess_html_file did before the passes were fused. Returns the
+    # names of the passes that have modified the tree
+    def apply_sequential_cleanup(self, html, rewriter, fn):
+        passes = [
+            ('unused_external', remove_unused_external),
+            ('noprint', remove_noprint),
+            ('see_also', remove_see_also),
+            ('google_analytics', remove_google_analytics),
+            ('ads', remove_ads),
+            ('fileinfo', remove_fileinfo),
+        ]
+        modified_passes = set()
+        for name, remove in passes:
+            before = etree.tostring(html, method='html')
+            remove(html)
+            if etree.tostring(html, method='html') != before:
+                modified_passes.add(name)
+
+        for el in html.xpath('//*[@src]'):
+            el.set('src', rewriter.rewrite(el.get('src'), fn))
+        for el in html.xpath('//*[@href]'):
+            el.set('href', rewriter.rewrite(el.get('href'), fn))
+        return modified_passes
+
+    def check_fused_cleanup(self, parse):
+        root = 'output'
+        fn = os.path.join(root, 'en/cpp/numeric/math/fabs.html')
+        rewriter = LinkRewriter(root, {})
+
+        html = parse()
+        expected_passes = self.apply_sequential_cleanup(html, rewriter, fn)
+        expected = etree.tostring(html, method='html')
+
+        html = parse()
+        visitor = build_cleanup_visitor(rewriter, fn)
+        visitor.visit(html)
+        self.assertEqual(expected, etree.tostring(html, method='html'))
+        self.assertEqual(expected_passes,
+                         visitor.modified_passes - {'rewrite_links'})
+
+    def test_fused_cleanup_matches_sequential(self):
+        self.check_fused_cleanup(self.parse_input)
+
+    def test_fused_cleanup_order(self):
+        # the passes that follow see_also must not see the elements that it
+        # removes and must not remove elements that it depends on
+        see_also_row = (
+            '<tr class="t-dsc"><td><div class="t-dsc-see">'
+            '{0}<a href="http://en.cppreference.com/w/c/fabs">fabs</a>'
+            '</div></td></tr>')
+        pages = [
+            # ads and file info links within see also rows
+            '<table class="t-dcl-list-begin">' +
+            see_also_row.format(
+                '<script src="http://carbonads.com/carbon.js"></script>') +
+            see_also_row.format(
+                '<span><a href="http://en.cppreference.com/w/File:a.png">'
+                '<img src="a.png"></a></span>') +
+            '</table>',
+
+            # a see also div that is also an ad
+            '<table class="t-dcl-list-begin"><tr class="t-dsc"><td>'
+            '<div class="t-dsc-see" id="bsap_1">see</div></td></tr></table>',
+
+            # an ad between a see also heading and its table
+            '<h3><span id="See_also">See also</span></h3>'
+            '<div id="bsap_2"></div>'
+            '<table class="t-dcl-list-begin">' + see_also_row.format('') +
+            '</table>',
+
+            # a Google Analytics script after a see also heading
+            '<h3><span id="See_also">See also</span></h3>'
+            '<script>pageTracker._trackPageview();</script>',
+
+            # file info links within an ad
+            '<div id="bsap_3"><span>'
+            '<a href="http://en.cppreference.com/w/File:b.png">b</a>'
+            '</span></div>',
+        ]
+        for body in pages:
+            with self.subTest(body=body):
+                self.check_fused_cleanup(lambda: etree.parse(
+                    io.StringIO('<html><head></head><body>' + body +
+                                '</body></html>'), self.parser))
+
+    def test_cssless_combined(self):
+        # the combined mode produces the same output as preprocess_qch.py
+        # run on the preprocessed pages
+        data_path = os.path.join(os.path.dirname(__file__),
+                                 'preprocess_cssless_data')
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'output')
+            cssless_root = os.path.join(dir, 'cssless')
+            shutil.copytree(data_path, root)
+            fn = os.path.join(root, 'multiset.html')
+
+            stylesheets = StyleSheetCache()
+            stylesheets.add_files([os.path.join(root, 'site_modules.css'),
+                                   os.path.join(root, 'ext.css')])
+            init_html_worker(root, {}, cssless_root=cssless_root,
+                             stylesheets=stylesheets)
+            try:
+                preprocess_html_chunk([(fn, fn)])
+                expected_fn = os.path.join(dir, 'expected.html')
+                preprocess_html_merge_cssless(fn, expected_fn)
+            finally:
+                init_html_worker(None, None)
+                init_cssless_worker(None)
+
+            with open(os.path.join(cssless_root, 'multiset.html'), 'rb') as f:
+                actual = f.read()
+            with open(expected_fn, 'rb') as f:
+                expected = f.read()
+            self.assertEqual(expected, actual)
+
+
+class FileRenameTestBase(unittest.TestCase):
     def make_rename_map(self, root):
         def p(*dirs):
             return os.path.join(root, 'dir1', *dirs)
@@ -356,6 +549,8 @@ class TestFileRename(unittest.TestCase):
               'load.php?modules=someext&only=styles'))
         ]
 
+
+class TestFileRename(FileRenameTestBase):
     def test_build_rename_map(self):
         with unittest.mock.patch('os.walk') as walk:
             walk.return_value = self.make_walk_result('output')
@@ -487,3 +682,276 @@ class TestFileRename(unittest.TestCase):
             self.assertEqual(expected,
                              trasform_relative_link(rename_map, target, file),
                              msg="target='{}', file='{}'".format(target, file))
+
+
+class TestFileInventory(FileRenameTestBase):
+    def make_inventory(self, root):
+        walk_result = self.make_walk_result(root)
+        dirs = dict((dir, list(filenames))
+                    for dir, _, filenames in walk_result)
+        return FileInventory(root, dirs)
+
+    def test_build_rename_map(self):
+        actual = self.make_inventory('output').build_rename_map()
+
+        expected = self.make_rename_map('output')
+        self.assertEqual(expected, actual)
+
+    def test_apply_renames(self):
+        expected = [
+            (('output/dir1/sub1/invalid*.txt',
+              'output/dir1/sub1/invalid_star_.txt'), {}),
+            (('output/dir1/sub2/Conflict.html',
+              'output/dir1/sub2/Conflict.2.html'), {}),
+            (('output/dir1/sub3/confl"ict".html',
+              'output/dir1/sub3/confl_q_ict_q_.html'), {}),
+            (('output/dir1/sub3/Confl"ict".html',
+              'output/dir1/sub3/Confl_q_ict_q_.2.html'), {}),
+            (('output/dir1/sub4/Conflict',
+              'output/dir1/sub4/Conflict.2'), {}),
+            (('output/dir1/sub4/conFlict',
+              'output/dir1/sub4/conFlict.3'), {}),
+            (('output/dir1/sub5/Conflict',
+              'output/dir1/sub5/Conflict.2'), {}),
+            (('output/dir1/sub6/load.php?modules=site&only=scripts',
+              'output/dir1/sub6/site_scripts.js'), {}),
+            (('output/dir1/sub6/load.php?modules=someext&only=styles',
+              'output/dir1/sub6/ext.css'), {})
+        ]
+
+        actual = []
+
+        def record_call(*args, **kwargs):
+            actual.append((args, kwargs))
+
+        inventory = self.make_inventory('output')
+        with unittest.mock.patch('os.rename') as rename:
+            rename.side_effect = record_call
+
+            with nostdout():
+                inventory.apply_renames(self.make_rename_map('output'))
+
+        self.assertEqual(expected, actual,
+                         msg="Unexpected sequence of calls to os.rename")
+
+        expected_html = [
+            'output/dir1/sub2/conflict.html',
+            'output/dir1/sub2/Conflict.2.html',
+            'output/dir1/sub3/confl_q_ict_q_.html',
+            'output/dir1/sub3/Confl_q_ict_q_.2.html',
+        ]
+        self.assertEqual(expected_html, inventory.find_html_files())
+
+    def test_scan(self):
+        with unittest.mock.patch('os.scandir') as scandir:
+            def entry(path, is_dir):
+                e = unittest.mock.Mock()
+                e.name = os.path.basename(path)
+                e.path = path
+                e.is_dir.return_value = is_dir
+                e.is_symlink.return_value = False
+                return e
+
+            listing = {
+                'output': [entry('output/a.html', False),
+                           entry('output/sub', True)],
+                'output/sub': [entry('output/sub/b.css', False)],
+            }
+
+            def fake_scandir(dir):
+                result = unittest.mock.MagicMock()
+                result.__enter__.return_value = iter(listing[dir])
+                return result
+
+            scandir.side_effect = fake_scandir
+            inventory = FileInventory.scan('output')
+
+        self.assertEqual({'output': ['a.html'], 'output/sub': ['b.css']},
+                         inventory.dirs)
+
+    def test_direct_layout(self):
+        inventory = FileInventory('src', {
+            'src': ['cppreference-export-a.xml'],
+            'src/en.cppreference.com/w/cpp': ['a.html', 'A.html'],
+            'src/en.cppreference.com/mwiki': [
+                'load.php?modules=site&only=scripts'],
+        })
+        with unittest.mock.patch('os.scandir') as scandir, \
+                unittest.mock.patch('os.walk') as walk:
+            layout = build_direct_layout(inventory, 'dst')
+            rename_map = \
+                FileInventory.from_layout('dst', layout).build_rename_map()
+            layout = build_direct_layout(inventory, 'dst', rename_map)
+        scandir.assert_not_called()
+        walk.assert_not_called()
+
+        expected = [
+            ('src/en.cppreference.com/w/cpp/a.html', 'dst/en/cpp/a.html'),
+            ('src/en.cppreference.com/w/cpp/A.html', 'dst/en/cpp/A.2.html'),
+            ('src/en.cppreference.com/mwiki/'
+             'load.php?modules=site&only=scripts',
+             'dst/common/site_scripts.js'),
+        ]
+        self.assertEqual(expected, layout)
+
+
+class TestAssets(unittest.TestCase):
+    def test_minify_css(self):
+        css = (
+            '/* comment */\n'
+            'div#content > p,  a:hover {\n'
+            '    font-family: "DejaVu  Sans", arial;\n'
+            '    margin: 0 auto ;\n'
+            '}\n'
+            '@media screen and (max-width: 10em) { .a\\ b { color: red } }\n'
+        )
+        self.assertEqual(
+            'div#content>p,a:hover{font-family: "DejaVu  Sans",arial;'
+            'margin: 0 auto}'
+            '@media screen and (max-width: 10em){.a\\ b{color: red}}\n',
+            minify_css(css))
+
+    def test_minify_js(self):
+        self.assertEqual('a = 1;\nif (a) {\nb();\n}\n',
+                         minify_js('  a = 1;  \n\nif (a) {\n    b();\n}\n'))
+        for js in ['a = `x\n  y`;\n', 'a = "x\\\n  y";\n']:
+            self.assertEqual(js, minify_js(js))
+
+    def test_process_assets(self):
+        with tempfile.TemporaryDirectory() as root:
+            common = os.path.join(root, 'common')
+            os.makedirs(common)
+            contents = {
+                'site_modules.css': 'a {  color: red; }\n',
+                'ext.css': 'b { color: blue }\n',
+                'site_scripts.js': 'f();\n',
+                'skin_scripts.js': '    f();\n',
+            }
+            for name, text in contents.items():
+                with open(os.path.join(common, name), 'w') as f:
+                    f.write(text)
+
+            asset_map = process_assets(root)
+
+            self.assertEqual(sorted(contents.keys()), sorted(asset_map))
+            self.assertRegex(asset_map['ext.css'], r'^ext\.[0-9a-f]{12}\.css$')
+            # identical contents after minification are merged
+            self.assertEqual(asset_map['site_scripts.js'],
+                             asset_map['skin_scripts.js'])
+            self.assertEqual(
+                sorted(set(asset_map.values())), sorted(os.listdir(common)))
+            with open(os.path.join(common, asset_map['site_modules.css'])) as f:
+                self.assertEqual('a{color: red}\n', f.read())
+
+    def test_link_rewriter(self):
+        rename_map = {
+            'load.php?modules=site&only=styles': 'site_modules.css',
+        }
+        asset_map = {'site_modules.css': 'site_modules.0123456789ab.css'}
+        rewriter = LinkRewriter('output', rename_map, asset_map=asset_map)
+        fn = 'output/en/cpp/a.html'
+        self.assertEqual(
+            '../../common/site_modules.0123456789ab.css',
+            rewriter.rewrite(
+                '../../common/load.php%3Fmodules=site&only=styles', fn))
+        self.assertEqual(
+            '../../common/site_modules.0123456789ab.css',
+            rewriter.rewrite('http://en.cppreference.com/mwiki/load.php?'
+                             'modules=site&only=styles', fn))
+
+
+class TestManifest(unittest.TestCase):
+    def make_manifest(self, version='v1', rename_map=None, files=None):
+        return {
+            'version': version,
+            'rename_map': rename_map or {'a*.html': 'a_star_.html'},
+            'files': files or {'en/a.html': '1', 'en/b.html': '2'}
+        }
+
+    def test_no_previous_manifest(self):
+        self.assertEqual([], get_unchanged_files(None, self.make_manifest()))
+
+    def test_unchanged(self):
+        old = self.make_manifest()
+        new = self.make_manifest()
+        self.assertEqual(['en/a.html', 'en/b.html'],
+                         sorted(get_unchanged_files(old, new)))
+
+    def test_changed_files(self):
+        old = self.make_manifest()
+        new = self.make_manifest(files={'en/a.html': '1', 'en/b.html': '3',
+                                        'en/c.html': '4'})
+        self.assertEqual(['en/a.html'], get_unchanged_files(old, new))
+
+    def test_changed_version(self):
+        old = self.make_manifest()
+        new = self.make_manifest(version='v2')
+        self.assertEqual([], get_unchanged_files(old, new))
+
+    def test_changed_rename_map(self):
+        old = self.make_manifest()
+        new = self.make_manifest(rename_map={'b*.html': 'b_star_.html'})
+        self.assertEqual([], get_unchanged_files(old, new))
+
+    def test_changed_asset_map(self):
+        old = self.make_manifest()
+        new = self.make_manifest()
+        new['asset_map'] = {'ext.css': 'ext.0123456789ab.css'}
+        self.assertEqual([], get_unchanged_files(old, new))
+
+    def test_package_versions(self):
+        def get_manifest(lxml_version):
+            with unittest.mock.patch(
+                    'commands.versioning.get_package_version',
+                    return_value=lxml_version):
+                return build_manifest('output', {}, [])
+
+        old = get_manifest('1.0')
+        self.assertEqual(old['version'], get_manifest('1.0')['version'])
+        self.assertNotEqual(old['version'], get_manifest('2.0')['version'])
+
+
+class TestSplitIntoChunks(unittest.TestCase):
+    def test_split_into_chunks(self):
+        self.assertEqual([], split_into_chunks([], 3))
+        self.assertEqual([[1, 2, 3]], split_into_chunks([1, 2, 3], 3))
+        self.assertEqual([[1, 2], [3]], split_into_chunks([1, 2, 3], 2))
+        self.assertEqual([[1], [2], [3]], split_into_chunks([1, 2, 3], 1))
+
+
+class TestLinkRewriter(unittest.TestCase):
+    def test_matches_transform_link(self):
+        root = 'output/reference'
+        rename_map = {
+            'invalid*.html': 'invalid_star_.html',
+            'output/reference/en/cpp/Conflict.html': 'Conflict.2.html',
+        }
+        files = [
+            'output/reference/index.html',
+            'output/reference/en/cpp.html',
+            'output/reference/en/cpp/io.html',
+            'output/reference/en/cpp/experimental/ranges.html',
+            'output/reference/en/cpp/experimental/ranges/View.html',
+            'output/reference/common/page.html',
+            'output/other/page.html',
+        ]
+        targets = [
+            'http://en.cppreference.com/mwiki/load.php?debug=false&lang=en&modules=site&only=scripts&skin=cppreference2&*',  # noqa
+            'http://en.cppreference.com/w/cpp/ranges-placeholder/concepts/Assignable',  # noqa
+            'http://en.cppreference.com/w/cpp/ranges-algorithm-placeholder/all_any_none_of',  # noqa
+            'https://example.com/a.html',
+            '../mwiki/site.css',
+            'invalid*.html',
+            'Conflict.html#p2',
+            'cpp/Conflict.html',
+            '../cpp/Conflict.html?a=b',
+        ]
+
+        rewriter = LinkRewriter(root, rename_map)
+        for i in range(2):  # the second time the results are cached
+            for file in files:
+                for target in targets:
+                    self.assertEqual(
+                        transform_link(rename_map, target, file, root),
+                        rewriter.rewrite(target, file),
+                        msg="target='{}', file='{}'".format(target, file))
@@ -15,20 +15,45 @@
 #   You should have received a copy of the GNU General Public License
 #   along with this program.  If not, see http://www.gnu.org/licenses/.
 
+import copy
 import os
+import pickle
+import tempfile
 import unittest
+import unittest.mock
+
+import cssutils
 
 from lxml import etree
 
+from premailer import Premailer
+
+from commands.preprocess_cssless import CsslessOutputCache
+from commands.preprocess_cssless import StyleCache
+from commands.preprocess_cssless import StyleCacheReport
+from commands.preprocess_cssless import StyleRuleIndex
+from commands.preprocess_cssless import StyleSheetCache
 from commands.preprocess_cssless import apply_font_size
+from commands.preprocess_cssless import check_premailer_compatibility
+from commands.preprocess_cssless import compact_inline_styles
+from commands.preprocess_cssless import convert_cssless_tree
 from commands.preprocess_cssless import convert_font_size_property_to_pt
 from commands.preprocess_cssless import convert_inline_block_elements_to_table
 from commands.preprocess_cssless import convert_span_tables_to_tr_td
 from commands.preprocess_cssless import \
     convert_table_border_top_to_tr_background
 from commands.preprocess_cssless import convert_zero_td_width_to_nonzero
+from commands.preprocess_cssless import get_page_features
+from commands.preprocess_cssless import get_selector_requirements
+from commands.preprocess_cssless import init_cssless_worker
+from commands.preprocess_cssless import load_style_caches
+from commands.preprocess_cssless import parse_inline_style
+from commands.preprocess_cssless import preprocess_html_merge_css
 from commands.preprocess_cssless import preprocess_html_merge_cssless
+from commands.preprocess_cssless import remove_display_none
+from commands.preprocess_cssless import save_style_caches
 from commands.preprocess_cssless import silence_cssutils_warnings
+from commands.preprocess_cssless import strip_style_tags
 
 
 class TestPreprocessHtmlMergeCss(unittest.TestCase):
@@ -72,6 +97,143 @@ class TestPreprocessHtmlMergeCss(unittest.TestCase):
         self.assertEqual(test, expected)
         os.remove(dst_path)
 
+    def test_shared_stylesheets(self):
+        dir_path = os.path.join(os.path.dirname(__file__),
+                                'preprocess_cssless_data')
+        stylesheets = StyleSheetCache()
+        stylesheets.add_files([os.path.join(dir_path, 'site_modules.css'),
+                               os.path.join(dir_path, 'ext.css')])
+        self.assertEqual(2, len(stylesheets.rule_sets))
+
+        # the cache is shared with the workers through pickling
+        init_cssless_worker(pickle.loads(pickle.dumps(stylesheets)))
+        try:
+            for name in ['multiset', 'basic_string', 'multiset']:
+                src_path = os.path.join(dir_path, name + '.html')
+                dst_path = os.path.join(dir_path, name + '_out.html')
+                expected_path = os.path.join(dir_path,
+                                             name + '_expected.html')
+
+                preprocess_html_merge_cssless(src_path, dst_path)
+
+                with open(dst_path, 'r') as a_file:
+                    test = a_file.read()
+                with open(expected_path, 'r') as a_file:
+                    expected = a_file.read()
+
+                self.assertEqual(test, expected)
+                os.remove(dst_path)
+        finally:
+            init_cssless_worker(None)
+
+
+class TestCsslessOutputCache(unittest.TestCase):
+    def write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'src')
+            cache_dir = os.path.join(dir, 'cache')
+            page = os.path.join(root, 'a/page.html')
+            other = os.path.join(root, 'b/page.html')
+            css = os.path.join(root, 'common/site.css')
+            self.write(page, '<html></html>')
+            self.write(other, '<html></html>')
+            self.write(css, 'p { color: red }')
+
+            cache = CsslessOutputCache(cache_dir, root, [css])
+            key = cache.get_key(page)
+            self.assertNotEqual(key, cache.get_key(other))
+
+            dst = os.path.join(dir, 'dst/a/page.html')
+            self.assertFalse(cache.materialize(key, dst))
+            self.write(dst, 'output')
+            cache.store(key, dst)
+
+            dst2 = os.path.join(dir, 'dst2/a/page.html')
+            self.assertTrue(cache.materialize(key, dst2))
+            self.assertEqual('output', self.read(dst2))
+
+            # the cached page is not affected by changes of the output
+            os.remove(dst)
+            self.write(dst, 'modified')
+            self.assertEqual('output', self.read(cache.get_path(key)))
+
+            self.write(page, '<html><body></body></html>')
+            self.assertNotEqual(key, cache.get_key(page))
+
+            self.write(page, '<html></html>')
+            self.assertEqual(key, cache.get_key(page))
+            self.write(css, 'p { color: blue }')
+            cache = CsslessOutputCache(cache_dir, root, [css])
+            self.assertNotEqual(key, cache.get_key(page))
+
+    def test_package_versions(self):
+        with tempfile.TemporaryDirectory() as dir:
+            root = os.path.join(dir, 'src')
+            page = os.path.join(root, 'a/page.html')
+            self.write(page, '<html></html>')
+
+            def get_key(changed_package=None):
+                def get_version(name):
+                    return '0.0' if name == changed_package else '1.0'
+
+                with unittest.mock.patch(
+                        'commands.versioning.get_package_version',
+                        get_version):
+                    return CsslessOutputCache(dir, root, []).get_key(page)
+
+            key = get_key()
+            self.assertEqual(key, get_key())
+            for package in ['premailer', 'cssutils', 'lxml']:
+                self.assertNotEqual(key, get_key(package), package)
+
+
+class TestStyleRuleIndex(unittest.TestCase):
+    def test_selector_requirements(self):
+        tests = [
+            ('div', [('tag', 'div')]),
+            ('DIV.a#b', [('tag', 'div'), ('.', 'a'), ('#', 'b')]),
+            ('.a > .b-c', [('.', 'b-c')]),
+            ('table tr+td ~ .a', [('.', 'a')]),
+            ('.a span', [('tag', 'span')]),
+            ('*', []),
+            ('a[href]', [('tag', 'a')]),
+            ('a[href="x y"]', []),
+            ('li.a:first-child', [('tag', 'li'), ('.', 'a')]),
+            # Premailer drops everything from the first colon on, unless it's
+            # one of the filtering pseudo classes
+            ('a:hover .b', [('tag', 'a')]),
+            ('li:first-child .a', [('tag', 'li')]),
+            ('.a:not(.b)', [('.', 'a')]),
+            ('.a\\:b', []),
+        ]
+        for selector, expected in tests:
+            with self.subTest(selector=selector):
+                self.assertEqual(expected, get_selector_requirements(selector))
+
+    def test_candidates(self):
+        rules = [((0, 0, 0, 0, i), selector, 'color:red')
+                 for i, selector in enumerate(
+                     ['div .a', '#b', 'span.c', '.a.d', 'a[href="x y"]'])]
+        index = StyleRuleIndex(rules)
+
+        root = etree.fromstring(
+            '<html><body><div class="a  d"><span id="b">x</span></div>'
+            '</body></html>', etree.HTMLParser())
+        features = get_page_features(root)
+        self.assertEqual([0, 1, 3, 4], index.get_candidates(features))
+        self.assertEqual([rules[i] for i in [0, 1, 3, 4]],
+                         index.filter(rules, features))
+        self.assertEqual(rules, index.filter(rules, None))
+
 
 class HTMLTestBase(unittest.TestCase):
     def setUp(self):
@@ -416,6 +578,322 @@ class TestConvertZeroTdWidthToNonzero(HTMLTestBase):
         self.assert_converts_html(input, expected, test_fun)
 
 
+def convert_cssless_tree_sequentially(root, default_size):
+    strip_style_tags(root)
+    remove_display_none(root)
+    convert_span_tables_to_tr_td(root)
+    convert_inline_block_elements_to_table(root)
+    convert_zero_td_width_to_nonzero(root)
+    convert_font_size_property_to_pt(root, default_size)
+    convert_table_border_top_to_tr_background(root)
+
+
+class TestConvertCsslessTree(HTMLTestBase):
+    def assert_same_as_sequential(self, root):
+        expected = copy.deepcopy(root)
+        convert_cssless_tree_sequentially(expected, 16)
+        convert_cssless_tree(root, 16)
+        self.assertEqual(etree.tostring(expected, encoding=str),
+                         etree.tostring(root, encoding=str))
+
+    def test_fixtures(self):
+        dir_path = os.path.join(os.path.dirname(__file__),
+                                'preprocess_cssless_data')
+        for name in ['multiset', 'basic_string']:
+            with self.subTest(name=name):
+                src_path = os.path.join(dir_path, name + '.html')
+                parser = etree.HTMLParser()
+                root = etree.parse(src_path, parser).getroot()
+                preprocess_html_merge_css(root, src_path)
+                self.assert_same_as_sequential(root)
+
+    def test_mixed(self):
+        input = \
+            '<html><body style="font-size:0.5em">' \
+            '<style>p { color: red }</style>tail' \
+            '<div style="display:none">removed</div>text' \
+            '<span style="display:table;font-size:2em">' \
+            '<span style="display:table-row">' \
+            '<span style="display:table-cell;width:0%">a</span>' \
+            '</span>' \
+            '</span>' \
+            '<div style="display:inline-block;font-size:10px">b</div>' \
+            '<div style="display:inline-table">' \
+            '<div style="display:none">c</div>' \
+            '</div>' \
+            '<table width="10%"><tr>' \
+            '<td style="border-top:1px solid;font-size:2em">d</td>' \
+            '<td width="0%">e</td></tr>' \
+            '<tr><td><table><tr><td style="border-top:1px">f</td></tr>' \
+            '</table></td></tr>' \
+            '</table>' \
+            '</body></html>'
+        root = etree.fromstring(input, etree.HTMLParser())
+        self.assert_same_as_sequential(root)
+
+
+class TestCompactInlineStyles(HTMLTestBase):
+    def convert(self, root):
+        compact_inline_styles(root)
+        return root
+
+    def test_inherited(self):
+        input = \
+            '<div style="color: red; font-size: 10pt">' \
+            '<span style="color: red; font-size: 12pt">a</span>' \
+            '<a style="color: red">b</a>' \
+            '<p style="font: 10pt serif"><b style="font-size: 10pt">c</b></p>' \
+            '<table style="color: blue" align="center">' \
+            '<tr><td style="color: blue; text-align: center">d</td></tr>' \
+            '</table>' \
+            '</div>'
+        expected = \
+            '<div style="color:red;font-size:10pt">' \
+            '<span style="font-size:12pt">a</span>' \
+            '<a style="color:red">b</a>' \
+            '<p style="font:10pt serif"><b style="font-size:10pt">c</b></p>' \
+            '<table style="color:blue" align="center">' \
+            '<tr><td style="text-align:center">d</td></tr>' \
+            '</table>' \
+            '</div>'
+        self.assert_converts_html(input, expected, self.convert)
+
+    def test_line_height(self):
+        input = \
+            '<div style="line-height: 1.2em">' \
+            '<div style="line-height: 1.2em; font-size: 8pt">a</div>' \
+            '<div style="line-height: 1.5">' \
+            '<div style="line-height: 1.5">b</div>' \
+            '</div>' \
+            '</div>'
+        expected = \
+            '<div style="line-height:1.2em">' \
+            '<div style="line-height:1.2em;font-size:8pt">a</div>' \
+            '<div style="line-height:1.5">' \
+            '<div>b</div>' \
+            '</div>' \
+            '</div>'
+        self.assert_converts_html(input, expected, self.convert)
+
+    def test_initial(self):
+        input = \
+            '<div style="margin: 0; padding: 0 0; display: block">a</div>' \
+            '<p style="margin: 0; float: none">b</p>' \
+            '<span style="margin: 0; margin-top: 0">c</span>' \
+            '<td bgcolor="red" style="background-color: transparent">d</td>'
+        expected = \
+            '<div>a</div>' \
+            '<p style="margin:0">b</p>' \
+            '<span style="margin:0;margin-top:0">c</span>' \
+            '<td bgcolor="red" style="background-color:transparent">d</td>'
+        self.assert_converts_html(input, expected, self.convert)
+
+    def test_shorthands(self):
+        input = \
+            '<div style="padding-top: 1px; padding-right: 2px; ' \
+            'padding-bottom: 1px; padding-left: 2px; color: red">a</div>' \
+            '<div style="padding-top: 1px; padding-right: 2px; ' \
+            'padding-bottom: 3px; padding-left: 4px">b</div>' \
+            '<div style="padding-top: 1px; padding-right: 1px; ' \
+            'padding-bottom: 1px; padding-left: 1px; padding: 2px">c</div>' \
+            '<div style="border-top: 1px solid red; ' \
+            'border-right: 1px solid red; border-bottom: 1px solid red; ' \
+            'border-left: 1px solid red">d</div>' \
+            '<div style="border-top: 1px solid red; ' \
+            'border-right: 1px solid red; border-bottom: 1px solid red; ' \
+            'border-left: 2px solid red">e</div>'
+        expected = \
+            '<div style="padding:1px 2px;color:red">a</div>' \
+            '<div style="padding:1px 2px 3px 4px">b</div>' \
+            '<div style="padding-top:1px;padding-right:1px;' \
+            'padding-bottom:1px;padding-left:1px;padding:2px">c</div>' \
+            '<div style="border:1px solid red">d</div>' \
+            '<div style="border-top:1px solid red;' \
+            'border-right:1px solid red;border-bottom:1px solid red;' \
+            'border-left:2px solid red">e</div>'
+        self.assert_converts_html(input, expected, self.convert)
+
+
+class TestInlineStyle(unittest.TestCase):
+    def setUp(self):
+        silence_cssutils_warnings()
+
+    # Checks that the results are the same as those of cssutils
+    def check(self, style):
+        expected = cssutils.parseStyle(style)
+        actual = parse_inline_style(style)
+        self.assertEqual(expected.getCssText(separator=''),
+                         actual.css_text())
+
+        for name in ['display', 'font-size', 'color']:
+            value = expected.getPropertyCSSValue(name)
+            self.assertEqual(value.cssText if value else None,
+                             actual.get(name))
+
+            removed = cssutils.parseStyle(style)
+            removed.removeProperty(name)
+            self.assertEqual(removed.getCssText(separator=''),
+                             actual.remove(name).css_text())
+
+            for value in ['16.0pt', '13.333333333333334pt', '1.9999999px',
+                          '1px solid #CCC', 'url(a.png)']:
+                modified = cssutils.parseStyle(style)
+                modified.setProperty(name, value)
+                self.assertEqual(modified.getCssText(separator=''),
+                                 actual.set(name, value).css_text())
+
+    def test_matches_cssutils(self):
+        styles = [
+            None,
+            '',
+            'display:table;font-size:1.0em',
+            ' Display : table-row ; ;',
+            'font-size:12.0pt;font-size:+0.50em;color:Red',
+            'margin:0  auto;width:.5em;padding:-0.0px 00.5PX',
+            'font-family:a , b,c;line-height:1.00;x:1.0e1px',
+            'color:#aBc;border-top:1px solid #CCC',
+            'color:#AABBCC;border:1px solid #aabbcd',
+            'color:#aabbcc;background:#FFffFF;border-color:#AaBbCc #112233',
+            'font-size:1em !important;font-size:2em;color:red!important',
+            'font-family:"a b", serif;background:url(a.png) no-repeat',
+            'font:12px/1.5 a;width:0%;height:0.0000005px',
+        ]
+        for style in styles:
+            with self.subTest(style=style):
+                self.check(style)
+
+    def test_immutable(self):
+        style = parse_inline_style('display:block;font-size:1em')
+        self.assertEqual('display: block', style.remove('font-size').css_text())
+        self.assertEqual('display: block;font-size: 1em', style.css_text())
+        other = parse_inline_style('display:block; font-size:1em')
+        self.assertEqual(hash(style), hash(other))
+
+
+class TestStyleCache(unittest.TestCase):
+    def make_cache(self, maxsize, eviction):
+        self.calls = []
+
+        def func(style):
+            self.calls.append(style)
+            return style.upper()
+        return StyleCache(func, maxsize, eviction)
+
+    def test_lru(self):
+        cache = self.make_cache(2, 'lru')
+        for style in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.assertEqual(style.upper(), cache(style))
+        self.assertEqual(['a', 'b', 'c', 'b'], self.calls)
+        self.assertEqual((2, 4, 2), cache.take_counters())
+        self.assertEqual((0, 0, 0), cache.take_counters())
+
+    def test_fifo(self):
+        cache = self.make_cache(2, 'fifo')
+        for style in ['a', 'b', 'a', 'c', 'a', 'b']:
+            self.assertEqual(style.upper(), cache(style))
+        self.assertEqual(['a', 'b', 'c', 'a', 'b'], self.calls)
+
+    def test_unbounded(self):
+        cache = self.make_cache(None, 'lru')
+        for style in ['a', 'b', 'c', 'a', 'b', 'c']:
+            cache(style)
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+        self.assertEqual(3, len(cache.entries))
+
+    def test_persist(self):
+        cache = self.make_cache(None, 'lru')
+        cache.track_new_entries()
+        cache('a')
+        cache('b')
+        cache('a')
+
+        report = StyleCacheReport({'func': [(('c',), 'C')]})
+        report.add({'func': cache.take_counters() + (len(cache.entries),
+                                                     cache.take_new_entries())})
+        self.assertEqual([], cache.take_new_entries())
+        self.assertEqual(
+            'Style cache func: 1 hits, 2 misses, 0 evictions, 2 entries',
+            report.format())
+
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, 'cache.pickle')
+            save_style_caches(fn, report.get_tables(maxsize=2))
+            self.assertEqual({'func': [(('a',), 'A'), (('b',), 'B')]},
+                             load_style_caches(fn))
+        self.assertIsNone(load_style_caches(fn))
+
+    def test_persist_stale(self):
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, 'cache.pickle')
+            save_style_caches(fn, {'func': [(('a',), StyleCacheReport())]})
+            with open(fn, 'rb') as f:
+                data = f.read()
+
+            # tables that reference a class that no longer exists in
+            # commands.preprocess_cssless
+            with open(fn, 'wb') as f:
+                f.write(data.replace(b'StyleCacheReport', b'GoneClassReport_'))
+            self.assertIsNone(load_style_caches(fn))
+
+            # tables written by different code
+            with open(fn, 'wb') as f:
+                pickle.dump('stale version', f)
+                f.write(data)
+            self.assertIsNone(load_style_caches(fn))
+
+            # the format used before the version was a separate record
+            with open(fn, 'wb') as f:
+                pickle.dump({'version': 'stale version', 'tables': {}}, f)
+            self.assertIsNone(load_style_caches(fn))
+
+            with open(fn, 'wb') as f:
+                f.write(b'garbage')
+            self.assertIsNone(load_style_caches(fn))
+
+
+class TestCheckPremailerCompatibility(unittest.TestCase):
+    def setUp(self):
+        check_premailer_compatibility.cache_clear()
+
+    def tearDown(self):
+        check_premailer_compatibility.cache_clear()
+
+    def test_installed(self):
+        # Fails when premailer is upgraded without checking that the
+        # internals CachedStyleSheetPremailer overrides are still the same
+        check_premailer_compatibility()
+
+    def test_version(self):
+        with unittest.mock.patch(
+                'commands.preprocess_cssless.get_package_version',
+                return_value='9.9.9'):
+            with self.assertRaisesRegex(Exception, 'premailer version'):
+                check_premailer_compatibility()
+
+    def test_signature(self):
+        def load_external(self, url, timeout):
+            pass
+
+        with unittest.mock.patch.object(Premailer, '_load_external',
+                                        load_external):
+            with self.assertRaisesRegex(Exception, '_load_external'):
+                check_premailer_compatibility()
+
+    def test_specificity_layout(self):
+        parse_style_rules = Premailer._parse_style_rules
+
+        def reversed_specificity(self, css_body, ruleset_index):
+            rules, leftover = parse_style_rules(self, css_body,
+                                                ruleset_index)
+            return [(tuple(reversed(spec)), selector, bulk)
+                    for spec, selector, bulk in rules], leftover
+
+        with unittest.mock.patch.object(Premailer, '_parse_style_rules',
+                                        reversed_specificity):
+            with self.assertRaisesRegex(Exception, 'specificity'):
+                check_premailer_compatibility()
+
+
 class TestApplyFontSize(unittest.TestCase):
     def test_em(self):
         self.assertEqual(10, apply_font_size('1em', 10))
@@ -561,6 +1039,17 @@ text
 </div>'''
         self.assert_converts_html(input, expected, test_fun)
 
+    def test_deep_tree(self):
+        root = etree.Element('div')
+        el = root
+        for i in range(5000):
+            el = etree.SubElement(el, 'div', style='font-size: 1em')
+        el.set('style', 'font-size: 50%')
+
+        convert_font_size_property_to_pt(root, 10)
+        self.assertEqual('font-size: 10pt', root[0].get('style'))
+        self.assertEqual('font-size: 5pt', el.get('style'))
+
 
 class TestConvertTableBorderTopToTrBackground(HTMLTestBase):
     def test_no_border(self):